@@ -0,0 +1,181 @@
+import asyncio
+
+from KamigamiLogging import logger
+from KamigamiMetrics import clock
+
+"""
+Tactile (button) controls mapped to robot actions.  A viewer mashing a
+button, or a whole audience pressing it at once, shows up as presses in
+report after report; the ActionScheduler turns those into a bounded
+number of robot commands:
+
+    debounce  presses of one control on one robot within this many
+              seconds of the first are one press, fired at the end of
+              the window;
+    cooldown  an action does not fire again on the same robot for this
+              many seconds;
+    rate      a token bucket caps each action at rate fires per second
+              (bursts of up to burst) over all robots together.
+
+An action that puts the robot in a state it will not leave by itself,
+such as test mode, gives a duration and the command that ends it; that
+command is sent duration seconds after the action fires.
+
+Pressing only does bookkeeping; the action runs from a loop timer and
+its commands are queued on the robot's transport, so no radio or other
+blocking I/O happens in the report handler.
+"""
+
+log = logger("control")
+
+
+class TokenBucket:
+    """
+    rate tokens per second, holding at most burst.
+    """
+    def __init__(self, rate, burst=1.0):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self._last = clock()
+
+    def take(self, now=None):
+        now = clock() if now is None else now
+        self.tokens = min(self.burst, self.tokens + (now - self._last) * self.rate)
+        self._last = now
+        if self.tokens < 1.0:
+            return False
+        self.tokens -= 1.0
+        return True
+
+
+class TactileAction:
+    """
+    command, *args: what to send through KamigamiController.send, e.g.
+                    TactileAction("color", "red").
+    debounce, cooldown, rate, burst: see the module docstring.
+    duration: seconds after firing to send then, or None.
+    then: (command, *args) that ends the action, e.g. ("testmode", 0).
+    """
+    def __init__(self, command, *args, debounce=0.1, cooldown=0.5, rate=2.0, burst=2.0,
+                 duration=None, then=None):
+        if (duration is None) != (then is None):
+            raise ValueError("duration and then go together")
+        self.command = command
+        self.args = args
+        self.debounce = debounce
+        self.cooldown = cooldown
+        self.rate = rate
+        self.burst = burst
+        self.duration = duration
+        self.then = then
+
+    def run(self, controller):
+        controller.send(self.command, *self.args)
+
+    def finish(self, controller):
+        controller.send(*self.then)
+
+
+# Actions buttons can be mapped to by name.
+ACTIONS = {
+    "kick": TactileAction("ir", debounce=0.1, cooldown=1.0, rate=2.0),
+    "red": TactileAction("color", "red", debounce=0.1, cooldown=0.5, rate=4.0),
+    "blue": TactileAction("color", "blue", debounce=0.1, cooldown=0.5, rate=4.0),
+    "green": TactileAction("color", "green", debounce=0.1, cooldown=0.5, rate=4.0),
+    "spin": TactileAction("testmode", 20, debounce=0.2, cooldown=3.0, rate=0.5, burst=1.0,
+                          duration=2.0, then=("testmode", 0)),
+}
+
+
+class ActionScheduler:
+    """
+    bindings: {tactile control id: action name}.
+    actions: {action name: TactileAction}, default ACTIONS.
+    """
+    def __init__(self, bindings, actions=None, loop=None):
+        self.bindings = dict(bindings)
+        self.actions = actions if actions is not None else ACTIONS
+        self.loop = loop
+        self._pending = {}
+        self._last_fired = {}
+        self._running = {}
+        self._buckets = dict((name, TokenBucket(action.rate, action.burst))
+                             for name, action in self.actions.items())
+
+        self.pressed = 0
+        self.debounced = 0
+        self.fired = 0
+        self.cooled_down = 0
+        self.rate_limited = 0
+        self.errors = 0
+        self.finished = 0
+
+    def _loop(self):
+        return self.loop if self.loop is not None else asyncio.get_event_loop()
+
+    def press(self, control_id, robot_index, controller):
+        """
+        Note a press of control_id for the robot at robot_index.  Returns
+        False if the control is not bound to an action.
+        """
+        name = self.bindings.get(control_id)
+        if name is None:
+            return False
+        self.pressed += 1
+        key = (control_id, robot_index)
+        if key in self._pending:
+            self.debounced += 1
+            return True
+        self._pending[key] = controller
+        self._loop().call_later(self.actions[name].debounce, self._fire, key, name, robot_index)
+        return True
+
+    def _fire(self, key, name, robot_index):
+        controller = self._pending.pop(key)
+        action = self.actions[name]
+        now = clock()
+        last = self._last_fired.get((name, robot_index))
+        if last is not None and now - last < action.cooldown:
+            self.cooled_down += 1
+            return
+        if not self._buckets[name].take(now):
+            self.rate_limited += 1
+            return
+        self._last_fired[(name, robot_index)] = now
+        try:
+            action.run(controller)
+        except Exception:
+            self.errors += 1
+            log.exception("Action %s failed on robot %d", name, robot_index)
+            return
+        self.fired += 1
+        log.debug("Action %s on robot %d", name, robot_index)
+        if action.duration is not None:
+            # Only the latest firing on a robot ends the action, so an
+            # earlier timer does not cut a refired action short.
+            self._running[(name, robot_index)] = now
+            self._loop().call_later(action.duration, self._finish, name, robot_index, controller, now)
+
+    def _finish(self, name, robot_index, controller, fired):
+        if self._running.get((name, robot_index)) != fired:
+            return
+        del self._running[(name, robot_index)]
+        try:
+            self.actions[name].finish(controller)
+        except Exception:
+            self.errors += 1
+            log.exception("Ending action %s failed on robot %d", name, robot_index)
+            return
+        self.finished += 1
+
+    def stats(self):
+        return {
+            "pressed": self.pressed,
+            "debounced": self.debounced,
+            "fired": self.fired,
+            "finished": self.finished,
+            "cooled_down": self.cooled_down,
+            "rate_limited": self.rate_limited,
+            "errors": self.errors,
+        }
@@ -0,0 +1,115 @@
+import time
+
+from KamigamiController import KamigamiController
+from KamigamiMetrics import Histogram, clock
+
+"""
+Scripted sequences (a pre-match routine, a calibration sweep) for the
+CLI.  A script is compiled once, every line parsed and encoded up front,
+into a list of (seconds from start, frame) pairs; play() then writes the
+frames at those times on a monotonic schedule, so playback timing does
+not depend on how long a line takes to parse or encode.
+
+Script lines are CLI commands (see KamigamiCli.HELP_TEXT), optionally
+timed:
+
+    # calibration sweep
+    lights 0 0 255
+    +0.5 motors 20 20      half a second after the previous line
+    @2 motors 0 0          two seconds after the start
+    wait 1                 nothing for a second
+    shutdown
+
+Untimed lines follow the previous line immediately.  "exit" ends the
+script.
+"""
+
+
+class _FrameCapture:
+    def __init__(self):
+        self.frames = []
+
+    def write_value(self, message):
+        self.frames.append(bytes(message))
+
+
+class BatchError(ValueError):
+    def __init__(self, line_number, message):
+        ValueError.__init__(self, "Line {0}: {1}".format(line_number, message))
+        self.line_number = line_number
+
+
+def compile_script(lines, commands=None):
+    """
+    Parse and encode script lines.  Returns [(seconds, frame)] in time
+    order.  Raises BatchError for the first bad line.
+    """
+    if commands is None:
+        from KamigamiCli import CLI_COMMANDS as commands
+    capture = _FrameCapture()
+    robot = KamigamiController(capture)
+    schedule = []
+    now = 0.0
+    for line_number, line in enumerate(lines, 1):
+        tokens = line.split("#", 1)[0].split()
+        if not tokens:
+            continue
+        try:
+            if tokens[0][0] == "@":
+                now = float(tokens.pop(0)[1:])
+            elif tokens[0][0] == "+":
+                now += float(tokens.pop(0)[1:])
+        except ValueError:
+            raise BatchError(line_number, "Bad time {0}".format(tokens[0]))
+        if not tokens:
+            continue
+        name, args = tokens[0], tokens[1:]
+        if name == "wait":
+            try:
+                now += float(args[0])
+            except (IndexError, ValueError):
+                raise BatchError(line_number, "Please specify a time to wait.")
+            continue
+        if name[0:4] == "exit":
+            break
+        if name == "help" or name not in commands:
+            raise BatchError(line_number, "Unknown command {0}".format(name))
+        handler, arg_count, missing_message = commands[name]
+        if len(args) < arg_count:
+            raise BatchError(line_number, missing_message)
+        del capture.frames[:]
+        try:
+            handler(robot, args)
+        except (ValueError, AttributeError) as error:
+            raise BatchError(line_number, error)
+        schedule.extend((now, frame) for frame in capture.frames)
+    # Stable, so frames of one line keep their order.
+    schedule.sort(key=lambda entry: entry[0])
+    return schedule
+
+
+def play(schedule, writer, spin=0.002, sleep=time.sleep):
+    """
+    Write each frame at its time after the start.  Every wait is for an
+    absolute target (start + seconds), so lateness never accumulates: the
+    thread sleeps until spin seconds before the target and busy-waits the
+    rest.  Returns a Histogram of how late each write started.
+    """
+    lateness = Histogram()
+    start = clock()
+    for seconds, frame in schedule:
+        target = start + seconds
+        remaining = target - clock()
+        if remaining > spin:
+            sleep(remaining - spin)
+        while clock() < target:
+            pass
+        lateness.record(clock() - target)
+        writer.write_value(frame)
+    return lateness
+
+
+def jitter_report(lateness):
+    return "{0} frames, lateness mean {1:.3f}ms p50 {2:.3f}ms p99 {3:.3f}ms max {4:.3f}ms".format(
+        lateness.count, lateness.mean * 1e3, lateness.percentile(50) * 1e3,
+        lateness.percentile(99) * 1e3, lateness.max * 1e3)
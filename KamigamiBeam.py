@@ -0,0 +1,412 @@
+import asyncio
+import json
+import os
+import random
+import ssl
+import time
+
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode, urljoin, urlsplit
+
+from beam_interactive import start
+
+from KamigamiLogging import logger
+
+"""
+Beam without blocking the event loop.  BeamApi talks HTTP/1.1 to the Beam
+REST API over asyncio streams, so logging in and joining Interactive run
+alongside connecting the robots instead of stalling every robot's tick.
+
+BeamSessionCache keeps the channel id and the session cookie of each user
+on disk, so a restart skips logging in, and the Interactive address and
+key in memory until they expire, so a reconnect skips the API entirely.
+
+InteractiveLink supervises the Interactive connection: when it drops it
+is opened again, at once while the cached key keeps working and with
+jittered exponential backoff while it does not.  The robots are not
+touched, so they stay connected (and stopped at their last command)
+while Interactive comes back.
+"""
+
+log = logger("interactive")
+
+URL = "https://beam.pro/api/v1/"
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".kamigami_beam.json")
+
+
+class BeamError(Exception):
+    """
+    A Beam API request that failed; status is the HTTP status, or None if
+    there was no answer.
+    """
+    def __init__(self, message, status=None):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+@asyncio.coroutine
+def _read_response(reader):
+    """
+    (status, [(header, value)], body) of one HTTP/1.x response.
+    """
+    status_line = yield from reader.readline()
+    parts = status_line.decode("latin-1").split(None, 2)
+    if len(parts) < 2 or not parts[0].startswith("HTTP/"):
+        raise BeamError("Malformed response {0!r}.".format(status_line))
+    status = int(parts[1])
+    headers = []
+    while True:
+        line = yield from reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers.append((name.strip().lower(), value.strip()))
+    fields = dict(headers)
+    if "chunked" in fields.get("transfer-encoding", "").lower():
+        chunks = []
+        while True:
+            size = int((yield from reader.readline()).split(b";")[0], 16)
+            if not size:
+                break
+            chunks.append((yield from reader.readexactly(size)))
+            yield from reader.readline()
+        body = b"".join(chunks)
+    elif "content-length" in fields:
+        body = yield from reader.readexactly(int(fields["content-length"]))
+    else:
+        body = yield from reader.read()
+    return status, headers, body
+
+
+class BeamApi:
+    """
+    The parts of the Beam REST API this app uses.
+    url: API root; point it at a local stand-in for tests.
+    timeout: seconds for a whole request.
+    cookies: the session, {name: value}; logging in fills it.
+    """
+    def __init__(self, url=URL, timeout=10.0, cookies=None):
+        self.url = url
+        self.timeout = timeout
+        self.cookies = dict(cookies or {})
+        self.requests = 0
+
+    def _build(self, endpoint):
+        """Build an address for an API endpoint."""
+        return urljoin(self.url, endpoint.lstrip('/'))
+
+    @asyncio.coroutine
+    def request(self, method, endpoint, data=None):
+        """
+        Send one request and return its decoded JSON body.  data is sent
+        form encoded.  Raises BeamError for anything but a 2xx answer.
+        """
+        return (yield from asyncio.wait_for(self._request(method, endpoint, data), self.timeout))
+
+    @asyncio.coroutine
+    def _request(self, method, endpoint, data):
+        address = urlsplit(self._build(endpoint))
+        secure = address.scheme == "https"
+        port = address.port or (443 if secure else 80)
+        path = address.path + ("?" + address.query if address.query else "")
+        headers = [
+            ("Host", address.netloc),
+            ("Accept", "application/json"),
+            ("Connection", "close"),
+            ("User-Agent", "Kamigami-Interactive"),
+        ]
+        if self.cookies:
+            headers.append(("Cookie", "; ".join("{0}={1}".format(name, value)
+                                                for name, value in sorted(self.cookies.items()))))
+        body = b""
+        if data is not None:
+            body = urlencode(data).encode("utf-8")
+            headers.append(("Content-Type", "application/x-www-form-urlencoded"))
+        headers.append(("Content-Length", str(len(body))))
+
+        self.requests += 1
+        try:
+            reader, writer = yield from asyncio.open_connection(
+                address.hostname, port, ssl=ssl.create_default_context() if secure else None)
+        except OSError as error:
+            raise BeamError("Could not reach {0}: {1}".format(address.netloc, error))
+        try:
+            writer.write("{0} {1} HTTP/1.1\r\n".format(method, path).encode("latin-1") +
+                         "".join("{0}: {1}\r\n".format(name, value) for name, value in headers).encode("latin-1") +
+                         b"\r\n" + body)
+            status, headers, body = yield from _read_response(reader)
+        except (OSError, asyncio.IncompleteReadError, ValueError) as error:
+            raise BeamError("{0} {1} failed: {2}".format(method, endpoint, error))
+        finally:
+            writer.close()
+
+        for name, value in headers:
+            if name == "set-cookie":
+                for morsel in SimpleCookie(value).values():
+                    self.cookies[morsel.key] = morsel.value
+        if not 200 <= status < 300:
+            raise BeamError("{0} {1} answered {2}.".format(method, endpoint, status), status)
+        try:
+            return json.loads(body.decode("utf-8"))
+        except ValueError:
+            raise BeamError("{0} {1} answered with something other than JSON.".format(method, endpoint), status)
+
+    @asyncio.coroutine
+    def login(self, username, password, code=''):
+        """Log into Beam via the API."""
+        auth = dict(username=username, password=password, code=code)
+        return (yield from self.request("POST", "/users/login", auth))
+
+    @asyncio.coroutine
+    def join_interactive(self, channel):
+        """Retrieve interactive connection information."""
+        return (yield from self.request("GET", "/interactive/{channel}/robot".format(channel=channel)))
+
+
+class BeamSessionCache:
+    """
+    Channel id and session cookies of each user, stored as JSON readable
+    only by the owner (or only in memory if path is None), ignored once
+    older than session_ttl seconds; and Interactive address and key, kept
+    in memory for key_ttl seconds.
+    """
+    def __init__(self, path=DEFAULT_CACHE_PATH, session_ttl=24 * 60 * 60, key_ttl=5 * 60):
+        self.path = path
+        self.session_ttl = session_ttl
+        self.key_ttl = key_ttl
+        self._interactive = {}
+        self._sessions = {}
+
+    def _load(self):
+        if self.path is None:
+            return dict(self._sessions)
+        try:
+            with open(self.path) as cache_file:
+                return json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _save(self, entries):
+        if self.path is None:
+            self._sessions = entries
+            return
+        temp_path = self.path + ".tmp"
+        try:
+            descriptor = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with open(descriptor, "w") as cache_file:
+                json.dump(entries, cache_file)
+            os.replace(temp_path, self.path)
+        except (IOError, OSError):
+            # The cache is only an optimization.
+            pass
+
+    def session(self, username):
+        """
+        (channel id, cookies) of username's last login, or None.
+        """
+        entry = self._load().get(username)
+        if entry is None or time.time() - entry.get("saved", 0) > self.session_ttl:
+            return None
+        return entry["channel"], entry.get("cookies", {})
+
+    def remember_session(self, username, channel, cookies):
+        entries = self._load()
+        entries[username] = {"channel": channel, "cookies": cookies, "saved": time.time()}
+        self._save(entries)
+
+    def forget_session(self, username):
+        entries = self._load()
+        if entries.pop(username, None) is not None:
+            self._save(entries)
+
+    def interactive(self, channel):
+        """
+        join_interactive's answer for channel while it is fresh, or None.
+        """
+        entry = self._interactive.get(channel)
+        if entry is None or time.monotonic() - entry[0] > self.key_ttl:
+            return None
+        return entry[1]
+
+    def remember_interactive(self, channel, data):
+        self._interactive[channel] = (time.monotonic(), data)
+
+    def forget_interactive(self, channel):
+        self._interactive.pop(channel, None)
+
+
+class InteractiveLink:
+    """
+    Keeps an Interactive connection open and its packets handled.
+    api: a BeamApi.
+    auth: {"username", "password"[, "code"]}.
+    handle: coroutine function taking a connection and returning when it
+            closes, e.g. index.handle_packets.
+    cache: a BeamSessionCache; one in memory only if None.
+    connect: coroutine function (address, channel, key) -> connection,
+             beam_interactive.start by default.
+    backoff, max_backoff: seconds to wait after the first failure in a
+                          row, doubling (with jitter) up to max_backoff.
+    stable: a connection open at least this many seconds was good; one
+            that drops sooner counts as a failure (a rejected key closes
+            right after the handshake) and its key is not reused.
+    poll: seconds between checks that the connection is still open.
+    """
+    def __init__(self, api, auth, handle, cache=None, connect=start, backoff=0.5, max_backoff=30.0,
+                 stable=5.0, poll=0.1):
+        self.api = api
+        self.auth = auth
+        self.handle = handle
+        self.cache = cache if cache is not None else BeamSessionCache(path=None)
+        self.connect = connect
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.stable = stable
+        self.poll = poll
+        self.channel = None
+        self.connection = None
+        self.failures = 0
+        self.connects = 0
+        self.logins = 0
+        self.joins = 0
+        self.errors = 0
+        self._stopping = False
+
+    @asyncio.coroutine
+    def log_in(self):
+        """
+        The channel id, from the cached session or by logging in.
+        """
+        username = self.auth["username"]
+        session = self.cache.session(username)
+        if session is not None:
+            self.channel, cookies = session
+            self.api.cookies.update(cookies)
+            return self.channel
+        self.logins += 1
+        user = yield from self.api.login(username, self.auth["password"], self.auth.get("code", ''))
+        self.channel = user["channel"]["id"]
+        self.cache.remember_session(username, self.channel, self.api.cookies)
+        return self.channel
+
+    @asyncio.coroutine
+    def interactive_info(self):
+        """
+        (channel id, join_interactive answer), from the caches where they
+        are fresh.  A cached session that Beam no longer accepts is
+        replaced by logging in again.
+        """
+        channel = yield from self.log_in()
+        data = self.cache.interactive(channel)
+        if data is not None:
+            return channel, data
+        self.joins += 1
+        try:
+            data = yield from self.api.join_interactive(channel)
+        except BeamError as error:
+            if error.status not in (401, 403) or not self.cache.session(self.auth["username"]):
+                raise
+            log.info("Cached Beam session was refused, logging in again.")
+            self.cache.forget_session(self.auth["username"])
+            self.api.cookies.clear()
+            channel = yield from self.log_in()
+            self.joins += 1
+            data = yield from self.api.join_interactive(channel)
+        self.cache.remember_interactive(channel, data)
+        return channel, data
+
+    def delay(self):
+        """
+        Seconds to wait before the next attempt.
+        """
+        if not self.failures:
+            return 0.0
+        ceiling = min(self.max_backoff, self.backoff * 2 ** (self.failures - 1))
+        return random.uniform(ceiling / 2, ceiling)
+
+    @asyncio.coroutine
+    def run(self):
+        """
+        Connect and handle packets until stop() is called.
+        """
+        while not self._stopping:
+            delay = self.delay()
+            if delay:
+                yield from asyncio.sleep(delay)
+            if self._stopping:
+                break
+            channel = None
+            try:
+                channel, data = yield from self.interactive_info()
+                self.connection = yield from self.connect(data["address"], channel, data["key"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                # API errors, timeouts, websockets' handshake errors...
+                self.errors += 1
+                self.failures += 1
+                self.cache.forget_interactive(channel)
+                log.warning("Could not connect to Interactive (attempt %d): %r", self.failures, error)
+                continue
+
+            self.connects += 1
+            opened = time.monotonic()
+            failed = False
+            log.info("Connected to Interactive on channel %s.", channel)
+            try:
+                yield from self._handle_until_closed(self.connection)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # A bug in a handler must not take the robots off the air.
+                self.errors += 1
+                failed = True
+                log.exception("Interactive handler failed.")
+            finally:
+                self.connection.close()
+                self.connection = None
+            if not failed and time.monotonic() - opened >= self.stable:
+                self.failures = 0
+            else:
+                self.failures += 1
+                self.cache.forget_interactive(channel)
+            if not self._stopping:
+                log.warning("Interactive disconnected, reconnecting.")
+
+    @asyncio.coroutine
+    def _handle_until_closed(self, connection):
+        """
+        Run handle(connection) until it returns or the connection closes.
+        beam_interactive's Connection marks itself closed when the socket
+        drops but leaves a pending wait_message() waiting for good, so
+        the handler is cancelled once the connection reports closed.
+        Raises whatever the handler raised.
+        """
+        handling = asyncio.get_event_loop().create_task(self.handle(connection))
+        try:
+            while not handling.done():
+                yield from asyncio.wait([handling], timeout=self.poll)
+                if not handling.done() and connection.closed:
+                    handling.cancel()
+                    yield from asyncio.wait([handling])
+        finally:
+            handling.cancel()
+        if not handling.cancelled():
+            handling.result()
+
+    def stop(self):
+        self._stopping = True
+        if self.connection is not None:
+            self.connection.close()
+
+    def stats(self):
+        return {
+            "connected": self.connection is not None,
+            "connects": self.connects,
+            "reconnects": max(self.connects - 1, 0),
+            "failures": self.failures,
+            "errors": self.errors,
+            "logins": self.logins,
+            "joins": self.joins,
+            "api_requests": self.api.requests,
+        }
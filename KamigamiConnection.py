@@ -1,9 +1,10 @@
 import argparse
 import time
-from subprocess import check_output
-from bluepy import btle
 from KamigamiData import *
 from KamigamiInterface import KamigamiInterface
+import KamigamiLogging
+from KamigamiSession import KamigamiSession
+from KamigamiTelemetry import KamigamiTelemetry
 
 class AdaptedWriter():
 	"""
@@ -21,33 +22,28 @@ class AdaptedWriter():
 
 parser = argparse.ArgumentParser()
 
-# TODO: Auto Mac Address Finding.
 parser.add_argument('-m', '--mac', action='store',
                     help='Supply the mac address.') 
+parser.add_argument('--log', action='store', default="INFO",
+                    help='Log levels, e.g. "INFO,session=DEBUG".  Default INFO.')
+args = parser.parse_args()
 
+# The session reports connecting and reconnecting through logging.
+sink = KamigamiLogging.setup(args.log)
 try:
-	print("Attempting to connect to Mac Address: " + parser.parse_args().mac)
-	MAC_ADDR = parser.parse_args().mac
-except:
-	print("Scanning for Robot and connecting to the first one.")
-	import os
-	if "mac_scanner.py" not in os.listdir("."):
-		raise EnvironmentError("Mac address must be specified if the scanner is not in the directory.")
-	MAC_ADDR = check_output(["sudo", "python", "mac_scanner.py", "-p", "-t", "5.0"])[:17]
+	if args.mac is None:
+		print("Scanning for Robot and connecting to the first one.")
 
+	# Tries recently seen robots before scanning, and stops scanning as soon
+	# as a robot advertises.
+	session = KamigamiSession(mac=args.mac, scan_time=5.0).connect()
 
-p = btle.Peripheral(MAC_ADDR, addrType=btle.ADDR_TYPE_RANDOM)
+	telemetry = KamigamiTelemetry().attach(session)
 
-print("Aquired peripheral.")
+	interface = KamigamiInterface(telemetry, AdaptedWriter(session.writer))
+	interface.run()
 
-# Setup to turn notifications on, e.g.
 
-service = p.getServiceByUUID(KamigamiRobot.MAIN_SERVICE_UUID)
-
-writer = service.getCharacteristics(KamigamiRobot.WRITE_UUID)[0]
-
-interface = KamigamiInterface(None, AdaptedWriter(writer))
-interface.run()
-
-
-time.sleep(10)
+	time.sleep(10)
+finally:
+	sink.stop()
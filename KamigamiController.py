@@ -0,0 +1,83 @@
+from KamigamiData import KamigamiByteFormatter
+from KamigamiMetrics import clock
+
+"""
+Typed programmatic API for driving a Kamigami Robot.  Code that already
+has numbers in hand (the Interactive handlers, scripts) should call these
+methods directly; the text CLI in KamigamiCli is only a parser on top.
+"""
+
+
+class KamigamiController:
+    """
+    writer: anything with a write_value(message) method, e.g. AdaptedWriter.
+    motor_writer: optional separate destination for motor packets, such as
+                  a CommandMailbox, so they can be rate limited on their own.
+    metrics: optional Metrics to record motor packet encode times in.
+    merger: optional UnifiedTickMerger.  Motor and light settings then go
+            to it as plain values and it decides what frames to send.
+    """
+    def __init__(self, writer, motor_writer=None, metrics=None, merger=None):
+        self.writer = writer
+        self.motor_writer = motor_writer if motor_writer is not None else writer
+        self.metrics = metrics
+        self.merger = merger
+
+    def set_motors(self, left, right):
+        if self.merger is not None:
+            self.merger.set_motors(left, right)
+            return
+        if self.metrics is None:
+            self.motor_writer.write_value(KamigamiByteFormatter.get_sendable_motor_packet(left, right))
+            return
+        started = clock()
+        packet = KamigamiByteFormatter.get_sendable_motor_packet(left, right)
+        self.metrics.stage("encode").since(started)
+        self.motor_writer.write_value(packet)
+
+    def set_lights(self, r, g, b):
+        if self.merger is not None:
+            self.merger.set_lights(r, g, b)
+            return
+        self.writer.write_value(KamigamiByteFormatter.get_sendable_light_packet(r=r, g=g, b=b))
+
+    def set_color(self, color):
+        if self.merger is not None:
+            if color.lower() not in KamigamiByteFormatter.COLORS:
+                raise ValueError("Bad Arguments")
+            self.merger.set_lights(*KamigamiByteFormatter.COLORS[color.lower()])
+            return
+        self.writer.write_value(KamigamiByteFormatter.get_sendable_light_packet(color=color))
+
+    def ir(self):
+        self.writer.write_value(KamigamiByteFormatter.get_sendable_ir_packet())
+
+    def shutdown(self):
+        self.writer.write_value(KamigamiByteFormatter.get_sendable_shutdown())
+
+    def testmode(self, speed):
+        self.writer.write_value(KamigamiByteFormatter.get_sendable_testmode(speed))
+
+    def send_raw(self, values):
+        self.writer.write_value(KamigamiByteFormatter.convert_params_to_message(values))
+
+    def send(self, command, *args):
+        """
+        Dispatch a command by name, e.g. send("motors", 10, 10).
+        """
+        try:
+            method = KamigamiController.COMMANDS[command]
+        except KeyError:
+            raise ValueError("Unknown command: {0}".format(command))
+        method(self, *args)
+
+
+KamigamiController.COMMANDS = {
+    "motors": KamigamiController.set_motors,
+    "lights": KamigamiController.set_lights,
+    "color": KamigamiController.set_color,
+    "ir": KamigamiController.ir,
+    "shutdown": KamigamiController.shutdown,
+    "testmode": KamigamiController.testmode,
+    "raw": KamigamiController.send_raw,
+}
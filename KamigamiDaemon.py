@@ -0,0 +1,371 @@
+import argparse
+import asyncio
+import os
+import socket
+import stat
+import struct
+import tempfile
+
+from KamigamiData import KamigamiByteFormatter, KamigamiRobot
+from KamigamiFleet import Fleet
+import KamigamiLogging
+from KamigamiMetrics import clock
+from KamigamiScanner import MacCache
+from KamigamiSession import KamigamiSession
+
+"""
+Long running owner of the robot links.  Local tools send commands to the
+daemon instead of scanning and connecting themselves, so a command costs
+a local round trip rather than a BLE connect, and any number of
+producers share the daemon's links.
+
+Commands come over a Unix stream socket, where every message is prefixed
+with its length as a little-endian uint16, and/or (if enabled) local UDP
+datagrams.
+A command is REQUEST (sequence number, robot index) followed by one
+robot frame exactly as KamigamiByteFormatter builds it.  Every command
+is answered with ACK (sequence number, status).
+
+The Unix socket lives in the user's runtime directory and only its owner
+may connect; a robot is as private as the account running the daemon.
+UDP has no such check: any local user can drive the robots through it,
+so it is off unless a port is given.
+
+Sequence numbers are per client (UDP source address or Unix
+connection).  A command whose number is not newer than the last one
+accepted from that client, e.g. a late UDP datagram, is answered STALE
+and not sent.  Sequence number 0 opts out of this check.
+"""
+
+REQUEST = struct.Struct('<IB')
+ACK = struct.Struct('<IB')
+LENGTH = struct.Struct('<H')
+
+OK = 0
+STALE = 1
+BAD_ROBOT = 2
+BAD_FRAME = 3
+BUSY = 4
+
+
+
+def default_socket_path():
+    """
+    $XDG_RUNTIME_DIR/kamigami.sock, or a per user name in the temporary
+    directory where there is no runtime directory.
+    """
+    runtime = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime:
+        return os.path.join(runtime, "kamigami.sock")
+    return os.path.join(tempfile.gettempdir(), "kamigami-{0}.sock".format(os.getuid()))
+
+
+DEFAULT_SOCKET_PATH = default_socket_path()
+DEFAULT_UDP_PORT = 9106
+
+log = KamigamiLogging.logger("control")
+
+
+def _newer(seq, last):
+    """
+    Serial number comparison, so sequence numbers can wrap around.
+    """
+    return 0 < (seq - last) % 0x100000000 < 0x80000000
+
+
+class KamigamiDaemon:
+    """
+    fleet: a started Fleet whose robots the commands drive.
+    client_ttl: seconds after which an idle client's sequence state is
+                forgotten.
+    """
+    def __init__(self, fleet, client_ttl=60.0):
+        self.fleet = fleet
+        self.client_ttl = client_ttl
+        self._clients = {}
+        self._since_prune = 0
+        self._servers = []
+        self._unix_path = None
+
+        self.received = 0
+        self.accepted = 0
+        self.stale = 0
+        self.rejected = 0
+
+    def handle(self, client, message):
+        """
+        Run one command from client, returning the ACK to answer with.
+        """
+        self.received += 1
+        if len(message) < REQUEST.size + 1:
+            self.rejected += 1
+            return ACK.pack(0, BAD_FRAME)
+        seq, robot_index = REQUEST.unpack_from(message)
+        status = self._run(client, seq, robot_index, message[REQUEST.size:])
+        if status == OK:
+            self.accepted += 1
+        elif status == STALE:
+            self.stale += 1
+        else:
+            self.rejected += 1
+        return ACK.pack(seq, status)
+
+    def _run(self, client, seq, robot_index, frame):
+        now = clock()
+        if seq:
+            last = self._clients.get(client)
+            if last is not None and not _newer(seq, last[0]):
+                return STALE
+            self._clients[client] = (seq, now)
+            self._prune(now)
+        if robot_index >= len(self.fleet.robots):
+            return BAD_ROBOT
+        identifier = frame[0]
+        if KamigamiByteFormatter.FRAME_SIZES.get(identifier) != len(frame):
+            return BAD_FRAME
+        controller = self.fleet.robots[robot_index].controller
+        try:
+            # Motor and light frames go through the controller, so they
+            # are merged and rate limited like any other producer's.
+            if identifier == KamigamiRobot.Identifiers.MOTOR_PACKET:
+                _, left, right = KamigamiByteFormatter.MOTOR_STRUCT.unpack(frame)
+                controller.set_motors(left, right)
+            elif identifier == KamigamiRobot.Identifiers.LIGHT_PACKET:
+                _, r, g, b = KamigamiByteFormatter.LIGHT_STRUCT.unpack(frame)
+                controller.set_lights(r, g, b)
+            elif controller.writer.write_value(frame) is None:
+                return BUSY
+        except ValueError:
+            return BAD_FRAME
+        return OK
+
+    def _prune(self, now):
+        self._since_prune += 1
+        if self._since_prune < 1024:
+            return
+        self._since_prune = 0
+        for client, (seq, seen) in list(self._clients.items()):
+            if now - seen > self.client_ttl:
+                del self._clients[client]
+
+    def forget(self, client):
+        self._clients.pop(client, None)
+
+    @asyncio.coroutine
+    def serve_udp(self, host="127.0.0.1", port=DEFAULT_UDP_PORT, loop=None):
+        loop = loop if loop is not None else asyncio.get_event_loop()
+        transport, protocol = yield from loop.create_datagram_endpoint(
+            lambda: _DatagramProtocol(self), local_addr=(host, port))
+        self._servers.append(transport)
+        return transport
+
+    @asyncio.coroutine
+    def serve_unix(self, path=DEFAULT_SOCKET_PATH):
+        """
+        Listen on a Unix socket only the current user can connect to.  A
+        socket left behind by a daemon that died is replaced; anything
+        else already at path is an error.
+        """
+        _remove_stale_socket(path)
+
+        @asyncio.coroutine
+        def handle_client(reader, writer):
+            client = ("unix", id(writer))
+            try:
+                while True:
+                    header = yield from reader.readexactly(LENGTH.size)
+                    message = yield from reader.readexactly(LENGTH.unpack(header)[0])
+                    writer.write(LENGTH.pack(ACK.size) + self.handle(client, message))
+                    # A client that does not read its ACKs is not read from
+                    # either, rather than buffered for without limit.
+                    yield from writer.drain()
+            except (asyncio.IncompleteReadError, ConnectionError):
+                pass
+            finally:
+                self.forget(client)
+                writer.close()
+
+        server = yield from asyncio.start_unix_server(handle_client, sock=_bind_private_socket(path))
+        self._servers.append(server)
+        self._unix_path = path
+        return server
+
+    def close(self):
+        """
+        Stop listening and remove the Unix socket.
+        """
+        for server in self._servers:
+            server.close()
+        self._servers = []
+        if self._unix_path is not None:
+            try:
+                os.unlink(self._unix_path)
+            except OSError:
+                pass
+            self._unix_path = None
+
+    def stats(self):
+        return {
+            "clients": len(self._clients),
+            "received": self.received,
+            "accepted": self.accepted,
+            "stale": self.stale,
+            "rejected": self.rejected,
+        }
+
+
+def _bind_private_socket(path):
+    """
+    A Unix socket bound at path with mode 0600 from the start; chmod
+    after bind would leave a window in which anyone could connect.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    mask = os.umask(0o177)
+    try:
+        sock.bind(path)
+    except OSError:
+        sock.close()
+        raise
+    finally:
+        os.umask(mask)
+    return sock
+
+
+def _remove_stale_socket(path):
+    try:
+        mode = os.lstat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise FileExistsError("{0} exists and is not a socket.".format(path))
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except ConnectionRefusedError:
+        os.unlink(path)
+        return
+    finally:
+        probe.close()
+    raise OSError("A daemon is already listening on {0}.".format(path))
+
+
+class _DatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, daemon):
+        self.daemon = daemon
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.transport.sendto(self.daemon.handle(addr, data), addr)
+
+
+class DaemonClient:
+    """
+    Blocking client.  address is a Unix socket path or a (host, port)
+    UDP address.
+    """
+    def __init__(self, address=DEFAULT_SOCKET_PATH, timeout=0.5):
+        self.address = address
+        if isinstance(address, str):
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.connect(address)
+            self.stream = True
+        else:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.socket.connect(address)
+            self.stream = False
+        self.socket.settimeout(timeout)
+        self.seq = 0
+
+    def send(self, frame, robot=0):
+        """
+        Send one frame and wait for its ACK.  Returns the status, or
+        None if no ACK came in time.
+        """
+        self.seq = self.seq % 0xFFFFFFFF + 1
+        message = REQUEST.pack(self.seq, robot) + bytes(frame)
+        try:
+            if self.stream:
+                self.socket.sendall(LENGTH.pack(len(message)) + message)
+            else:
+                self.socket.send(message)
+            while True:
+                seq, status = ACK.unpack(self._receive())
+                # Skip answers to earlier commands that timed out.
+                if seq == self.seq:
+                    return status
+        except socket.timeout:
+            return None
+
+    def _receive(self):
+        if not self.stream:
+            return self.socket.recv(64)
+        data = b""
+        while len(data) < LENGTH.size + ACK.size:
+            chunk = self.socket.recv(LENGTH.size + ACK.size - len(data))
+            if not chunk:
+                raise ConnectionError("Daemon closed the connection.")
+            data += chunk
+        return data[LENGTH.size:]
+
+    def motors(self, left, right, robot=0):
+        return self.send(KamigamiByteFormatter.get_sendable_motor_packet(left, right), robot)
+
+    def lights(self, r, g, b, robot=0):
+        return self.send(KamigamiByteFormatter.get_sendable_light_packet(r=r, g=g, b=b), robot)
+
+    def close(self):
+        self.socket.close()
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-n', '--count', type=int, default=1,
+                    help='Number of robots to connect to.  Default 1.')
+parser.add_argument('-t', '--time', type=float, default=10.0,
+                    help='Scan time in seconds.  Default 10.')
+parser.add_argument('--socket', action='store', default=DEFAULT_SOCKET_PATH,
+                    help='Unix socket to listen on, or "" for none.  Default {0}.'.format(DEFAULT_SOCKET_PATH))
+parser.add_argument('--udp', type=int, nargs='?', const=DEFAULT_UDP_PORT, default=0,
+                    help='Also listen on this local UDP port ({0} if none is given).  Any local user can '
+                         'send to it.  Off by default.'.format(DEFAULT_UDP_PORT))
+parser.add_argument('--fake-robots', action='store_true',
+                    help='Drive fake robots instead of real ones.')
+parser.add_argument('--log', action='store', default="INFO",
+                    help='Log levels, e.g. "INFO,control=DEBUG".')
+
+
+def main():
+    args = parser.parse_args()
+    sink = KamigamiLogging.setup(args.log)
+    loop = asyncio.get_event_loop()
+    if args.fake_robots:
+        from KamigamiFakes import FakeSession
+        fleet = Fleet(count=args.count, session_class=FakeSession, cache=MacCache(path=None),
+                      macs=["00:00:00:00:00:{0:02x}".format(i) for i in range(args.count)])
+    else:
+        fleet = Fleet(count=args.count, scan_time=args.time, session_class=KamigamiSession)
+    daemon = KamigamiDaemon(fleet)
+    try:
+        loop.run_until_complete(fleet.start(loop))
+        if args.socket:
+            loop.run_until_complete(daemon.serve_unix(args.socket))
+            log.info("Listening on %s", args.socket)
+        if args.udp:
+            loop.run_until_complete(daemon.serve_udp(port=args.udp))
+            log.info("Listening on UDP port %d", args.udp)
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.close()
+        print("Daemon:", daemon.stats())
+        print("Robots:", fleet.stats())
+        fleet.close()
+        loop.close()
+        sink.stop()
+
+
+if __name__ == "__main__":
+    main()
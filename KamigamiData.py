@@ -1,3 +1,7 @@
+import struct
+from random import choice
+
+
 class KamigamiRobot:
     """
     Class that contains information specific to the Kamigami Robot
@@ -24,8 +28,48 @@ class KamigamiRobot:
 class KamigamiByteFormatter:
     """
     Formats packets for outgoing data to the Kamigami Robot.
+    Every method returns the raw bytes that go over the wire.
     """
 
+    # One pre-built single byte object for every possible byte value.
+    BYTE_TABLE = tuple(bytes((i,)) for i in range(256))
+
+    # Fixed layout packets are packed with precompiled struct formats.
+    MOTOR_STRUCT = struct.Struct('>Bbb')
+    LIGHT_STRUCT = struct.Struct('>BBBB')
+    TESTMODE_STRUCT = struct.Struct('>BBbb')
+    # Assumed layout, not documented by the robot: identifier, then the
+    # IMU, lux and motor settings notifications per second.  Nothing
+    # sends it unless asked to (Fleet(adapt_telemetry=True)).
+    STICKY_STRUCT = struct.Struct('>BBBB')
+
+    SHUTDOWN_PACKET = bytes((KamigamiRobot.Identifiers.SHUTDOWN,))
+
+    # Length in bytes of each kind of frame, by identifier.
+    FRAME_SIZES = {
+        KamigamiRobot.Identifiers.SHUTDOWN: 1,
+        KamigamiRobot.Identifiers.MOTOR_PACKET: 3,
+        KamigamiRobot.Identifiers.LIGHT_PACKET: 4,
+        KamigamiRobot.Identifiers.IR_PACKET: 3,
+        KamigamiRobot.Identifiers.TEST_MODE: 4,
+        KamigamiRobot.Identifiers.UNIFIED_PACKET: 20,
+        KamigamiRobot.Identifiers.STICKY_PACKET_SET: 4,
+    }
+    IR_PACKETS = (
+        bytes((KamigamiRobot.Identifiers.IR_PACKET, 0x08, 0x02)),
+        bytes((KamigamiRobot.Identifiers.IR_PACKET, 0x07, 0x02)),
+        bytes((KamigamiRobot.Identifiers.IR_PACKET, 0x06, 0x02)),
+    )
+
+    COLORS = {
+        "red": (255, 0, 0),
+        "blue": (0, 0, 255),
+        "green": (0, 255, 0),
+        "yellow": (255, 255, 0),
+        "purple": (127, 0, 127),
+        "cyan": (0, 255, 255),
+    }
+
     # Get a motor packet to send to the robot.
     @staticmethod
     def get_sendable_motor_packet(left, right):
@@ -33,12 +77,11 @@ class KamigamiByteFormatter:
             raise ValueError("Please specify a left speed correctly.  Speeds must be between -63 and 63, inclusive.")
         if right >= 64 or right <= -64:
             raise ValueError("Please specify a right speed correctly.  Speeds must be between -63 and 63, inclusive.")
-        return KamigamiByteFormatter.convert_params_to_message([KamigamiRobot.Identifiers.MOTOR_PACKET, left, right])
+        return KamigamiByteFormatter.MOTOR_STRUCT.pack(KamigamiRobot.Identifiers.MOTOR_PACKET, left, right)
 
     # Get a light packet to send to the robot
     @staticmethod
     def get_sendable_light_packet(color=None, r=None, g=None, b=None):
-        print(r,g,b)
         if color is not None and (r is not None or g is not None or b is not None):
             raise ValueError("Choose a color or specifying r, g, b values")
         if r is not None and g is not None and b is not None:
@@ -48,34 +91,30 @@ class KamigamiByteFormatter:
                 raise ValueError("Please specify a green color value correctly.  Color must be between 0 and 255, inclusive.")
             if 0 > b or 255 < b:
                 raise ValueError("Please specify a blue color value correctly.  Color must be between 0 and 255, inclusive.")
-            data_ = KamigamiByteFormatter.convert_params_to_message([KamigamiRobot.Identifiers.LIGHT_PACKET, r, g, b])
-            return data_
-        if color.lower() == "red":
-            # return "02ff0000".decode('hex')
-            return KamigamiByteFormatter.get_sendable_light_packet(r=255, g=0, b=0)
-        elif color.lower() == "blue":
-            # return "020000ff".decode('hex')
-            return KamigamiByteFormatter.get_sendable_light_packet(r=0, g=0, b=255)
-        elif color.lower() == "green":
-            # return "0200ff00".decode('hex')
-            return KamigamiByteFormatter.get_sendable_light_packet(r=0, g=255, b=0)
-        elif color.lower() == "yellow":
-            return KamigamiByteFormatter.get_sendable_light_packet(r=255, g=255, b=0)
-        elif color.lower() == "purple":
-            return KamigamiByteFormatter.get_sendable_light_packet(r=127, g=0, b=127)
-        elif color.lower() == "cyan":
-            return KamigamiByteFormatter.get_sendable_light_packet(r=0, g=255, b=255)
-        else:
+            return KamigamiByteFormatter.LIGHT_STRUCT.pack(KamigamiRobot.Identifiers.LIGHT_PACKET, r, g, b)
+        if color is None or color.lower() not in KamigamiByteFormatter.COLORS:
             raise ValueError("Bad Arguments")
+        r, g, b = KamigamiByteFormatter.COLORS[color.lower()]
+        return KamigamiByteFormatter.get_sendable_light_packet(r=r, g=g, b=b)
+
+    @staticmethod
+    def get_sendable_sticky_packet(imu, lux, motor_settings=0):
+        """
+        Set the notification rates, in notifications per second.
+        """
+        for rate in (imu, lux, motor_settings):
+            if not 0 <= rate <= 255:
+                raise ValueError("Notification rates must be between 0 and 255, inclusive.")
+        return KamigamiByteFormatter.STICKY_STRUCT.pack(
+            KamigamiRobot.Identifiers.STICKY_PACKET_SET, imu, lux, motor_settings)
 
     @staticmethod
     def get_sendable_ir_packet():
-        choice_values = ['\x08\x02', '\x07\x02', '\x06\x02']
-        return KamigamiByteFormatter.convert_to_byte(KamigamiRobot.Identifiers.IR_PACKET) + choice(choice_values)
+        return choice(KamigamiByteFormatter.IR_PACKETS)
 
     @staticmethod
     def get_sendable_shutdown():
-        return KamigamiByteFormatter.convert_to_byte(KamigamiRobot.Identifiers.SHUTDOWN)
+        return KamigamiByteFormatter.SHUTDOWN_PACKET
 
     @staticmethod
     def get_sendable_testmode(speed):
@@ -84,23 +123,20 @@ class KamigamiByteFormatter:
         which will test the lights and motors.
         Motor speed is the parameter.
         """
-        return KamigamiByteFormatter.convert_params_to_message([KamigamiRobot.Identifiers.TEST_MODE, 1, speed, speed])
+        if speed >= 64 or speed <= -64:
+            raise ValueError("Please specify a testmode speed correctly.  Speeds must be between -63 and 63, inclusive.")
+        return KamigamiByteFormatter.TESTMODE_STRUCT.pack(KamigamiRobot.Identifiers.TEST_MODE, 1, speed, speed)
 
     @staticmethod
     def convert_to_byte(value):
         """
         Method used to format integers into
         bytes for the robot to interpret.
+        Negative values are sent as two's complement.
         """
-        # Negative number
-        if str(value)[0] == "-":
-            return hex(256+int(value))[2:].decode('hex')
-        # Single digit hex value (positive)
-        if len(hex(value)) == 3:
-            return ("0"+hex(value)[2:]).decode('hex')
-        else:
-            # Double digit hex value
-            return hex(value)[2:].decode('hex')
+        if value < -128 or value > 255:
+            raise ValueError("Value {0} does not fit in a single byte.".format(value))
+        return KamigamiByteFormatter.BYTE_TABLE[value & 0xFF]
 
     @staticmethod
     def convert_params_to_message(values):
@@ -109,7 +145,11 @@ class KamigamiByteFormatter:
         bytes that the robot can interpret.  Then, join
         the command together.
         """
-        return "".join(map(KamigamiByteFormatter.convert_to_byte, values))
+        table = KamigamiByteFormatter.BYTE_TABLE
+        for value in values:
+            if value < -128 or value > 255:
+                raise ValueError("Value {0} does not fit in a single byte.".format(value))
+        return b"".join([table[value & 0xFF] for value in values])
 
     @staticmethod
     def get_unified_packet(motor_power=None, lights=None):
@@ -119,20 +159,94 @@ class KamigamiByteFormatter:
                      in index 0 and right speed in index 1.
         lights: Three element list or tuple containing r,g,b in positions
                 0, 1, and 2 respectively.
+        For repeated sends keep a UnifiedPacket around instead.
+        """
+        packet = UnifiedPacket()
+        try:
+            if motor_power is not None:
+                packet.set_motors(motor_power[0], motor_power[1])
+            if lights is not None:
+                packet.set_lights(lights[0], lights[1], lights[2])
+        except ValueError as error:
+            raise AttributeError(str(error))
+        return bytes(packet.frame)
+
+
+class UnifiedPacket:
+    """
+    Reusable UNIFIED_PACKET frame.  The 20 bytes are allocated once and
+    updated in place, so a control loop can change a field and hand
+    view() straight to the writer without building a new message.
+    """
+    SIZE = 20
+
+    # Frame layout
+    IDENTIFIER_OFFSET = 0
+    FLAGS_OFFSET = 1
+    MOTOR_OFFSET = 2
+    LIGHT_OFFSET = 6
+
+    # Bits of the flags byte
+    MOTOR_FLAG = 0x01
+    LIGHT_FLAG = 0x04
+
+    MAX_MOTOR_SPEED = 63
+
+    MOTOR_STRUCT = struct.Struct('>BB')
+    LIGHT_STRUCT = struct.Struct('>BBB')
+
+    def __init__(self):
+        self.frame = bytearray(UnifiedPacket.SIZE)
+        self._view = memoryview(self.frame)
+        self.clear()
+
+    def clear(self):
+        """
+        Zero every field and drop all flags.
+        """
+        self.frame[:] = bytes(UnifiedPacket.SIZE)
+        self.frame[UnifiedPacket.IDENTIFIER_OFFSET] = KamigamiRobot.Identifiers.UNIFIED_PACKET
+
+    @property
+    def flags(self):
+        return self.frame[UnifiedPacket.FLAGS_OFFSET]
+
+    def set_flags(self, flags):
+        if not 0 <= flags <= 255:
+            raise ValueError("Flags must fit in a single byte.")
+        self.frame[UnifiedPacket.FLAGS_OFFSET] = flags
+
+    def set_motors(self, left, right):
+        if not (0 <= left <= UnifiedPacket.MAX_MOTOR_SPEED and 0 <= right <= UnifiedPacket.MAX_MOTOR_SPEED):
+            raise ValueError("Motor parameters out of 0 to 63 (inclusive) range.")
+        UnifiedPacket.MOTOR_STRUCT.pack_into(self.frame, UnifiedPacket.MOTOR_OFFSET, left, right)
+        self.frame[UnifiedPacket.FLAGS_OFFSET] |= UnifiedPacket.MOTOR_FLAG
+
+    def clear_motors(self):
+        UnifiedPacket.MOTOR_STRUCT.pack_into(self.frame, UnifiedPacket.MOTOR_OFFSET, 0, 0)
+        self.frame[UnifiedPacket.FLAGS_OFFSET] &= ~UnifiedPacket.MOTOR_FLAG & 0xFF
+
+    def set_lights(self, r, g, b):
+        if not (0 <= r <= 255 and 0 <= g <= 255 and 0 <= b <= 255):
+            raise ValueError("Specified light values are out of range.")
+        UnifiedPacket.LIGHT_STRUCT.pack_into(self.frame, UnifiedPacket.LIGHT_OFFSET, r, g, b)
+        self.frame[UnifiedPacket.FLAGS_OFFSET] |= UnifiedPacket.LIGHT_FLAG
+
+    def clear_lights(self):
+        UnifiedPacket.LIGHT_STRUCT.pack_into(self.frame, UnifiedPacket.LIGHT_OFFSET, 0, 0, 0)
+        self.frame[UnifiedPacket.FLAGS_OFFSET] &= ~UnifiedPacket.LIGHT_FLAG & 0xFF
+
+    @property
+    def motors(self):
+        return UnifiedPacket.MOTOR_STRUCT.unpack_from(self.frame, UnifiedPacket.MOTOR_OFFSET)
+
+    @property
+    def lights(self):
+        return UnifiedPacket.LIGHT_STRUCT.unpack_from(self.frame, UnifiedPacket.LIGHT_OFFSET)
+
+    def view(self):
+        """
+        Zero-copy view of the frame for the writer.  The contents change
+        with the next setter call, so copy it if it has to be kept.
         """
-        cmd = [KamigamiRobot.Identifiers.UNIFIED_PACKET] + [0x0 for i in range(19)] # Set all positions to 0x0
-        if motor_power is not None:
-            if not all(map(lambda speed: 0 <= speed <= 63, motor_power)):
-                raise AttributeError("Motor parameters out of 0 to 63 (inclusive) range.")
-            cmd[1] |= 0x01
-            cmd[2] = motor_power[0]
-            cmd[3] = motor_power[1]
-        if lights is not None:
-            if not all(map(lambda color: 0 <= color <= 255, lights)):
-                raise AttributeError("Specified light values are out of range.")
-            cmd[1] |= 0x04
-            cmd[6] = lights[0]
-            cmd[7] = lights[1]
-            cmd[8] = lights[2]
-
-        return KamigamiByteFormatter.convert_params_to_message(cmd)
+        return self._view
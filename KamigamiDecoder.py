@@ -0,0 +1,275 @@
+import argparse
+import numpy as np
+
+from KamigamiData import KamigamiByteFormatter, KamigamiRobot
+from KamigamiRecorder import BLE_WRITE, HEADER, RECORD
+
+"""
+The inverse of KamigamiByteFormatter, for analysing what was actually
+sent.  decode_frame() checks and parses one frame; decode_stream() and
+decode_log() turn a whole capture into one NumPy structured array per
+packet identifier, without a Python object per frame.  A log's records
+carry their length, so decode_log() only walks the record headers and
+reads every field with vectorized gathers.
+
+Frames carry no length, so a stream of concatenated frames is split by
+identifier.  Every byte offset gets "where would the next frame start if
+one started here"; the frame starts are then the chain of those jumps
+from offset 0, found by pointer doubling (log2(n) vectorized passes)
+rather than walking the frames one at a time.  An offset holding an
+unknown identifier, or a frame cut off by the end of the buffer, is
+malformed: decoding resumes at the next byte and the offsets are
+reported as malformed runs.
+"""
+
+Identifiers = KamigamiRobot.Identifiers
+
+# Fields of each kind of frame: (name, byte offset in the frame, dtype).
+FIELDS = {
+    Identifiers.SHUTDOWN: [],
+    Identifiers.MOTOR_PACKET: [('left', 1, 'i1'), ('right', 2, 'i1')],
+    Identifiers.LIGHT_PACKET: [('r', 1, 'u1'), ('g', 2, 'u1'), ('b', 3, 'u1')],
+    Identifiers.IR_PACKET: [('code', 1, 'u1'), ('argument', 2, 'u1')],
+    Identifiers.TEST_MODE: [('mode', 1, 'u1'), ('left', 2, 'i1'), ('right', 3, 'i1')],
+    Identifiers.UNIFIED_PACKET: [('flags', 1, 'u1'), ('left', 2, 'u1'), ('right', 3, 'u1'),
+                                 ('r', 6, 'u1'), ('g', 7, 'u1'), ('b', 8, 'u1')],
+    Identifiers.STICKY_PACKET_SET: [('imu', 1, 'u1'), ('lux', 2, 'u1'), ('motor_settings', 3, 'u1')],
+}
+
+NAMES = {
+    Identifiers.SHUTDOWN: "shutdown",
+    Identifiers.MOTOR_PACKET: "motor",
+    Identifiers.LIGHT_PACKET: "light",
+    Identifiers.IR_PACKET: "ir",
+    Identifiers.TEST_MODE: "testmode",
+    Identifiers.UNIFIED_PACKET: "unified",
+    Identifiers.STICKY_PACKET_SET: "sticky",
+}
+
+# A log record header (KamigamiRecorder.RECORD) as a NumPy dtype.
+_RECORD = np.dtype([('kind', 'u1'), ('channel', '<u2'), ('seconds', '<f8'), ('length', '<u4')])
+
+# Frame size by identifier byte, 0 for identifiers that are not frames.
+_SIZES = np.zeros(256, dtype=np.int64)
+for _identifier, _size in KamigamiByteFormatter.FRAME_SIZES.items():
+    _SIZES[_identifier] = _size
+
+
+def decode_frame(frame):
+    """
+    Parse one frame.  Returns (identifier, {field: value}); raises
+    ValueError if it is not a well formed frame.
+    """
+    frame = bytes(frame)
+    if not frame:
+        raise ValueError("Empty frame.")
+    identifier = frame[0]
+    size = KamigamiByteFormatter.FRAME_SIZES.get(identifier)
+    if size is None:
+        raise ValueError("Unknown identifier {0}.".format(identifier))
+    if len(frame) != size:
+        raise ValueError("{0} frame is {1} bytes, expected {2}.".format(NAMES[identifier], len(frame), size))
+    values = np.frombuffer(frame, dtype=np.uint8)
+    return identifier, dict((name, values[offset:offset + 1].view(dtype)[0].item())
+                            for name, offset, dtype in FIELDS[identifier])
+
+
+def _chain(jumps, start):
+    """
+    Boolean mask of the offsets visited following jumps from start.
+    jumps has a final sentinel entry that jumps to itself; it is not part
+    of the result.
+    """
+    visited = np.zeros(len(jumps), dtype=bool)
+    visited[start] = True
+    steps = 1
+    while steps < len(jumps):
+        # visited holds every offset within `steps` jumps of start, and
+        # jumps[i] is `steps` jumps on from i.
+        visited[jumps[visited]] = True
+        jumps = jumps[jumps]
+        steps *= 2
+    visited[-1] = False
+    return visited
+
+
+def _runs(offsets):
+    """
+    (offset, length) of each run of consecutive offsets.
+    """
+    if not len(offsets):
+        return np.zeros((0, 2), dtype=np.int64)
+    breaks = np.flatnonzero(np.diff(offsets) != 1) + 1
+    starts = np.concatenate(([0], breaks))
+    ends = np.concatenate((breaks, [len(offsets)]))
+    return np.stack((offsets[starts], ends - starts), axis=1)
+
+
+def _tables(data, starts, extra=None):
+    """
+    One structured array per identifier for the frames at starts.
+    extra: optional [(name, dtype, values aligned with starts)].
+    """
+    identifiers = data[starts]
+    tables = {}
+    for identifier, fields in FIELDS.items():
+        chosen = identifiers == identifier
+        if not chosen.any():
+            continue
+        offsets = starts[chosen]
+        dtype = [('offset', '<i8')] + [(name, kind) for name, kind, values in (extra or [])]
+        dtype += [(name, field_dtype) for name, _, field_dtype in fields]
+        table = np.zeros(len(offsets), dtype=dtype)
+        table['offset'] = offsets
+        for name, kind, values in (extra or []):
+            table[name] = values[chosen]
+        for name, offset, field_dtype in fields:
+            table[name] = data[offsets + offset].view(field_dtype)
+        tables[identifier] = table
+    return tables
+
+
+class DecodedFrames:
+    """
+    frames: {identifier: structured array}, one row per frame in capture
+            order, with the byte offset of every frame.
+    malformed: (offset, length) rows, one per run of bytes that were not
+               a frame.
+    """
+    def __init__(self, frames, malformed):
+        self.frames = frames
+        self.malformed = malformed
+
+    def __getitem__(self, identifier):
+        return self.frames[identifier]
+
+    def counts(self):
+        return dict((NAMES[identifier], len(table)) for identifier, table in self.frames.items())
+
+
+def decode_stream(buffer):
+    """
+    Decode a buffer of concatenated frames.
+    """
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    size = len(data)
+    if not size:
+        return DecodedFrames({}, _runs(np.zeros(0, dtype=np.int64)))
+    offsets = np.arange(size, dtype=np.int64)
+    ends = offsets + _SIZES[data]
+    malformed = (_SIZES[data] == 0) | (ends > size)
+    # Malformed bytes are skipped one at a time; offset size is the end.
+    jumps = np.append(np.where(malformed, offsets + 1, ends), size)
+    starts = np.flatnonzero(_chain(jumps, 0))
+    bad = malformed[starts]
+    return DecodedFrames(_tables(data, starts[~bad]), _runs(starts[bad]))
+
+
+def _gather(data, offsets, dtype):
+    """
+    The dtype value stored at each of offsets in data, gathered one byte
+    column at a time so the only index arrays are one per record.
+    """
+    values = np.empty(len(offsets), dtype=dtype)
+    columns = values.view(np.uint8).reshape(len(offsets), values.itemsize)
+    for column in range(values.itemsize):
+        columns[:, column] = data[offsets + column]
+    return values
+
+
+def decode_log(log):
+    """
+    Decode the BLE writes of a KamigamiLog.  Rows also carry the write's
+    seconds since the start of the log ('t') and its channel (the robot's
+    index in the fleet).  Writes that are not exactly one frame are
+    reported as malformed, with the offset of the record in the file.
+    """
+    starts = np.fromiter(log.record_offsets(), dtype=np.int64)
+    data = np.frombuffer(log.buffer, dtype=np.uint8)
+    records = starts[data[starts] == BLE_WRITE]
+    del starts
+    lengths = _gather(data, records + _RECORD.fields['length'][1], '<u4')
+    payloads = records + RECORD.size
+    identifiers = data[np.minimum(payloads, len(data) - 1)]
+    well_formed = (lengths > 0) & (_SIZES[identifiers] == lengths)
+    malformed = np.stack((records[~well_formed], lengths[~well_formed].astype(np.int64)), axis=1)
+    good, payloads = records[well_formed], payloads[well_formed]
+    del records, lengths, identifiers
+    tables = _tables(data, payloads,
+                     extra=[('t', '<f8', _gather(data, good + _RECORD.fields['seconds'][1], '<f8')),
+                            ('channel', '<u2', _gather(data, good + _RECORD.fields['channel'][1], '<u2'))])
+    # Everything returned is a copy, so the log can still be closed.
+    del data
+    return DecodedFrames(tables, malformed)
+
+
+def command_rate(table, bucket=1.0):
+    """
+    Frames per second of a decode_log table, in buckets of bucket seconds.
+    Returns (bucket start times, rates).
+    """
+    if not len(table):
+        return np.zeros(0), np.zeros(0)
+    edges = np.arange(0.0, table['t'].max() + bucket, bucket)
+    counts, edges = np.histogram(table['t'], bins=edges)
+    return edges[:-1], counts / bucket
+
+
+def repeats(table):
+    """
+    Mask of the frames that are the same as the previous frame of their
+    kind (on the same channel, for decode_log tables).
+    """
+    fields = [name for name in table.dtype.names if name not in ('offset', 't')]
+    if not len(table):
+        return np.zeros(0, dtype=bool)
+    if 'channel' in fields:
+        order = np.argsort(table['channel'], kind='stable')
+    else:
+        order = np.arange(len(table))
+    same = np.zeros(len(table), dtype=bool)
+    if not fields:
+        same[order[1:]] = True
+        return same
+    ordered = table[order][fields]
+    same[order[1:]] = ordered[1:] == ordered[:-1]
+    return same
+
+
+def summary(decoded):
+    lines = []
+    for identifier, table in sorted(decoded.frames.items()):
+        line = "{0:<9} {1:>8} frames, {2:>8} repeats".format(
+            NAMES[identifier], len(table), int(repeats(table).sum()))
+        if identifier == Identifiers.MOTOR_PACKET:
+            line += ", left {0:.1f}+/-{1:.1f} right {2:.1f}+/-{3:.1f}".format(
+                table['left'].mean(), table['left'].std(), table['right'].mean(), table['right'].std())
+        if 't' in table.dtype.names:
+            times, rates = command_rate(table)
+            if len(rates):
+                line += ", peak {0:.0f}/s".format(rates.max())
+        lines.append(line)
+    for offset, length in decoded.malformed[:20]:
+        lines.append("malformed at offset {0}, {1} bytes".format(offset, length))
+    if len(decoded.malformed) > 20:
+        lines.append("... {0} malformed runs in all".format(len(decoded.malformed)))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Summarize the frames of a capture.')
+    parser.add_argument('path', help='A KamigamiRecorder log, or raw concatenated frames with --raw.')
+    parser.add_argument('--raw', action='store_true', help='The file is raw concatenated frames.')
+    args = parser.parse_args()
+    if args.raw:
+        with open(args.path, "rb") as capture:
+            decoded = decode_stream(capture.read())
+    else:
+        from KamigamiRecorder import KamigamiLog
+        log = KamigamiLog(args.path)
+        decoded = decode_log(log)
+    print(summary(decoded))
+
+
+if __name__ == "__main__":
+    main()
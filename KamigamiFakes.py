@@ -0,0 +1,281 @@
+import asyncio
+import json
+import random
+import threading
+import time
+import websockets
+
+from urllib.parse import parse_qsl
+
+from beam_interactive import proto
+
+from KamigamiData import KamigamiRobot
+from KamigamiScanner import MacCache
+from KamigamiSession import KamigamiSession
+
+"""
+Stand-ins for the radio and the network, for benchmarks and load tests.
+FakePeripheral/FakeCharacteristic mimic the parts of bluepy this code
+uses and record every write; FakeInteractiveConnection mimics a
+beam_interactive connection that emits synthetic report packets.
+FakeBeamApi and serve_fake_interactive stand in for the Beam REST API
+and the Interactive websocket on localhost, for testing KamigamiBeam.
+"""
+
+
+class FakeCharacteristic:
+    """
+    Records writes as (monotonic time, bytes).  latency seconds are spent
+    in every write with a response, as a GATT round trip would.
+    """
+    def __init__(self, uuid, handle, latency=0.0):
+        self.uuid = uuid
+        self.handle = handle
+        self.latency = latency
+        self.writes = []
+        self._lock = threading.Lock()
+
+    def write(self, val, withResponse=False):
+        if withResponse and self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.writes.append((time.monotonic(), bytes(val)))
+
+    def getHandle(self):
+        return self.handle
+
+    def getDescriptors(self, forUUID=None, hndEnd=0xFFFF):
+        return [FakeDescriptor(self.handle + 1)]
+
+
+class FakeDescriptor:
+    def __init__(self, handle):
+        self.handle = handle
+
+
+class FakeService:
+    def __init__(self, characteristics):
+        self.characteristics = characteristics
+
+    def getCharacteristics(self, forUUID=None):
+        return [c for c in self.characteristics if forUUID is None or c.uuid == forUUID]
+
+
+class FakePeripheral:
+    """
+    Peripheral with the Kamigami service: a write characteristic and a
+    notify characteristic.
+    """
+    def __init__(self, deviceAddr=None, addrType=None, iface=None, latency=0.0):
+        self.addr = deviceAddr
+        self.writer = FakeCharacteristic(KamigamiRobot.WRITE_UUID, 0x0E, latency)
+        self.notifier = FakeCharacteristic(KamigamiRobot.NOTIFY_UUID, 0x10, latency)
+        self.service = FakeService([self.writer, self.notifier])
+        self.delegate = None
+        self.handle_writes = []
+        self.connected = True
+
+    def getServiceByUUID(self, uuidVal):
+        return self.service
+
+    def withDelegate(self, delegate):
+        self.delegate = delegate
+        return self
+
+    def writeCharacteristic(self, handle, val, withResponse=False):
+        self.handle_writes.append((handle, bytes(val)))
+
+    def waitForNotifications(self, timeout):
+        return False
+
+    def disconnect(self):
+        self.connected = False
+
+
+class FakeSession(KamigamiSession):
+    """
+    KamigamiSession that connects to a FakePeripheral.  Its address is
+    only remembered in memory unless a cache is given.
+    """
+    def __init__(self, mac="00:00:00:00:00:00", latency=0.0, cache=None, **kwargs):
+        KamigamiSession.__init__(self, mac=mac, cache=cache if cache is not None else MacCache(path=None), **kwargs)
+        self.latency = latency
+
+    def _connect_to(self, mac, use_cached_handles=True):
+        self.peripheral = FakePeripheral(mac, latency=self.latency)
+        self.writer = self.peripheral.writer
+        self.mac = mac
+        self.cache.remember(mac, write_handle=self.writer.getHandle(), notify_handle=None, cccd_handle=None)
+        return self
+
+
+def make_report(joysticks=1, tactiles=0, rng=random, time_ms=0):
+    """
+    A proto.Report with random joystick positions and button presses.
+    """
+    report = proto.Report()
+    report.time = time_ms
+    report.users.connected = report.users.quorum = report.users.active = joysticks
+    for control_id in range(joysticks):
+        joystick = report.joystick.add()
+        joystick.id = control_id
+        joystick.coordMean.x = rng.uniform(-1.0, 1.0)
+        joystick.coordMean.y = rng.uniform(-1.0, 1.0)
+    for control_id in range(tactiles):
+        tactile = report.tactile.add()
+        tactile.id = control_id
+        tactile.pressFrequency = rng.randint(0, 3)
+    return report
+
+
+class FakeInteractiveConnection:
+    """
+    Emits `count` report packets, rate_hz per second (or as fast as they
+    are read when rate_hz is None), then reports a disconnect.
+    Packets come out of get_packet() as (decoded, raw bytes) like the
+    real connection's.
+    """
+    def __init__(self, count, rate_hz=None, joysticks=1, tactiles=0, seed=0):
+        rng = random.Random(seed)
+        self.packets = []
+        for index in range(count):
+            report = make_report(joysticks, tactiles, rng, time_ms=index)
+            self.packets.append((report, proto.encode(report)))
+        self.interval = 1.0 / rate_hz if rate_hz else 0.0
+        self._index = 0
+        self._next = None
+        self.closed = False
+
+    @asyncio.coroutine
+    def wait_message(self):
+        if self.closed or self._index >= len(self.packets):
+            return False
+        if self.interval:
+            now = time.monotonic()
+            if self._next is None:
+                self._next = now
+            if self._next > now:
+                yield from asyncio.sleep(self._next - now)
+            self._next += self.interval
+        else:
+            # Still give other tasks a turn, as a real socket read would.
+            yield from asyncio.sleep(0)
+        return True
+
+    def get_packet(self):
+        packet = self.packets[self._index]
+        self._index += 1
+        return packet
+
+    def close(self):
+        self.closed = True
+
+
+class FakeBeamApi:
+    """
+    The Beam REST API endpoints KamigamiBeam uses, over plain HTTP.
+    Logging in as username/password sets a session cookie; joining
+    Interactive needs it and answers with address and key.  requests
+    counts the requests to each path; refuse_session makes the next
+    join refuse the session, as an expired one would be.
+    """
+    def __init__(self, username="robot", password="secret", channel=1234, address="ws://127.0.0.1:9107",
+                 key="stream-key"):
+        self.username = username
+        self.password = password
+        self.channel = channel
+        self.address = address
+        self.key = key
+        self.sessions = set()
+        self.requests = {}
+        self.refuse_session = False
+        self.server = None
+
+    @property
+    def url(self):
+        host, port = self.server.sockets[0].getsockname()[:2]
+        return "http://{0}:{1}/api/v1/".format(host, port)
+
+    def answer(self, method, path, cookie, form):
+        """
+        (status, extra headers, JSON body) for one request.
+        """
+        self.requests[path] = self.requests.get(path, 0) + 1
+        if method == "POST" and path == "/api/v1/users/login":
+            if form.get("username") != self.username or form.get("password") != self.password:
+                return 401, [], {"message": "Invalid username or password."}
+            session = "s{0}".format(len(self.sessions) + 1)
+            self.sessions.add(session)
+            return 200, [("Set-Cookie", "sid={0}; Path=/; HttpOnly".format(session))], \
+                {"username": self.username, "channel": {"id": self.channel}}
+        if method == "GET" and path == "/api/v1/interactive/{0}/robot".format(self.channel):
+            if self.refuse_session:
+                self.refuse_session = False
+                self.sessions.clear()
+            if cookie.get("sid") not in self.sessions:
+                return 403, [], {"message": "Not logged in."}
+            return 200, [], {"address": self.address, "key": self.key}
+        return 404, [], {"message": "Not found."}
+
+    @asyncio.coroutine
+    def _handle(self, reader, writer):
+        try:
+            method, path, _ = (yield from reader.readline()).decode("latin-1").split(" ", 2)
+            headers = {}
+            while True:
+                line = (yield from reader.readline()).decode("latin-1")
+                if line in ("\r\n", ""):
+                    break
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+            body = yield from reader.readexactly(int(headers.get("content-length", 0)))
+            form = dict(parse_qsl(body.decode("utf-8")))
+            cookie = dict(pair.strip().split("=", 1) for pair in headers.get("cookie", "").split(";") if "=" in pair)
+            status, extra, answer = self.answer(method, path, cookie, form)
+            body = json.dumps(answer).encode("utf-8")
+            writer.write("HTTP/1.1 {0} X\r\n".format(status).encode("latin-1") +
+                         "".join("{0}: {1}\r\n".format(name, value) for name, value in extra).encode("latin-1") +
+                         b"Content-Type: application/json\r\n"
+                         b"Content-Length: " + str(len(body)).encode("ascii") + b"\r\n\r\n" + body)
+            yield from writer.drain()
+        finally:
+            writer.close()
+
+    @asyncio.coroutine
+    def serve(self, host="127.0.0.1", port=0):
+        self.server = yield from asyncio.start_server(self._handle, host, port)
+        return self.server
+
+
+@asyncio.coroutine
+def serve_fake_interactive(key="stream-key", count=10, rate_hz=None, host="127.0.0.1", port=0):
+    """
+    A websocket server that acts as Interactive: it checks the handshake's
+    stream key, then sends `count` reports (as FakeInteractiveConnection
+    makes them) and closes, so every client sees a disconnect.  A wrong
+    key gets an Error packet and a close.  The server's handshakes
+    attribute counts handshakes by accepted (True) or refused.
+    """
+    handshakes = {True: 0, False: 0}
+
+    @asyncio.coroutine
+    def handle(websocket, path=None):
+        handshake = proto.decode((yield from websocket.recv()))
+        accepted = isinstance(handshake, proto.Handshake) and handshake.streamKey == key
+        handshakes[accepted] += 1
+        if not accepted:
+            error = proto.Error()
+            error.message = "Invalid stream key."
+            yield from websocket.send(proto.encode(error))
+            yield from websocket.close()
+            return
+        yield from websocket.send(proto.encode(proto.HandshakeACK()))
+        reports = FakeInteractiveConnection(count, rate_hz=rate_hz)
+        while (yield from reports.wait_message()):
+            report, raw = reports.get_packet()
+            yield from websocket.send(raw)
+        yield from websocket.close()
+
+    server = yield from websockets.serve(handle, host, port)
+    server.handshakes = handshakes
+    return server
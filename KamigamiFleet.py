@@ -0,0 +1,251 @@
+import asyncio
+
+from KamigamiData import KamigamiByteFormatter
+from KamigamiController import KamigamiController
+from KamigamiLinkRates import CommandRateController, TelemetryRateController
+from KamigamiLogging import logger
+from KamigamiMailbox import CommandMailbox, MailboxWriter
+from KamigamiMerger import UnifiedTickMerger
+from KamigamiScanner import MacCache, find_robots
+from KamigamiSession import KamigamiSession
+from KamigamiTelemetry import KamigamiTelemetry, poll_notifications
+from KamigamiTransport import AsyncBleTransport, NonBlockingWriter
+
+"""
+Several robots under control at once.  Every robot gets its own session,
+BLE transport (and so its own radio thread), motor/light merger (or motor
+mailbox) and controller,
+so a slow robot only holds up writes to itself.  Connecting and broadcast
+writes run in parallel across robots.
+"""
+
+log = logger("session")
+
+
+class FleetRobot:
+    """
+    Write path to one connected robot of a Fleet.  With merge, motor and
+    light settings go out through a UnifiedTickMerger, at most one frame
+    per tick; otherwise motor packets go through a CommandMailbox.
+    """
+    def __init__(self, session, loop, write_rate=40, telemetry=None, metrics=None,
+                 recorder=None, channel=0, merge=True, keepalive=1.0, adapt_telemetry=False,
+                 adapt_rate=True, min_rate=5.0):
+        self.session = session
+        self.transport = AsyncBleTransport(session.writer, loop=loop, metrics=metrics,
+                                           recorder=recorder, channel=channel,
+                                           session=session).start()
+        self.mailbox = None
+        self.merger = None
+        if merge:
+            self.merger = UnifiedTickMerger(self.transport, rate_hz=write_rate, keepalive=keepalive,
+                                            metrics=metrics)
+            self.motor_writer = self.merger
+            self.controller = KamigamiController(NonBlockingWriter(self.transport), metrics=metrics,
+                                                 merger=self.merger)
+        else:
+            self.mailbox = CommandMailbox(max_age=0.25, metrics=metrics)
+            self.motor_writer = MailboxWriter(self.mailbox, self.transport, rate_hz=write_rate)
+            self.controller = KamigamiController(NonBlockingWriter(self.transport), motor_writer=self.mailbox,
+                                                 metrics=metrics)
+        self.motor_writer.start()
+        self.command_rate = None
+        self._command_rate_task = None
+        if adapt_rate:
+            self.command_rate = CommandRateController(self.motor_writer, self.transport, min_rate=min_rate,
+                                                      max_rate=write_rate, metrics=metrics)
+            self._command_rate_task = loop.create_task(self.command_rate.run())
+        self.telemetry = telemetry
+        self._poller = None
+        self.rates = None
+        self._rate_task = None
+        if telemetry is not None:
+            self._poller = loop.create_task(poll_notifications(telemetry, self.transport))
+            if adapt_telemetry:
+                self.rates = TelemetryRateController(self.transport, telemetry)
+                self._rate_task = loop.create_task(self.rates.run())
+
+    @property
+    def mac(self):
+        return self.session.mac
+
+    def close(self):
+        if self._poller is not None:
+            self._poller.cancel()
+        if self._rate_task is not None:
+            self._rate_task.cancel()
+        if self._command_rate_task is not None:
+            self._command_rate_task.cancel()
+        self.motor_writer.stop()
+        self.transport.close()
+        self.session.disconnect()
+
+    def stats(self):
+        stats = {"transport": self.transport.stats()}
+        if self.merger is not None:
+            stats["merger"] = self.merger.stats()
+        else:
+            stats["motors"] = self.mailbox.stats()
+        if self.telemetry is not None:
+            stats["telemetry"] = self.telemetry.stats()
+        if self.rates is not None:
+            stats["telemetry_rates"] = self.rates.stats()
+        if self.command_rate is not None:
+            stats["command_rate"] = self.command_rate.stats()
+        return stats
+
+
+class Fleet:
+    """
+    count: number of robots to control.
+    macs: addresses to use first; the rest come from the MacCache and
+          then from scanning.  Robots that fail to connect are replaced
+          by scanning again.
+    iface: number of the HCI adapter to scan and connect with.
+    write_rate: motor commands (or merged frames) per second for each robot.
+    merge: send motor and light settings as merged UNIFIED_PACKET frames.
+    adapt_telemetry: lower the telemetry rates while a robot's link is
+                     congested (see KamigamiLinkRates).  Off by default:
+                     it writes STICKY_PACKET_SET frames, whose layout is
+                     assumed rather than confirmed.
+    adapt_rate: back each robot's write_rate off, down to min_rate, while
+                its writes are slow or failing.
+    telemetry: record each robot's notifications into a KamigamiTelemetry.
+    metrics: optional Metrics shared by every robot's write path.
+    recorder: optional KamigamiRecorder logging every robot's writes, with
+              the robot's index as the channel.
+    session_class: what to connect with, e.g. KamigamiFakes.FakeSession.
+    """
+    def __init__(self, count=1, macs=None, scan_time=10.0, write_rate=40, cache=None,
+                 telemetry=False, metrics=None, recorder=None, session_class=KamigamiSession,
+                 merge=True, adapt_telemetry=False, adapt_rate=True, min_rate=5.0, iface=0):
+        self.count = count
+        self.macs = list(macs) if macs else []
+        self.scan_time = scan_time
+        self.iface = iface
+        self.write_rate = write_rate
+        self.cache = cache if cache is not None else MacCache()
+        self.telemetry = telemetry
+        self.metrics = metrics
+        self.recorder = recorder
+        self.session_class = session_class
+        self.merge = merge
+        self.adapt_telemetry = adapt_telemetry
+        self.adapt_rate = adapt_rate
+        self.min_rate = min_rate
+        self.robots = []
+        self.routes = {}
+
+    def discover(self):
+        """
+        Pick the addresses to connect to.  Blocking.
+        """
+        macs = list(self.macs)
+        for mac in self.cache.fresh():
+            if len(macs) >= self.count:
+                break
+            if mac not in macs:
+                macs.append(mac)
+        if len(macs) < self.count:
+            macs += self.rescan(macs, self.count - len(macs))
+        return macs
+
+    def rescan(self, exclude, count):
+        """
+        Scan for up to count robots other than those in exclude.  Blocking.
+        """
+        macs = []
+        for mac, rssi in find_robots(count + len(exclude), self.scan_time, self.iface):
+            if mac not in exclude and len(macs) < count:
+                macs.append(mac)
+                self.cache.remember(mac, rssi)
+        return macs
+
+    @asyncio.coroutine
+    def start(self, loop=None):
+        """
+        Discover robots and connect to all of them concurrently.  Robots
+        that fail to connect are logged and left out, and one more scan
+        looks for others to take their place.
+        """
+        loop = loop if loop is not None else asyncio.get_event_loop()
+        macs = yield from loop.run_in_executor(None, self.discover)
+        yield from self._connect_all(loop, macs)
+        missing = self.count - len(self.robots)
+        if missing > 0 and self.scan_time > 0:
+            log.info("%d robot(s) short, scanning for others.", missing)
+            macs = yield from loop.run_in_executor(None, self.rescan, macs, missing)
+            yield from self._connect_all(loop, macs)
+        if not self.robots:
+            raise EnvironmentError("No Kamigami Robots could be connected.")
+        if len(self.robots) < self.count:
+            log.warning("Only %d of %d robots connected.", len(self.robots), self.count)
+        return self
+
+    @asyncio.coroutine
+    def _connect_all(self, loop, macs):
+        sessions = [self.session_class(mac=mac, cache=self.cache, iface=self.iface) for mac in macs]
+        results = yield from asyncio.gather(
+            *[loop.run_in_executor(None, self._connect, session) for session in sessions],
+            return_exceptions=True)
+        for session, result in zip(sessions, results):
+            if isinstance(result, Exception):
+                log.warning("Could not connect to %s: %s", session.mac, result)
+                self.cache.forget(session.mac)
+            else:
+                self.robots.append(FleetRobot(session, loop, self.write_rate, telemetry=result,
+                                              metrics=self.metrics, recorder=self.recorder,
+                                              channel=len(self.robots), merge=self.merge,
+                                              adapt_telemetry=self.adapt_telemetry,
+                                              adapt_rate=self.adapt_rate, min_rate=self.min_rate))
+
+    def _connect(self, session):
+        session.connect()
+        if self.telemetry:
+            return KamigamiTelemetry().attach(session)
+        return None
+
+    def assign(self, control_id, robot_index):
+        """
+        Route an Interactive control (joystick or button id) to a robot.
+        """
+        self.routes[control_id] = robot_index
+
+    def robot_index_for(self, control_id):
+        """
+        Index of the robot a control drives.  Unassigned controls are
+        spread over the robots by id.
+        """
+        return self.routes.get(control_id, control_id) % len(self.robots)
+
+    def robot_for(self, control_id):
+        return self.robots[self.robot_index_for(control_id)]
+
+    def broadcast(self, frame):
+        """
+        Queue the same frame on every robot.  Each robot writes on its own
+        radio thread, so the writes go out in parallel.
+        """
+        return [robot.controller.writer.write_value(frame) for robot in self.robots]
+
+    @asyncio.coroutine
+    def broadcast_and_wait(self, frame):
+        results = yield from asyncio.gather(
+            *[robot.transport.write(frame) for robot in self.robots],
+            return_exceptions=True)
+        return results
+
+    def broadcast_lights(self, r, g, b):
+        # Through each controller, so a merger knows the lights changed.
+        return [robot.controller.set_lights(r, g, b) for robot in self.robots]
+
+    def broadcast_shutdown(self):
+        return self.broadcast(KamigamiByteFormatter.get_sendable_shutdown())
+
+    def close(self):
+        for robot in self.robots:
+            robot.close()
+        self.robots = []
+
+    def stats(self):
+        return dict((robot.mac, robot.stats()) for robot in self.robots)
@@ -4,9 +4,8 @@ import time
 """
 Edit this file to specify actions.  This interface file allows you to 
 read and write values to the robot without changing KamigamiConnection.
-Note that the read_manager argument is currently in place only to make 
-the interface completely compatible with both mac and linux.  It is currently
-unimplemented for linux and will be passed as None.
+On linux the read_manager is a KamigamiTelemetry: call read_manager.poll()
+to take in notifications, then read read_manager.imu / read_manager.lux.
 """
 
 class KamigamiInterface:
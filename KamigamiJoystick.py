@@ -0,0 +1,73 @@
+import numpy as np
+
+"""
+Turns all the joysticks of an Interactive report into one motor command
+per robot.  The coordinates are pulled into arrays once and everything
+after that (NaN filtering, combining, deadzone, scaling) is vectorized.
+"""
+
+MAX_SPEED = 63
+
+
+class JoystickAggregator:
+    """
+    policy: how joysticks driving the same robot are combined; "mean",
+            "weighted" (by the per-control weights) or "median".
+    deadzone: input magnitude (on the -1..1 joystick scale) treated as 0.
+    scale: motor speed for a full joystick deflection, clipped to +-63.
+    weights: control id -> weight, for the "weighted" policy.
+    """
+    POLICIES = ("mean", "weighted", "median")
+
+    def __init__(self, policy="mean", deadzone=0.1, scale=MAX_SPEED, weights=None):
+        if policy not in JoystickAggregator.POLICIES:
+            raise ValueError("Unknown joystick policy: {0}".format(policy))
+        self.policy = policy
+        self.deadzone = deadzone
+        self.scale = scale
+        self.weights = weights if weights is not None else {}
+
+    def commands(self, joysticks, route=None, robot_count=1):
+        """
+        joysticks: the report's joystick entries.
+        route: control id -> robot index, or None to drive robot 0.
+        Returns a list of (robot index, left, right), one per robot that
+        had at least one joystick with a valid position.
+        """
+        count = len(joysticks)
+        if not count:
+            return []
+        xs = np.fromiter((joystick.coordMean.x for joystick in joysticks), float, count)
+        ys = np.fromiter((joystick.coordMean.y for joystick in joysticks), float, count)
+        if route is not None or self.policy == "weighted":
+            ids = [joystick.id for joystick in joysticks]
+        valid = ~(np.isnan(xs) | np.isnan(ys))
+        if not valid.any():
+            return []
+        if route is None:
+            robots = np.zeros(count, dtype=np.intp)
+        else:
+            robots = np.fromiter((route(control_id) for control_id in ids), np.intp, count)
+        if self.policy == "weighted":
+            weights = np.fromiter((self.weights.get(control_id, 1.0) for control_id in ids), float, count)
+        else:
+            weights = np.ones(count)
+
+        xs, ys, robots, weights = xs[valid], ys[valid], robots[valid], weights[valid]
+        if self.policy == "median":
+            present = np.unique(robots)
+            x = np.array([np.median(xs[robots == robot]) for robot in present])
+            y = np.array([np.median(ys[robots == robot]) for robot in present])
+        else:
+            totals = np.bincount(robots, weights=weights, minlength=robot_count)
+            present = np.flatnonzero(totals)
+            x = np.bincount(robots, weights=xs * weights, minlength=robot_count)[present] / totals[present]
+            y = np.bincount(robots, weights=ys * weights, minlength=robot_count)[present] / totals[present]
+
+        # Radial deadzone, then scale onto the motor range.
+        still = np.hypot(x, y) < self.deadzone
+        x[still] = 0.0
+        y[still] = 0.0
+        left = np.clip(np.rint(x * self.scale), -MAX_SPEED, MAX_SPEED).astype(int)
+        right = np.clip(np.rint(y * self.scale), -MAX_SPEED, MAX_SPEED).astype(int)
+        return list(zip(present.tolist(), left.tolist(), right.tolist()))
@@ -0,0 +1,228 @@
+import asyncio
+
+from KamigamiData import KamigamiByteFormatter, KamigamiRobot
+from KamigamiLogging import logger
+
+"""
+Telemetry rates that give way to control traffic.  Notifications share
+the radio with motor commands; on a congested channel (an arena full of
+robots) a full rate IMU stream can starve the commands.  A
+TelemetryRateController watches one robot's transport and steps the
+notification rates, set with a STICKY_PACKET_SET frame, down a ladder of
+levels while writes are slower than usual for the link or queued up,
+and back up while the link is idle.
+
+The command rate adapts the same way: a CommandRateController backs a
+robot's tick rate off multiplicatively when writes slow down or fail and
+raises it additively while they keep up, so a degrading link sheds
+commands (the newest state always wins) instead of queueing them.
+"""
+
+log = logger("telemetry")
+
+# Fractions of the KamigamiRobot.Settings rates, best first.
+LEVELS = (1.0, 0.5, 0.25, 0.1, 0.0)
+
+
+class TelemetryRateController:
+    """
+    Write times are judged against the link's own baseline, the fastest
+    write average seen (drifting slowly up, so a longer connection
+    interval is learnt): a write with response takes at least one BLE
+    connection interval, which differs from link to link.
+
+    transport: the robot's AsyncBleTransport.
+    telemetry: optional KamigamiTelemetry whose poll interval follows the
+               rates.
+    busy_ratio, busy_depth: a write average above busy_ratio times the
+                            baseline, or more than busy_depth frames
+                            queued, is congestion; telemetry steps down
+                            at once.
+    idle_ratio: at most this times the baseline (or with no writes at
+                all) the link is idle; after idle_checks idle checks in a
+                row telemetry steps up a level.
+    interval: seconds between checks.
+    """
+    # Fraction of the way the baseline moves up towards a slower write
+    # average at each check.
+    BASELINE_DRIFT = 0.02
+
+    def __init__(self, transport, telemetry=None, levels=LEVELS, busy_ratio=1.5, busy_depth=4,
+                 idle_ratio=1.2, idle_checks=5, interval=1.0):
+        self.transport = transport
+        self.telemetry = telemetry
+        self.levels = levels
+        self.busy_ratio = busy_ratio
+        self.busy_depth = busy_depth
+        self.idle_ratio = idle_ratio
+        self.idle_checks = idle_checks
+        self.interval = interval
+        self.level = 0
+        self.rates = None
+        self.baseline = None
+        self._idle = 0
+        self._written = 0
+        self.changes = 0
+        self.errors = 0
+
+    def rates_for(self, level):
+        scale = self.levels[level]
+        return (int(round(KamigamiRobot.Settings.IMU_NOTIFY_PER_SECOND * scale)),
+                int(round(KamigamiRobot.Settings.LUX_NOTIFY_PER_SECOND * scale)),
+                int(round(KamigamiRobot.Settings.MOTOR_SETTINGS_NOTIFY_PER_SECOND * scale)))
+
+    def check(self):
+        """
+        Pick the level for the link as it is now.  Returns the new level.
+        """
+        transport = self.transport
+        wrote = transport.written != self._written
+        self._written = transport.written
+        latency = transport.write_latency
+        if wrote:
+            if self.baseline is None or latency < self.baseline:
+                self.baseline = latency
+            else:
+                self.baseline += (latency - self.baseline) * self.BASELINE_DRIFT
+        if transport.depth > self.busy_depth or (wrote and latency > self.baseline * self.busy_ratio):
+            self._idle = 0
+            return min(self.level + 1, len(self.levels) - 1)
+        if not wrote or latency <= self.baseline * self.idle_ratio:
+            self._idle += 1
+            if self._idle >= self.idle_checks:
+                self._idle = 0
+                return max(self.level - 1, 0)
+        else:
+            self._idle = 0
+        return self.level
+
+    @asyncio.coroutine
+    def apply(self, level):
+        """
+        Send the rates for level.  Goes through the transport's queue, so
+        it is ordered with the control traffic.
+        """
+        rates = self.rates_for(level)
+        if rates == self.rates:
+            self.level = level
+            return
+        try:
+            yield from self.transport.write(KamigamiByteFormatter.get_sendable_sticky_packet(*rates))
+        except Exception:
+            self.errors += 1
+            log.warning("Could not set telemetry rates to %s", rates)
+            return
+        # Only control traffic counts towards the next check.
+        self._written = self.transport.written
+        if self.rates is not None:
+            self.changes += 1
+            log.info("Telemetry rates %s -> %s", self.rates, rates)
+        self.level = level
+        self.rates = rates
+        if self.telemetry is not None:
+            fastest = max(rates[0], rates[1])
+            self.telemetry.poll_interval = 1.0 / (2 * fastest) if fastest else 0.5
+
+    @asyncio.coroutine
+    def run(self):
+        yield from self.apply(self.level)
+        while True:
+            yield from asyncio.sleep(self.interval)
+            level = self.check()
+            if level != self.level or self.rates is None:
+                yield from self.apply(level)
+
+    def stats(self):
+        return {
+            "level": self.level,
+            "rates": self.rates,
+            "baseline_latency": self.baseline,
+            "changes": self.changes,
+            "errors": self.errors,
+        }
+
+
+class CommandRateController:
+    """
+    AIMD control of a robot's command tick rate.  Every interval, if the
+    link fell behind since the last check, the rate is multiplied by
+    decrease; otherwise it grows by increase Hz.  It always stays within
+    min_rate and max_rate.  Falling behind is any write failing or being
+    rejected, more than busy_depth frames queued, or the average write
+    taking longer than target_load ticks at the current rate (so ticks
+    are being missed).  It is relative to the tick because a write with
+    response takes at least one BLE connection interval, 30-50ms on a
+    healthy link.
+
+    writer: what ticks, anything with a rate_hz property (a
+            UnifiedTickMerger or MailboxWriter).
+    transport: the AsyncBleTransport the writer writes through.
+    metrics: optional Metrics to count the adjustments in.
+    """
+    def __init__(self, writer, transport, min_rate=5.0, max_rate=40.0, target_load=1.0, busy_depth=4,
+                 increase=2.0, decrease=0.5, interval=0.5, metrics=None):
+        self.writer = writer
+        self.transport = transport
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.target_load = target_load
+        self.busy_depth = busy_depth
+        self.increase = increase
+        self.decrease = decrease
+        self.interval = interval
+        self.metrics = metrics
+        self._written = transport.written
+        self._failed = transport.errors + transport.rejected
+        self.error_rate = 0.0
+        self.increases = 0
+        self.decreases = 0
+
+    @property
+    def rate_hz(self):
+        return self.writer.rate_hz
+
+    def check(self):
+        """
+        Adjust the rate for the link as it is now.  Returns the new rate.
+        """
+        transport = self.transport
+        written = transport.written - self._written
+        failed = transport.errors + transport.rejected - self._failed
+        self._written = transport.written
+        self._failed = transport.errors + transport.rejected
+        attempts = written + failed
+        self.error_rate = float(failed) / attempts if attempts else 0.0
+
+        rate = self.writer.rate_hz
+        load = transport.write_latency * rate
+        if failed or transport.depth > self.busy_depth or (written and load > self.target_load):
+            new_rate = max(self.min_rate, rate * self.decrease)
+            if new_rate < rate:
+                self.decreases += 1
+                if self.metrics is not None:
+                    self.metrics.count("rate_decreases")
+                log.info("Command rate %.1f -> %.1f Hz (write %.1fms, %d queued, %d failed)",
+                         rate, new_rate, transport.write_latency * 1e3, transport.depth, failed)
+        else:
+            new_rate = min(self.max_rate, rate + self.increase)
+            if new_rate > rate:
+                self.increases += 1
+        self.writer.rate_hz = new_rate
+        return new_rate
+
+    @asyncio.coroutine
+    def run(self):
+        while True:
+            yield from asyncio.sleep(self.interval)
+            self.check()
+
+    def stats(self):
+        return {
+            "rate_hz": self.writer.rate_hz,
+            "write_latency": self.transport.write_latency,
+            "tick_load": self.transport.write_latency * self.writer.rate_hz,
+            "error_rate": self.error_rate,
+            "depth": self.transport.depth,
+            "increases": self.increases,
+            "decreases": self.decreases,
+        }
@@ -0,0 +1,172 @@
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+
+from KamigamiMetrics import clock
+
+"""
+Logging that never blocks the control path.  Everything logs to
+loggers named "kamigami.<category>" (see logger()); setup() puts a
+QueueHandler on them, so a record costs a level check, a sampling check
+and a put on a bounded queue, and a QueueListener thread does the
+formatting and the terminal or journald I/O.  When the queue is full
+records are dropped and counted rather than waited on.
+
+Categories used: control, interactive, session, radio, telemetry, metrics.
+"""
+
+ROOT = "kamigami"
+DEFAULT_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+
+def logger(category):
+    return logging.getLogger("{0}.{1}".format(ROOT, category))
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Lets through at most rate records per second (with bursts of up to
+    burst) for each logger and message template, and drops the rest.
+    rates: optional {category: rate} overriding rate for some categories;
+           a rate of None means no sampling.
+    Records at or above always_level are never dropped.
+    """
+    def __init__(self, rate=10.0, burst=None, rates=None, always_level=logging.WARNING):
+        logging.Filter.__init__(self)
+        self.rate = rate
+        self.burst = burst
+        self.rates = dict(("{0}.{1}".format(ROOT, category), value)
+                          for category, value in (rates or {}).items())
+        self.always_level = always_level
+        self._buckets = {}
+        self.sampled_out = 0
+
+    def filter(self, record):
+        if record.levelno >= self.always_level:
+            return True
+        rate = self.rates.get(record.name, self.rate)
+        if rate is None:
+            return True
+        key = (record.name, record.msg)
+        now = clock()
+        burst = self.burst if self.burst is not None else max(rate, 1.0)
+        tokens, last = self._buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - last) * rate)
+        if tokens < 1.0:
+            self._buckets[key] = (tokens, now)
+            self.sampled_out += 1
+            return False
+        self._buckets[key] = (tokens - 1.0, now)
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that drops records when its bounded queue is full, and
+    leaves formatting to the listener thread.
+    """
+    def __init__(self, records):
+        logging.handlers.QueueHandler.__init__(self, records)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record):
+        # Records stay in this process, so there is no need to merge the
+        # arguments into the message here.  Tracebacks are rendered now,
+        # while the exception is still current.
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class LogSink:
+    """
+    The queue, its handler and the listener thread that drains it.
+    levels: {category: level} for individual categories; others log
+            at level.
+    rates: {category: records per second}, see SamplingFilter.
+    """
+    def __init__(self, level=logging.INFO, levels=None, rate=10.0, rates=None,
+                 stream=None, handler=None, max_records=10000, fmt=DEFAULT_FORMAT):
+        if handler is None:
+            handler = logging.StreamHandler(stream if stream is not None else sys.stderr)
+            handler.setFormatter(logging.Formatter(fmt))
+        self.handler = handler
+        self.queue_handler = DroppingQueueHandler(queue.Queue(max_records))
+        self.sampler = SamplingFilter(rate, rates=rates)
+        self.queue_handler.addFilter(self.sampler)
+        self.listener = logging.handlers.QueueListener(self.queue_handler.queue, handler)
+        self.root = logging.getLogger(ROOT)
+        self.root.setLevel(level)
+        self.root.propagate = False
+        for category, category_level in (levels or {}).items():
+            self.set_level(category, category_level)
+        self._lock = threading.Lock()
+        self._started = False
+
+    def set_level(self, category, level):
+        """
+        Change a category's level, e.g. turn on "control" debug output
+        while the robots are running.
+        """
+        logger(category).setLevel(level)
+
+    def start(self):
+        with self._lock:
+            if not self._started:
+                self.root.addHandler(self.queue_handler)
+                self.listener.start()
+                self._started = True
+        return self
+
+    def stop(self):
+        """
+        Flush what is queued and stop the listener thread.
+        """
+        with self._lock:
+            if self._started:
+                self.root.removeHandler(self.queue_handler)
+                self.listener.stop()
+                self._started = False
+
+    def stats(self):
+        return {
+            "queued": self.queue_handler.queue.qsize(),
+            "dropped": self.queue_handler.dropped,
+            "sampled_out": self.sampler.sampled_out,
+        }
+
+
+def parse_levels(spec):
+    """
+    Parse "control=DEBUG,radio=WARNING" into {category: level}.  A bare
+    level, e.g. "DEBUG", sets the default level under the key None.
+    """
+    levels = {}
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        category, _, level = part.rpartition("=")
+        value = logging.getLevelName(level.strip().upper())
+        if not isinstance(value, int):
+            raise ValueError("Unknown log level: {0}".format(level))
+        levels[category.strip() or None] = value
+    return levels
+
+
+def setup(spec="", **kwargs):
+    """
+    Start a LogSink configured from a parse_levels spec.
+    """
+    levels = parse_levels(spec)
+    level = levels.pop(None, logging.INFO)
+    return LogSink(level=level, levels=levels, **kwargs).start()
@@ -0,0 +1,138 @@
+import threading
+
+from KamigamiMetrics import clock
+
+"""
+Latest-wins delivery of motor commands.  Producers post encoded packets
+into a CommandMailbox as fast as they like; a MailboxWriter thread takes
+whatever is newest at a fixed rate and writes it to the robot, so a slow
+radio never builds up a backlog of stale commands.
+"""
+
+
+class CommandMailbox:
+    """
+    Single slot mailbox.  Posting a command replaces any command that
+    has not been sent yet.  Commands older than max_age seconds when the
+    writer gets to them are dropped instead of sent.
+    metrics: optional Metrics to record queueing and end to end latency in.
+    """
+    def __init__(self, max_age=None, metrics=None):
+        self.max_age = max_age
+        self.metrics = metrics
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._command = None
+        self._posted_at = 0.0
+        self._origin = None
+
+        self.posted = 0
+        self.superseded = 0
+        self.dropped = 0
+        self.sent = 0
+        self.errors = 0
+
+    def post(self, command):
+        now = clock()
+        origin = self.metrics.origin if self.metrics is not None else None
+        with self._lock:
+            if self._command is not None:
+                self.superseded += 1
+            self._command = command
+            self._posted_at = now
+            self._origin = origin
+            self.posted += 1
+        self._ready.set()
+        if origin is not None:
+            self.metrics.stage("enqueue").record(now - origin)
+
+    # Lets the mailbox stand in wherever an AdaptedWriter is expected.
+    write_value = post
+
+    def take(self):
+        """
+        Remove and return the pending command, or None if there is none
+        (or it was too old to be worth sending).
+        """
+        return self._take()[0]
+
+    def _take(self):
+        with self._lock:
+            command = self._command
+            posted_at = self._posted_at
+            origin = self._origin
+            self._command = None
+            self._ready.clear()
+        if command is None:
+            return None, None, None
+        if self.max_age is not None and clock() - posted_at > self.max_age:
+            self.dropped += 1
+            return None, None, None
+        return command, posted_at, origin
+
+    def wait(self, timeout=None):
+        return self._ready.wait(timeout)
+
+    def stats(self):
+        return {
+            "posted": self.posted,
+            "superseded": self.superseded,
+            "dropped": self.dropped,
+            "sent": self.sent,
+            "errors": self.errors,
+        }
+
+
+class MailboxWriter(threading.Thread):
+    """
+    Drains a CommandMailbox into a writer (anything with write_value) at
+    no more than rate_hz writes per second.
+    """
+    def __init__(self, mailbox, writer, rate_hz=40):
+        threading.Thread.__init__(self, name="kamigami-writer")
+        self.daemon = True
+        self.mailbox = mailbox
+        self.writer = writer
+        self.interval = 1.0 / rate_hz
+        self._stopping = threading.Event()
+
+    @property
+    def rate_hz(self):
+        return 1.0 / self.interval
+
+    @rate_hz.setter
+    def rate_hz(self, rate_hz):
+        self.interval = 1.0 / rate_hz
+
+    def run(self):
+        metrics = self.mailbox.metrics
+        next_tick = clock()
+        while not self._stopping.is_set():
+            # Sleep until there is something to send, then hold it
+            # back until the next tick so the rate cap is respected.
+            if not self.mailbox.wait(0.5):
+                continue
+            delay = next_tick - clock()
+            if delay > 0:
+                self._stopping.wait(delay)
+            command, posted_at, origin = self.mailbox._take()
+            if command is None:
+                continue
+            started = clock()
+            try:
+                self.writer.write_value(command)
+                self.mailbox.sent += 1
+            except Exception:
+                self.mailbox.errors += 1
+                self.mailbox.dropped += 1
+            else:
+                if metrics is not None:
+                    metrics.stage("queued").record(started - posted_at)
+                    if origin is not None:
+                        metrics.stage("end_to_end").since(origin)
+            next_tick = max(next_tick + self.interval, clock())
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        self.mailbox._ready.set()
+        self.join(timeout)
@@ -0,0 +1,212 @@
+import collections
+import threading
+
+from KamigamiData import KamigamiByteFormatter, UnifiedPacket
+from KamigamiMetrics import clock
+
+"""
+Per-tick merging of motor and light state.  Callers only set the latest
+wanted state; once per tick the merger sends at most one frame carrying
+whatever changed, as a single UNIFIED_PACKET where possible, and sends
+nothing at all when nothing changed (apart from a periodic keep-alive).
+One-shot frames (IR, shutdown, testmode) can be queued with send(); each
+takes a tick of its own, ahead of the state.
+"""
+
+
+class UnifiedTickMerger(threading.Thread):
+    """
+    writer: anything with a blocking write_value, e.g. AsyncBleTransport.
+    rate_hz: ticks per second, so at most this many frames per second.
+    keepalive: seconds after which the current state is re-sent even if
+               it has not changed, or None to never re-send.
+    metrics: optional Metrics for enqueue/queued/end_to_end latency.
+
+    UNIFIED_PACKET only carries forward speeds (0 to 63).  A tick that has
+    to send a reverse speed sends a MOTOR_PACKET instead and leaves any
+    light change for the next tick.
+    """
+    def __init__(self, writer, rate_hz=40, keepalive=1.0, metrics=None):
+        threading.Thread.__init__(self, name="kamigami-merger")
+        self.daemon = True
+        self.writer = writer
+        self.interval = 1.0 / rate_hz
+        self.keepalive = keepalive
+        self.metrics = metrics
+        self.packet = UnifiedPacket()
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._stopping = threading.Event()
+
+        self._motors = None
+        self._lights = None
+        self._oneshots = collections.deque()
+        self._posted_at = None
+        self._origin = None
+        self._sent_motors = None
+        self._sent_lights = None
+        self._sending = None
+        self._last_sent = 0.0
+
+        self.ticks = 0
+        self.frames = 0
+        self.unified = 0
+        self.oneshots = 0
+        self.motor_fallbacks = 0
+        self.suppressed = 0
+        self.keepalives = 0
+        self.errors = 0
+
+    @property
+    def rate_hz(self):
+        return 1.0 / self.interval
+
+    @rate_hz.setter
+    def rate_hz(self, rate_hz):
+        self.interval = 1.0 / rate_hz
+
+    def set_motors(self, left, right):
+        if left >= 64 or left <= -64 or right >= 64 or right <= -64:
+            raise ValueError("Please specify speeds correctly.  Speeds must be between -63 and 63, inclusive.")
+        self._post(motors=(left, right))
+
+    def set_lights(self, r, g, b):
+        if not (0 <= r <= 255 and 0 <= g <= 255 and 0 <= b <= 255):
+            raise ValueError("Color values must be between 0 and 255, inclusive.")
+        self._post(lights=(r, g, b))
+
+    def send(self, frame):
+        """
+        Queue a one-shot frame for the next tick, without waiting for it
+        to be written.
+        """
+        with self._lock:
+            self._oneshots.append(bytes(frame))
+        self._ready.set()
+
+    def _post(self, motors=None, lights=None):
+        now = clock()
+        origin = self.metrics.origin if self.metrics is not None else None
+        with self._lock:
+            if motors is not None:
+                self._motors = motors
+            if lights is not None:
+                self._lights = lights
+            self._posted_at = now
+            self._origin = origin
+        self._ready.set()
+        if origin is not None:
+            self.metrics.stage("enqueue").record(now - origin)
+
+    def _next_oneshot(self):
+        """
+        The oldest queued one-shot frame, or None.  _ready stays set, so
+        the state (and any further one-shots) follow on later ticks.
+        """
+        with self._lock:
+            if not self._oneshots:
+                return None
+            self.oneshots += 1
+            return self._oneshots.popleft()
+
+    def _next_frame(self, now):
+        """
+        Fill in and return the frame for this tick, or None.  What it
+        carries only counts as sent (in _sending) once the write works,
+        so a failed write is retried on the next tick.
+        """
+        with self._lock:
+            motors, lights = self._motors, self._lights
+            self._ready.clear()
+        keepalive = (self.keepalive is not None and self._last_sent
+                     and now - self._last_sent >= self.keepalive)
+        send_motors = motors is not None and (motors != self._sent_motors or keepalive)
+        send_lights = lights is not None and (lights != self._sent_lights or keepalive)
+        if not (send_motors or send_lights):
+            self.suppressed += 1
+            return None
+        if keepalive and motors == self._sent_motors and lights == self._sent_lights:
+            self.keepalives += 1
+
+        if send_motors and (motors[0] < 0 or motors[1] < 0):
+            self.motor_fallbacks += 1
+            sent_lights = self._sent_lights
+            if send_lights:
+                # Come back for the lights on the next tick, even if this
+                # was only a keep-alive.
+                sent_lights = None
+                self._ready.set()
+            self._sending = (motors, sent_lights)
+            return KamigamiByteFormatter.get_sendable_motor_packet(motors[0], motors[1])
+
+        packet = self.packet
+        packet.clear()
+        sent_motors, sent_lights = self._sent_motors, self._sent_lights
+        if send_motors:
+            packet.set_motors(motors[0], motors[1])
+            sent_motors = motors
+        if send_lights:
+            packet.set_lights(lights[0], lights[1], lights[2])
+            sent_lights = lights
+        self._sending = (sent_motors, sent_lights)
+        self.unified += 1
+        return packet.view()
+
+    def run(self):
+        next_tick = clock()
+        while not self._stopping.is_set():
+            # Sleep until something is posted or a keep-alive is due, then
+            # hold it back until the next tick so the rate cap is respected.
+            timeout = 0.5
+            if self.keepalive is not None and self._last_sent:
+                timeout = max(0.0, min(timeout, self._last_sent + self.keepalive - clock()))
+            self._ready.wait(timeout)
+            delay = next_tick - clock()
+            if delay > 0 and self._stopping.wait(delay):
+                break
+            self.ticks += 1
+            started = clock()
+            posted_at = origin = None
+            self._sending = None
+            frame = self._next_oneshot()
+            if frame is None:
+                frame = self._next_frame(started)
+                if frame is not None:
+                    with self._lock:
+                        posted_at, origin = self._posted_at, self._origin
+                        self._origin = None
+            if frame is not None:
+                try:
+                    self.writer.write_value(frame)
+                except Exception:
+                    self.errors += 1
+                    if self._sending is not None:
+                        # Try the state again on the next tick.
+                        self._ready.set()
+                else:
+                    if self._sending is not None:
+                        self._sent_motors, self._sent_lights = self._sending
+                    self.frames += 1
+                    self._last_sent = clock()
+                    if self.metrics is not None and posted_at is not None:
+                        self.metrics.stage("queued").record(started - posted_at)
+                        if origin is not None:
+                            self.metrics.stage("end_to_end").since(origin)
+            next_tick = max(next_tick + self.interval, clock())
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        self._ready.set()
+        self.join(timeout)
+
+    def stats(self):
+        return {
+            "ticks": self.ticks,
+            "frames": self.frames,
+            "unified": self.unified,
+            "oneshots": self.oneshots,
+            "motor_fallbacks": self.motor_fallbacks,
+            "suppressed": self.suppressed,
+            "keepalives": self.keepalives,
+            "errors": self.errors,
+        }
@@ -0,0 +1,168 @@
+import asyncio
+import threading
+import time
+
+"""
+Low overhead latency histograms and counters for the control path, from
+an Interactive packet arriving to the BLE write completing.  Recording a
+value is a couple of integer operations and a list increment, cheap
+enough to leave on in production.  Summaries can be printed periodically
+or scraped over HTTP in the Prometheus text format.
+"""
+
+clock = time.perf_counter
+
+
+class Histogram:
+    """
+    HDR-style histogram of durations in seconds.  Values are bucketed in
+    microseconds with 16 linear sub-buckets per power of two, so any
+    percentile is accurate to within about 6%.
+    """
+    SUB_BUCKETS = 16
+    BUCKETS = 40 * SUB_BUCKETS
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = [0] * Histogram.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    @staticmethod
+    def _index(micros):
+        if micros < 2 * Histogram.SUB_BUCKETS:
+            return micros
+        shift = micros.bit_length() - 5
+        return min(shift * Histogram.SUB_BUCKETS + (micros >> shift), Histogram.BUCKETS - 1)
+
+    @staticmethod
+    def _upper_bound(index):
+        if index < 2 * Histogram.SUB_BUCKETS:
+            return index + 1
+        shift = index // Histogram.SUB_BUCKETS - 1
+        return (index - shift * Histogram.SUB_BUCKETS + 1) << shift
+
+    def record(self, seconds):
+        index = Histogram._index(int(seconds * 1e6)) if seconds > 0 else 0
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def since(self, start):
+        """
+        Record the time elapsed since start (a clock() value).
+        """
+        self.record(clock() - start)
+
+    def percentile(self, percent):
+        """
+        Upper bound of the bucket holding the given percentile, in seconds.
+        """
+        if not self.count:
+            return 0.0
+        target = self.count * percent / 100.0
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= target:
+                return min(Histogram._upper_bound(index) / 1e6, self.max)
+        return self.max
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def reset(self):
+        with self._lock:
+            self.counts = [0] * Histogram.BUCKETS
+            self.count = 0
+            self.total = 0.0
+            self.max = 0.0
+
+
+class Metrics:
+    """
+    Named histograms (stages) and counters.
+
+    origin: clock() time the Interactive packet currently being handled
+            arrived.  Set by the receive loop and picked up by whatever
+            queues a command while handling it.
+    """
+    PERCENTILES = (50, 90, 99)
+
+    def __init__(self):
+        self.stages = {}
+        self.counters = {}
+        self.origin = None
+
+    def stage(self, name):
+        histogram = self.stages.get(name)
+        if histogram is None:
+            histogram = self.stages.setdefault(name, Histogram())
+        return histogram
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def summary(self):
+        lines = []
+        for name in sorted(self.stages):
+            histogram = self.stages[name]
+            lines.append("{0:<12} n={1:<8} mean={2:.3f}ms {3} max={4:.3f}ms".format(
+                name, histogram.count, histogram.mean * 1e3,
+                " ".join("p{0}={1:.3f}ms".format(p, histogram.percentile(p) * 1e3)
+                         for p in Metrics.PERCENTILES),
+                histogram.max * 1e3))
+        for name in sorted(self.counters):
+            lines.append("{0:<12} {1}".format(name, self.counters[name]))
+        return "\n".join(lines)
+
+    def exposition(self):
+        """
+        Prometheus text format.
+        """
+        lines = []
+        for name in sorted(self.stages):
+            histogram = self.stages[name]
+            metric = "kamigami_{0}_seconds".format(name)
+            lines.append("# TYPE {0} summary".format(metric))
+            for p in Metrics.PERCENTILES:
+                lines.append('{0}{{quantile="{1}"}} {2:.6f}'.format(metric, p / 100.0, histogram.percentile(p)))
+            lines.append("{0}_sum {1:.6f}".format(metric, histogram.total))
+            lines.append("{0}_count {1}".format(metric, histogram.count))
+        for name in sorted(self.counters):
+            metric = "kamigami_{0}_total".format(name)
+            lines.append("# TYPE {0} counter".format(metric))
+            lines.append("{0} {1}".format(metric, self.counters[name]))
+        return "\n".join(lines) + "\n"
+
+
+@asyncio.coroutine
+def report_periodically(metrics, interval=60.0, output=print):
+    while True:
+        yield from asyncio.sleep(interval)
+        output(metrics.summary())
+
+
+@asyncio.coroutine
+def serve(metrics, host="127.0.0.1", port=9105):
+    """
+    Answer every HTTP request with the current metrics.
+    """
+    @asyncio.coroutine
+    def handle(reader, writer):
+        try:
+            yield from reader.readline()
+            body = metrics.exposition().encode("utf-8")
+            writer.write(b"HTTP/1.0 200 OK\r\n"
+                         b"Content-Type: text/plain; version=0.0.4\r\n"
+                         b"Content-Length: " + str(len(body)).encode("ascii") + b"\r\n\r\n" + body)
+            yield from writer.drain()
+        finally:
+            writer.close()
+
+    return (yield from asyncio.start_server(handle, host, port))
@@ -0,0 +1,203 @@
+import asyncio
+import mmap
+import struct
+import threading
+import time
+
+from beam_interactive import proto
+
+"""
+Capture and replay of live traffic.  A KamigamiRecorder appends every
+incoming Interactive packet and every outgoing BLE frame, with a
+timestamp, to a compact binary log.  A log is read back through a
+memory map, and ReplayConnection feeds its Interactive packets to the
+same handlers a live connection would, in real time or as fast as
+possible.
+
+Log layout: the 8 byte MAGIC, a little-endian double with the wall clock
+start time, then records of RECORD (kind, channel, seconds since start,
+payload length) each followed by the payload.
+"""
+
+MAGIC = b"KMGLOG01"
+HEADER = struct.Struct('<8sd')
+RECORD = struct.Struct('<BHdI')
+
+INTERACTIVE = 1
+BLE_WRITE = 2
+
+
+class KamigamiRecorder:
+    """
+    Append-only log writer.  Safe to call from the event loop and from
+    radio threads at the same time.
+
+    flush_every: flush after this many records.
+    flush_interval: seconds between flushes of records written since the
+                    last one, from a daemon thread, so a crash or kill
+                    loses at most this much of a quiet log.  None for no
+                    timer.
+    """
+    def __init__(self, path, flush_every=256, flush_interval=1.0):
+        self.path = path
+        self.flush_every = flush_every
+        self._file = open(path, "wb")
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        self._file.write(HEADER.pack(MAGIC, time.time()))
+        self._file.flush()
+        self._unflushed = 0
+        self.records = 0
+        self.flushes = 0
+        self._stopping = threading.Event()
+        self._thread = None
+        if flush_interval is not None:
+            self._thread = threading.Thread(target=self._run, args=(flush_interval,), name="kamigami-recorder")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def record(self, kind, payload, channel=0):
+        header = RECORD.pack(kind, channel, time.monotonic() - self._start, len(payload))
+        with self._lock:
+            self._file.write(header)
+            self._file.write(payload)
+            self.records += 1
+            self._unflushed += 1
+            if self._unflushed >= self.flush_every:
+                self._flush()
+
+    def record_interactive(self, raw_packet):
+        self.record(INTERACTIVE, raw_packet)
+
+    def record_write(self, frame, channel=0):
+        self.record(BLE_WRITE, frame, channel)
+
+    def flush(self):
+        with self._lock:
+            if self._unflushed and not self._file.closed:
+                self._flush()
+
+    def _flush(self):
+        self._file.flush()
+        self._unflushed = 0
+        self.flushes += 1
+
+    def _run(self, interval):
+        while not self._stopping.wait(interval):
+            self.flush()
+
+    def close(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+        with self._lock:
+            if self._unflushed:
+                self._flush()
+            self._file.close()
+
+
+class KamigamiLog:
+    """
+    Memory-mapped reader for a recorder log.  Payloads are copied out of
+    the map as bytes (they are a few hundred bytes at most), so they stay
+    valid after close() and never keep the map from closing.
+    """
+    def __init__(self, path):
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.started = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise ValueError("{0} is not a Kamigami log.".format(path))
+
+    def __iter__(self):
+        """
+        Yields (kind, channel, seconds since start, payload).  A record cut
+        short by a crash ends the iteration.
+        """
+        offset = HEADER.size
+        size = len(self._map)
+        while offset + RECORD.size <= size:
+            kind, channel, seconds, length = RECORD.unpack_from(self._map, offset)
+            offset += RECORD.size
+            if offset + length > size:
+                break
+            yield kind, channel, seconds, self._map[offset:offset + length]
+            offset += length
+
+    @property
+    def buffer(self):
+        """
+        The whole log, file header included, for vectorized readers such
+        as KamigamiDecoder.decode_log.  Views of it must be released
+        before close().
+        """
+        return self._map
+
+    def record_offsets(self):
+        """
+        Yields the file offset of every complete record, walking the
+        record headers without copying any payload.
+        """
+        offset = HEADER.size
+        size = len(self._map)
+        unpack_from = RECORD.unpack_from
+        while offset + RECORD.size <= size:
+            end = offset + RECORD.size + unpack_from(self._map, offset)[3]
+            if end > size:
+                break
+            yield offset
+            offset = end
+
+    def interactive(self):
+        for kind, channel, seconds, payload in self:
+            if kind == INTERACTIVE:
+                yield seconds, payload
+
+    def writes(self):
+        for kind, channel, seconds, payload in self:
+            if kind == BLE_WRITE:
+                yield channel, seconds, payload
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+class ReplayConnection:
+    """
+    Stands in for a beam_interactive connection, serving the Interactive
+    packets of a log.  realtime keeps the original spacing (scaled by
+    speed); otherwise packets come as fast as they are read.
+    """
+    def __init__(self, log, realtime=True, speed=1.0):
+        self._packets = log.interactive()
+        self.realtime = realtime
+        self.speed = speed
+        self._next = None
+        self._started = None
+        self.closed = False
+
+    @asyncio.coroutine
+    def wait_message(self):
+        if self.closed:
+            return False
+        self._next = next(self._packets, None)
+        if self._next is None:
+            return False
+        if self.realtime:
+            now = time.monotonic()
+            if self._started is None:
+                self._started = now - self._next[0] / self.speed
+            delay = self._started + self._next[0] / self.speed - now
+            if delay > 0:
+                yield from asyncio.sleep(delay)
+        else:
+            yield from asyncio.sleep(0)
+        return True
+
+    def get_packet(self):
+        raw = bytes(self._next[1])
+        return proto.decode(raw), raw
+
+    def close(self):
+        self.closed = True
@@ -0,0 +1,156 @@
+import contextlib
+import fcntl
+import json
+import os
+import threading
+import time
+from bluepy.btle import Scanner, DefaultDelegate
+
+"""
+Finding Kamigami Robots.  Scanning stops as soon as enough robots have
+advertised instead of waiting out the whole scan window, and robots that
+were found (or connected to) recently are remembered on disk so that a
+reconnect can skip scanning altogether.
+"""
+
+ROBOT_NAME = "KRB0001"
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".kamigami_robots.json")
+
+
+class RobotScanDelegate(DefaultDelegate):
+    """
+    Records every Kamigami Robot advertisement as it arrives, keeping the
+    strongest RSSI seen for each address.
+    """
+    def __init__(self):
+        DefaultDelegate.__init__(self)
+        self.found = {}
+
+    def handleDiscovery(self, dev, isNewDev, isNewData):
+        if dev.addr in self.found:
+            self.found[dev.addr] = max(self.found[dev.addr], dev.rssi)
+            return
+        for (adtype, desc, value) in dev.getScanData():
+            if value == ROBOT_NAME:
+                self.found[dev.addr] = dev.rssi
+                return
+
+
+def find_robots(count=1, scan_time=10.0, iface=0, poll=0.1):
+    """
+    Scan until `count` robots have been seen or scan_time runs out.
+    Returns a list of (address, rssi) tuples, strongest signal first.
+    """
+    delegate = RobotScanDelegate()
+    scanner = Scanner(iface).withDelegate(delegate)
+    deadline = time.monotonic() + scan_time
+    scanner.clear()
+    scanner.start()
+    try:
+        while len(delegate.found) < count:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            scanner.process(min(poll, remaining))
+    finally:
+        scanner.stop()
+    return sorted(delegate.found.items(), key=lambda item: item[1], reverse=True)
+
+
+def find_mac_address(scan_time=10.0, cache=None, iface=0):
+    """
+    Address of the first robot found, or None.
+    """
+    robots = find_robots(1, scan_time, iface)
+    if not robots:
+        return None
+    if cache is not None:
+        cache.remember(robots[0][0], robots[0][1])
+    return robots[0][0]
+
+
+class MacCache:
+    """
+    Addresses of robots seen recently, stored as JSON.  Entries older than
+    ttl seconds are ignored.  Safe to share between the threads that
+    connect a fleet's robots in parallel, and between processes (such as
+    shard workers) using the same path: updates hold an flock on a lock
+    file next to it.  path None keeps the cache in memory only, e.g. for
+    fake robots that must not end up in the real one.
+    """
+    def __init__(self, path=DEFAULT_CACHE_PATH, ttl=24 * 60 * 60):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def _load(self):
+        if self.path is None:
+            return dict(self._entries)
+        try:
+            with open(self.path) as cache_file:
+                return json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with self._lock:
+            if self.path is None:
+                yield
+                return
+            try:
+                lock_file = open(self.path + ".lock", "a")
+            except (IOError, OSError):
+                # The cache is only an optimization.
+                lock_file = None
+            try:
+                if lock_file is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                yield
+            finally:
+                if lock_file is not None:
+                    lock_file.close()
+
+    def _save(self, entries):
+        if self.path is None:
+            self._entries = entries
+            return
+        temp_path = "{0}.{1}.tmp".format(self.path, os.getpid())
+        try:
+            with open(temp_path, "w") as cache_file:
+                json.dump(entries, cache_file)
+            os.replace(temp_path, self.path)
+        except (IOError, OSError):
+            # The cache is only an optimization.
+            pass
+
+    def fresh(self):
+        """
+        Cached addresses within the TTL, most recently seen first.
+        """
+        now = time.time()
+        entries = self._load()
+        fresh = [(mac, entry["seen"]) for mac, entry in entries.items()
+                 if now - entry.get("seen", 0) <= self.ttl]
+        return [mac for mac, seen in sorted(fresh, key=lambda item: item[1], reverse=True)]
+
+    def get(self, mac):
+        return self._load().get(mac)
+
+    def remember(self, mac, rssi=None, **extra):
+        with self._locked():
+            entries = self._load()
+            entry = entries.get(mac, {})
+            entry["seen"] = time.time()
+            if rssi is not None:
+                entry["rssi"] = rssi
+            entry.update(extra)
+            entries[mac] = entry
+            self._save(entries)
+
+    def forget(self, mac):
+        with self._locked():
+            entries = self._load()
+            if entries.pop(mac, None) is not None:
+                self._save(entries)
@@ -0,0 +1,186 @@
+import asyncio
+import random
+import time
+from bluepy import btle
+
+from KamigamiData import KamigamiRobot
+from KamigamiLogging import logger
+from KamigamiScanner import MacCache, find_mac_address
+
+"""
+Lazily connected link to one robot.  Creating a KamigamiSession does no
+I/O; scanning and GATT discovery only happen on connect(), which can run
+on an executor (connect_async) alongside other start up work such as
+logging into Beam.
+
+GATT handles are cached per robot next to its address, so reconnecting
+to a known robot skips service discovery and writes by handle.
+"""
+
+# Client Characteristic Configuration descriptor, and the value that
+# turns notifications on.
+CCCD_UUID = 0x2902
+NOTIFICATIONS_ON = b"\x01\x00"
+
+log = logger("session")
+
+
+class HandleWriter:
+    """
+    Writes to a characteristic by its cached value handle, with the same
+    write() signature as a bluepy Characteristic.
+    """
+    def __init__(self, peripheral, handle):
+        self.peripheral = peripheral
+        self.handle = handle
+
+    def write(self, val, withResponse=False):
+        return self.peripheral.writeCharacteristic(self.handle, val, withResponse)
+
+    def getHandle(self):
+        return self.handle
+
+
+class KamigamiSession:
+    """
+    mac: address of the robot, or None to try recently seen robots and
+         then scan for the first one.
+    scan_time: seconds to scan for when no address is given.
+    cache: MacCache of known robots.  Defaults to the one in the home
+           directory.
+    iface: number of the HCI adapter to use (0 for hci0).
+    """
+    # Reconnect backoff: the first retry is immediate, later ones wait a
+    # random time up to base * 2**attempt, capped at max.
+    RECONNECT_BASE_DELAY = 0.05
+    RECONNECT_MAX_DELAY = 2.0
+    # Cached handles are dropped after this many failed reconnects.
+    HANDLE_RETRIES = 3
+
+    def __init__(self, mac=None, scan_time=10.0, cache=None, iface=0):
+        self.mac = mac
+        self.scan_time = scan_time
+        self.iface = iface
+        self.cache = cache if cache is not None else MacCache()
+        self.peripheral = None
+        self.writer = None
+        self.delegate = None
+        self.reconnects = 0
+
+    @property
+    def connected(self):
+        return self.writer is not None
+
+    def connect(self):
+        """
+        Find (if needed) and connect to the robot.  Blocking; does
+        nothing if already connected.
+        """
+        if self.connected:
+            return self
+        if self.mac is None:
+            # Robots we have seen recently are probably still around.
+            for mac in self.cache.fresh():
+                try:
+                    return self._connect_to(mac)
+                except btle.BTLEException:
+                    self.cache.forget(mac)
+            mac = find_mac_address(self.scan_time, iface=self.iface)
+            if mac is None:
+                raise EnvironmentError("No Kamigami Robot found while scanning.")
+            return self._connect_to(mac)
+        return self._connect_to(self.mac)
+
+    def _connect_to(self, mac, use_cached_handles=True):
+        log.info("Attempting to connect to Mac Address: %s", mac)
+        peripheral = btle.Peripheral(mac, addrType=btle.ADDR_TYPE_RANDOM, iface=self.iface)
+        log.info("Acquired peripheral %s.", mac)
+        handles = self._cached_handles(mac) if use_cached_handles else None
+        if handles is not None:
+            self.writer = HandleWriter(peripheral, handles["write_handle"])
+        else:
+            service = peripheral.getServiceByUUID(KamigamiRobot.MAIN_SERVICE_UUID)
+            self.writer = service.getCharacteristics(KamigamiRobot.WRITE_UUID)[0]
+        self.peripheral = peripheral
+        self.mac = mac
+        if handles is None:
+            # Rediscovered; the notification handles are found again on demand.
+            self.cache.remember(mac, write_handle=self.writer.getHandle(),
+                                notify_handle=None, cccd_handle=None)
+        else:
+            self.cache.remember(mac)
+        return self
+
+    def _cached_handles(self, mac):
+        entry = self.cache.get(mac)
+        if entry is None or "write_handle" not in entry:
+            return None
+        return entry
+
+    def enable_notifications(self, delegate):
+        """
+        Install a bluepy delegate and switch notifications on for
+        NOTIFY_UUID.  Returns the notify characteristic's value handle.
+        """
+        self.peripheral.withDelegate(delegate)
+        self.delegate = delegate
+        handles = self._cached_handles(self.mac)
+        if handles is None or handles.get("cccd_handle") is None:
+            service = self.peripheral.getServiceByUUID(KamigamiRobot.MAIN_SERVICE_UUID)
+            notifier = service.getCharacteristics(KamigamiRobot.NOTIFY_UUID)[0]
+            cccd = notifier.getDescriptors(forUUID=CCCD_UUID)[0]
+            self.cache.remember(self.mac, notify_handle=notifier.getHandle(), cccd_handle=cccd.handle)
+            handles = self._cached_handles(self.mac)
+        self.peripheral.writeCharacteristic(handles["cccd_handle"], NOTIFICATIONS_ON, withResponse=True)
+        return handles["notify_handle"]
+
+    def reconnect(self, give_up_after=None):
+        """
+        Re-establish a dropped link to the same robot, retrying with
+        jittered exponential backoff, and switch notifications back on.
+        Blocking.  Gives up (re-raising the last error) after
+        give_up_after seconds, or never if None.
+        """
+        deadline = None if give_up_after is None else time.monotonic() + give_up_after
+        attempt = 0
+        while True:
+            self._drop()
+            try:
+                self._connect_to(self.mac, use_cached_handles=attempt < KamigamiSession.HANDLE_RETRIES)
+                if self.delegate is not None:
+                    self.enable_notifications(self.delegate)
+                self.reconnects += 1
+                log.info("Reconnected to %s after %d attempts.", self.mac, attempt + 1)
+                return self
+            except btle.BTLEException as error:
+                log.debug("Reconnect attempt %d to %s failed: %s", attempt + 1, self.mac, error)
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise
+            if attempt:
+                delay = min(KamigamiSession.RECONNECT_MAX_DELAY,
+                            KamigamiSession.RECONNECT_BASE_DELAY * 2 ** attempt)
+                time.sleep(random.uniform(0, delay))
+            attempt += 1
+
+    def _drop(self):
+        try:
+            if self.peripheral is not None:
+                self.peripheral.disconnect()
+        except btle.BTLEException:
+            pass
+        self.peripheral = None
+        self.writer = None
+
+    def connect_async(self, loop=None, executor=None):
+        """
+        Run connect() on an executor.  Returns a future that resolves to
+        the session, so it can be awaited after other start up work.
+        """
+        loop = loop if loop is not None else asyncio.get_event_loop()
+        return loop.run_in_executor(executor, self.connect)
+
+    def disconnect(self):
+        if self.peripheral is not None:
+            self.peripheral.disconnect()
+        self.peripheral = None
+        self.writer = None
@@ -0,0 +1,412 @@
+import asyncio
+import multiprocessing
+import random
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from KamigamiController import KamigamiController
+from KamigamiLogging import logger
+from KamigamiMerger import UnifiedTickMerger
+from KamigamiScanner import MacCache, find_robots
+from KamigamiSession import KamigamiSession
+from KamigamiTransport import AsyncBleTransport
+
+"""
+Robots sharded over worker processes, one per Bluetooth adapter, so that
+control capacity grows with adapters and cores instead of stopping at
+what one bluepy helper and one HCI adapter can do.
+
+The supervisor and the workers share two fixed layout arrays instead of
+pickling commands through queues:
+
+    command slots  one SLOT per robot with its latest motor and light
+                   state and a ring of the last ONESHOTS one-shot frames
+                   (IR, shutdown, testmode) with a counter, written by
+                   the supervisor;
+    health slots   one HEALTH per robot with its link state and write
+                   statistics, written by the worker.
+
+Each slot has one writer and is guarded by a sequence lock: the writer
+makes the sequence odd, writes the fields, then makes it even again; a
+reader retries until it sees the same even sequence before and after.
+A writer killed halfway leaves its slot odd until its restarted process
+writes it again, so readers give up after a while instead of spinning.
+A ShardSupervisor looks like a Fleet (robots, controllers, routing), so
+the Interactive handlers can drive either.
+"""
+
+log = logger("session")
+
+# One-shot frames a slot holds, so that several sent within one worker
+# tick all go out.  A power of two, so the ring index survives the
+# counter wrapping.
+ONESHOTS = 8
+# sequence, left, right, r, g, b, which state is set, one-shot counter,
+# then ONESHOTS times one-shot length and frame.  One-shot number n is
+# kept at n % ONESHOTS.
+SLOT = struct.Struct('<IbbBBBBI' + 'B4s' * ONESHOTS)
+# sequence, connected, reconnects, written, errors, one-shots lost to a
+# full ring, write latency, heartbeat (time.monotonic(), comparable
+# between processes).
+HEALTH = struct.Struct('<IIIIIIdd')
+_SEQUENCE = struct.Struct('<I')
+# Retries a reader spins through before it starts yielding the CPU, and
+# how long it keeps retrying in all.
+READ_SPINS = 100
+READ_TIMEOUT = 0.1
+# Robots a worker could not connect to are retried after a random time up
+# to base * 2**attempt seconds, capped at max.
+CONNECT_RETRY_BASE_DELAY = 1.0
+CONNECT_RETRY_MAX_DELAY = 30.0
+# Seconds a robot's writes keep reconnecting before failing, so a dropped
+# robot does not hold its one-shots (and its merger) forever.
+RECONNECT_TIMEOUT = 10.0
+
+HAS_MOTORS = 0x01
+HAS_LIGHTS = 0x02
+
+
+class SharedSlots:
+    """
+    count fixed layout records in shared memory.  Every record must only
+    ever be written by one process.
+    """
+    def __init__(self, count, layout):
+        self.count = count
+        self.layout = layout
+        self.buffer = multiprocessing.RawArray('B', count * layout.size)
+
+    def write(self, index, *fields):
+        offset = index * self.layout.size
+        # Odd even if a previous writer of this record died halfway.
+        writing = _SEQUENCE.unpack_from(self.buffer, offset)[0] | 1
+        self.layout.pack_into(self.buffer, offset, writing, *fields)
+        _SEQUENCE.pack_into(self.buffer, offset, (writing + 1) & 0xFFFFFFFF)
+
+    def read(self, index, timeout=READ_TIMEOUT):
+        """
+        A consistent copy of the record, sequence number first.  Raises
+        TimeoutError if none was seen within timeout seconds.
+        """
+        offset = index * self.layout.size
+        deadline = None
+        tries = 0
+        while True:
+            values = self.layout.unpack_from(self.buffer, offset)
+            if not values[0] & 1 and _SEQUENCE.unpack_from(self.buffer, offset)[0] == values[0]:
+                return values
+            tries += 1
+            if tries >= READ_SPINS:
+                if deadline is None:
+                    deadline = time.monotonic() + timeout
+                elif time.monotonic() >= deadline:
+                    raise TimeoutError("Slot {0} is stuck mid-write.".format(index))
+                time.sleep(0)
+
+
+class _SlotMerger:
+    """
+    Supervisor side of one robot's command slot.  Stands in for a
+    UnifiedTickMerger (set_motors/set_lights) and for a writer
+    (write_value, for one-shot frames) of a KamigamiController.
+    """
+    def __init__(self, slots, index):
+        self.slots = slots
+        self.index = index
+        self.motors = (0, 0)
+        self.lights = (0, 0, 0)
+        self.has = 0
+        self.oneshots = 0
+        self.ring = [0, b""] * ONESHOTS
+
+    def _publish(self):
+        self.slots.write(self.index, self.motors[0], self.motors[1], self.lights[0], self.lights[1],
+                         self.lights[2], self.has, self.oneshots, *self.ring)
+
+    def set_motors(self, left, right):
+        if left >= 64 or left <= -64 or right >= 64 or right <= -64:
+            raise ValueError("Please specify speeds correctly.  Speeds must be between -63 and 63, inclusive.")
+        self.motors = (left, right)
+        self.has |= HAS_MOTORS
+        self._publish()
+
+    def set_lights(self, r, g, b):
+        if not (0 <= r <= 255 and 0 <= g <= 255 and 0 <= b <= 255):
+            raise ValueError("Color values must be between 0 and 255, inclusive.")
+        self.lights = (r, g, b)
+        self.has |= HAS_LIGHTS
+        self._publish()
+
+    def write_value(self, message):
+        message = bytes(message)
+        if len(message) > 4:
+            raise ValueError("Only frames of up to 4 bytes can be sent through a shard.")
+        self.oneshots = (self.oneshots + 1) & 0xFFFFFFFF
+        slot = self.oneshots % ONESHOTS
+        self.ring[2 * slot:2 * slot + 2] = [len(message), message]
+        self._publish()
+
+
+class ShardRobot:
+    """
+    One robot as the supervisor sees it: a controller writing into its
+    command slot, and its health.
+    """
+    def __init__(self, supervisor, index, mac, adapter):
+        self.supervisor = supervisor
+        self.index = index
+        self.mac = mac
+        self.adapter = adapter
+        self.slot = _SlotMerger(supervisor.commands, index)
+        self.controller = KamigamiController(self.slot, merger=self.slot)
+
+    def health(self):
+        try:
+            sequence, connected, reconnects, written, errors, lost, latency, heartbeat = \
+                self.supervisor.health.read(self.index)
+        except TimeoutError:
+            # Its worker died while writing; watch() restarts it.
+            return {
+                "adapter": self.adapter,
+                "connected": False,
+                "reconnects": None,
+                "written": None,
+                "errors": None,
+                "lost_oneshots": None,
+                "write_latency": None,
+                "heartbeat_age": None,
+            }
+        return {
+            "adapter": self.adapter,
+            "connected": bool(connected),
+            "reconnects": reconnects,
+            "written": written,
+            "errors": errors,
+            "lost_oneshots": lost,
+            "write_latency": latency,
+            "heartbeat_age": time.monotonic() - heartbeat if heartbeat else None,
+        }
+
+    def stats(self):
+        return self.health()
+
+
+def _connect_retry_delay(attempt):
+    return random.uniform(0, min(CONNECT_RETRY_MAX_DELAY, CONNECT_RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def _run_worker(adapter, indices, macs, commands, health, write_rate, session_class, cache_path, stopping):
+    """
+    Worker process: connect this adapter's robots, then copy their
+    command slots into per-robot mergers and publish their health, every
+    tick until stopping is set.  Only each robot's merger thread writes
+    to it, so a dropped robot never holds up the others.  Robots that did
+    not connect are retried in the background with backoff and join in
+    once they do.  stopping is a shared flag rather than a
+    multiprocessing.Event, whose internal lock a killed worker could
+    leave held.
+    """
+    robots = []
+    # [index, session, failed attempts, next attempt, future]
+    pending = []
+
+    def start_robot(index, session):
+        transport = AsyncBleTransport(session.writer, session=session, reconnect_timeout=RECONNECT_TIMEOUT)
+        merger = UnifiedTickMerger(transport, rate_hz=write_rate)
+        merger.start()
+        # [index, session, transport, merger, last sequence, last one-shot,
+        #  one-shots lost]
+        robots.append([index, session, transport, merger, None, 0, 0])
+
+    for index, mac in zip(indices, macs):
+        session = session_class(mac=mac, iface=adapter, cache=MacCache(cache_path))
+        try:
+            session.connect()
+        except Exception as error:
+            log.warning("hci%d could not connect to %s, will retry: %s", adapter, mac, error)
+            pending.append([index, session, 1, time.monotonic() + _connect_retry_delay(1), None])
+            continue
+        start_robot(index, session)
+
+    # Connects block for seconds, so retries run off the tick loop.
+    connector = ThreadPoolExecutor(max_workers=1)
+    interval = 1.0 / write_rate
+    try:
+        while not stopping.value:
+            now = time.monotonic()
+            for retry in list(pending):
+                index, session, attempt, due, future = retry
+                health.write(index, 0, 0, 0, 0, 0, 0.0, now)
+                if future is None:
+                    if now >= due:
+                        retry[4] = connector.submit(session.connect)
+                    continue
+                if not future.done():
+                    continue
+                error = future.exception()
+                if error is None:
+                    pending.remove(retry)
+                    log.info("hci%d connected to %s after %d attempts.", adapter, session.mac, attempt + 1)
+                    start_robot(index, session)
+                else:
+                    log.debug("hci%d retry %d to %s failed: %s", adapter, attempt, session.mac, error)
+                    retry[2:] = [attempt + 1, now + _connect_retry_delay(attempt + 1), None]
+            for robot in robots:
+                index, session, transport, merger, last_sequence, oneshots, lost = robot
+                try:
+                    slot = commands.read(index)
+                except TimeoutError:
+                    slot = None
+                if slot is not None and slot[0] != last_sequence:
+                    sequence, left, right, r, g, b, has, count = slot[:8]
+                    robot[4] = sequence
+                    if has & HAS_MOTORS:
+                        merger.set_motors(left, right)
+                    if has & HAS_LIGHTS:
+                        merger.set_lights(r, g, b)
+                    # A restarted worker must not repeat old one-shots.
+                    if last_sequence is None:
+                        robot[5] = count
+                    elif count != oneshots:
+                        robot[5] = count
+                        new = (count - oneshots) & 0xFFFFFFFF
+                        if new > ONESHOTS:
+                            robot[6] += new - ONESHOTS
+                            log.warning("hci%d lost %d one-shots for %s.", adapter, new - ONESHOTS, session.mac)
+                            new = ONESHOTS
+                        ring = slot[8:]
+                        for number in range(count - new + 1, count + 1):
+                            position = 2 * ((number & 0xFFFFFFFF) % ONESHOTS)
+                            # On the robot's own merger thread: a write that
+                            # is reconnecting must not hold up the other robots.
+                            merger.send(ring[position + 1][:ring[position]])
+                health.write(index, int(session.connected), transport.reconnects, transport.written,
+                             transport.errors + merger.errors, robot[6], transport.write_latency, time.monotonic())
+            time.sleep(interval)
+    finally:
+        connector.shutdown(wait=False)
+        for index, session, attempt, due, future in pending:
+            if future is None or future.done():
+                session.disconnect()
+        for index, session, transport, merger, last_sequence, oneshots, lost in robots:
+            merger.stop(RECONNECT_TIMEOUT)
+            transport.close()
+            session.disconnect()
+            health.write(index, 0, transport.reconnects, transport.written, transport.errors, lost,
+                         transport.write_latency, time.monotonic())
+
+
+class ShardSupervisor:
+    """
+    Drives robots through one worker process per adapter.
+    count, macs, scan_time, cache: which robots, as for Fleet; scanning
+                                   uses the first adapter, and the
+                                   workers share cache's file.
+    adapters: HCI adapter numbers, e.g. (0, 1) for hci0 and hci1.
+              Robots are dealt out over them in turn.
+    write_rate: frames per second for each robot.
+    session_class: what the workers connect with.
+    """
+    def __init__(self, count=1, macs=None, adapters=(0,), scan_time=10.0, write_rate=40, cache=None,
+                 session_class=KamigamiSession):
+        self.count = count
+        self.macs = list(macs) if macs else []
+        self.adapters = list(adapters)
+        self.scan_time = scan_time
+        self.write_rate = write_rate
+        self.cache = cache if cache is not None else MacCache()
+        self.session_class = session_class
+        self.robots = []
+        self.routes = {}
+        self.commands = None
+        self.health = None
+        self.workers = {}
+        self.restarts = 0
+        self._stopping = multiprocessing.RawValue('B', 0)
+
+    def discover(self):
+        macs = list(self.macs)
+        for mac in self.cache.fresh():
+            if len(macs) >= self.count:
+                break
+            if mac not in macs:
+                macs.append(mac)
+        if len(macs) < self.count:
+            for mac, rssi in find_robots(self.count, self.scan_time, self.adapters[0]):
+                if mac not in macs and len(macs) < self.count:
+                    macs.append(mac)
+                    self.cache.remember(mac, rssi)
+        return macs
+
+    def _spawn(self, adapter):
+        robots = [robot for robot in self.robots if robot.adapter == adapter]
+        worker = multiprocessing.Process(
+            target=_run_worker, name="kamigami-hci{0}".format(adapter),
+            args=(adapter, [robot.index for robot in robots], [robot.mac for robot in robots],
+                  self.commands, self.health, self.write_rate, self.session_class, self.cache.path,
+                  self._stopping))
+        worker.daemon = True
+        worker.start()
+        self.workers[adapter] = worker
+
+    @asyncio.coroutine
+    def start(self, loop=None, timeout=30.0):
+        """
+        Discover robots, start the workers and wait until every robot has
+        connected or timeout runs out.  Robots that did not connect stay
+        in robots, reported as disconnected, while their worker keeps
+        retrying them.
+        """
+        loop = loop if loop is not None else asyncio.get_event_loop()
+        macs = yield from loop.run_in_executor(None, self.discover)
+        if not macs:
+            raise EnvironmentError("No Kamigami Robots found.")
+        self.commands = SharedSlots(len(macs), SLOT)
+        self.health = SharedSlots(len(macs), HEALTH)
+        self.robots = [ShardRobot(self, index, mac, self.adapters[index % len(self.adapters)])
+                       for index, mac in enumerate(macs)]
+        for adapter in self.adapters:
+            if any(robot.adapter == adapter for robot in self.robots):
+                self._spawn(adapter)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if all(robot.health()["connected"] for robot in self.robots):
+                break
+            yield from asyncio.sleep(0.1)
+        return self
+
+    @asyncio.coroutine
+    def watch(self, interval=1.0):
+        """
+        Restart workers that died, e.g. after a bluepy helper crash.
+        """
+        while not self._stopping.value:
+            yield from asyncio.sleep(interval)
+            for adapter, worker in list(self.workers.items()):
+                if not worker.is_alive() and not self._stopping.value:
+                    log.warning("Worker for hci%d exited with %s, restarting.", adapter, worker.exitcode)
+                    self.restarts += 1
+                    self._spawn(adapter)
+
+    def assign(self, control_id, robot_index):
+        self.routes[control_id] = robot_index
+
+    def robot_index_for(self, control_id):
+        return self.routes.get(control_id, control_id) % len(self.robots)
+
+    def robot_for(self, control_id):
+        return self.robots[self.robot_index_for(control_id)]
+
+    def close(self, timeout=5.0):
+        self._stopping.value = 1
+        for worker in self.workers.values():
+            worker.join(timeout)
+            if worker.is_alive():
+                worker.terminate()
+        self.workers = {}
+
+    def stats(self):
+        stats = dict((robot.mac, robot.stats()) for robot in self.robots)
+        stats["restarts"] = self.restarts
+        return stats
@@ -0,0 +1,275 @@
+import collections
+import threading
+import time
+import numpy as np
+
+from KamigamiData import KamigamiByteFormatter, KamigamiRobot, UnifiedPacket
+from KamigamiFakes import FakeCharacteristic, FakePeripheral
+from KamigamiScanner import MacCache
+from KamigamiSession import KamigamiSession
+from KamigamiTelemetry import IMU_DTYPE, IMU_NOTIFICATION, LUX_DTYPE, LUX_NOTIFICATION
+
+"""
+Simulated robots, for load tests and benchmarks at fleet scale on one
+machine.  A RobotWorld keeps the state of every robot in NumPy arrays and
+steps them all at once: frames written to a robot are decoded into its
+motor, light and mode state, a differential drive model moves it, and
+IMU and lux notifications come out at each robot's notification rates
+(KamigamiRobot.Settings until a STICKY_PACKET_SET changes them).
+
+SimulatedPeripheral offers the bluepy Peripheral surface the rest of the
+code uses, so a SimulatedSession drops into a Fleet in place of a
+KamigamiSession.  Notifications use the layout KamigamiTelemetry assumes.
+"""
+
+# Metres per second of wheel speed at motor speed 1, and wheel spacing.
+SPEED_PER_UNIT = 0.005
+WHEEL_BASE = 0.06
+# IMU units per m/s^2 and per rad/s.
+ACCEL_SCALE = 1000.0
+GYRO_SCALE = 1000.0
+
+_IMU_MESSAGE = np.dtype([('id', 'u1')] + IMU_DTYPE.descr[1:])
+_LUX_MESSAGE = np.dtype([('id', 'u1')] + LUX_DTYPE.descr[1:])
+
+
+class RobotWorld:
+    """
+    State of count simulated robots.  Thread safe: radio threads apply
+    frames while the stepping thread moves the robots.
+    """
+    def __init__(self, count, seed=0):
+        self.count = count
+        self.rng = np.random.RandomState(seed)
+        self.x = np.zeros(count)
+        self.y = np.zeros(count)
+        self.heading = np.zeros(count)
+        self.velocity = np.zeros(count)
+        self.motors = np.zeros((count, 2), dtype=np.int16)
+        self.lights = np.zeros((count, 3), dtype=np.uint8)
+        self.testmode = np.zeros(count, dtype=np.int16)
+        self.on = np.ones(count, dtype=bool)
+        self.ir_shots = np.zeros(count, dtype=np.int64)
+        self.rates = np.tile(np.array([KamigamiRobot.Settings.IMU_NOTIFY_PER_SECOND,
+                                       KamigamiRobot.Settings.LUX_NOTIFY_PER_SECOND], dtype=float), (count, 1))
+        self._due = np.zeros((count, 2))
+        self._imu = np.zeros(count, dtype=_IMU_MESSAGE)
+        self._imu['id'] = IMU_NOTIFICATION
+        self._lux = np.zeros(count, dtype=_LUX_MESSAGE)
+        self._lux['id'] = LUX_NOTIFICATION
+        self.notifications = [collections.deque() for _ in range(count)]
+        self.notifying = np.zeros(count, dtype=bool)
+        self._lock = threading.Lock()
+        self.frames = 0
+        self.malformed = 0
+
+    def apply(self, index, frame):
+        """
+        Decode one frame written to robot index.
+        """
+        frame = bytes(frame)
+        identifier = frame[0] if frame else None
+        if KamigamiByteFormatter.FRAME_SIZES.get(identifier) != len(frame):
+            with self._lock:
+                self.malformed += 1
+            return
+        Identifiers = KamigamiRobot.Identifiers
+        with self._lock:
+            self.frames += 1
+            if identifier == Identifiers.MOTOR_PACKET:
+                _, left, right = KamigamiByteFormatter.MOTOR_STRUCT.unpack(frame)
+                self.motors[index] = (left, right)
+                self.testmode[index] = 0
+            elif identifier == Identifiers.LIGHT_PACKET:
+                self.lights[index] = KamigamiByteFormatter.LIGHT_STRUCT.unpack(frame)[1:]
+            elif identifier == Identifiers.UNIFIED_PACKET:
+                flags = frame[UnifiedPacket.FLAGS_OFFSET]
+                if flags & UnifiedPacket.MOTOR_FLAG:
+                    self.motors[index] = UnifiedPacket.MOTOR_STRUCT.unpack_from(frame, UnifiedPacket.MOTOR_OFFSET)
+                    self.testmode[index] = 0
+                if flags & UnifiedPacket.LIGHT_FLAG:
+                    self.lights[index] = UnifiedPacket.LIGHT_STRUCT.unpack_from(frame, UnifiedPacket.LIGHT_OFFSET)
+            elif identifier == Identifiers.IR_PACKET:
+                self.ir_shots[index] += 1
+            elif identifier == Identifiers.TEST_MODE:
+                self.testmode[index] = KamigamiByteFormatter.TESTMODE_STRUCT.unpack(frame)[2]
+            elif identifier == Identifiers.STICKY_PACKET_SET:
+                self.rates[index] = KamigamiByteFormatter.STICKY_STRUCT.unpack(frame)[1:3]
+            elif identifier == Identifiers.SHUTDOWN:
+                self.on[index] = False
+                self.motors[index] = 0
+                self.testmode[index] = 0
+
+    def step(self, dt):
+        """
+        Advance every robot by dt seconds and queue the notifications due.
+        """
+        with self._lock:
+            # Test mode runs both motors at the test speed.
+            testing = self.testmode != 0
+            left = np.where(testing, self.testmode, self.motors[:, 0]) * self.on
+            right = np.where(testing, self.testmode, self.motors[:, 1]) * self.on
+            velocity = (left + right) * (SPEED_PER_UNIT / 2)
+            turn_rate = (right - left) * (SPEED_PER_UNIT / WHEEL_BASE)
+            acceleration = (velocity - self.velocity) / dt
+            self.velocity = velocity
+            self.heading += turn_rate * dt
+            self.x += velocity * np.cos(self.heading) * dt
+            self.y += velocity * np.sin(self.heading) * dt
+
+            self._due += self.rates * dt * self.on[:, None]
+            counts = np.floor(self._due).astype(np.int64)
+            self._due -= counts
+            counts *= self.notifying[:, None]
+            if not counts.any():
+                return
+
+            noise = self.rng.normal(0.0, 5.0, (self.count, 6))
+            imu = self._imu
+            imu['accel'][:, 0] = np.clip(acceleration * ACCEL_SCALE + noise[:, 0], -32768, 32767)
+            imu['accel'][:, 1] = np.clip(velocity * turn_rate * ACCEL_SCALE + noise[:, 1], -32768, 32767)
+            imu['accel'][:, 2] = np.clip(9.81 * ACCEL_SCALE + noise[:, 2], -32768, 32767)
+            imu['gyro'][:, 0] = noise[:, 3]
+            imu['gyro'][:, 1] = noise[:, 4]
+            imu['gyro'][:, 2] = np.clip(turn_rate * GYRO_SCALE + noise[:, 5], -32768, 32767)
+            lux = self._lux
+            lux['lux'] = np.clip(200 + self.lights.sum(axis=1) + self.rng.normal(0.0, 3.0, self.count), 0, 65535)
+
+            imu_bytes = imu.tobytes()
+            lux_bytes = lux.tobytes()
+            for index in np.nonzero(counts.any(axis=1))[0]:
+                queue = self.notifications[index]
+                imu_message = imu_bytes[index * imu.itemsize:(index + 1) * imu.itemsize]
+                lux_message = lux_bytes[index * lux.itemsize:(index + 1) * lux.itemsize]
+                queue.extend([imu_message] * counts[index, 0])
+                queue.extend([lux_message] * counts[index, 1])
+
+    def run(self, rate_hz=100):
+        """
+        Step in real time on a daemon thread.  Returns the thread; set
+        its stopping event to end it.
+        """
+        thread = threading.Thread(target=self._run, args=(1.0 / rate_hz,), name="kamigami-world")
+        thread.daemon = True
+        thread.stopping = threading.Event()
+        self._thread = thread
+        thread.start()
+        return thread
+
+    def _run(self, interval):
+        stopping = self._thread.stopping
+        last = time.monotonic()
+        while not stopping.wait(interval):
+            now = time.monotonic()
+            self.step(now - last)
+            last = now
+
+    def macs(self):
+        return [mac_for(index) for index in range(self.count)]
+
+    def peripheral(self, index, latency=0.0):
+        return SimulatedPeripheral(self, index, latency)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "frames": self.frames,
+                "malformed": self.malformed,
+                "on": int(self.on.sum()),
+                "moving": int((self.velocity != 0).sum()),
+                "ir_shots": int(self.ir_shots.sum()),
+                "queued_notifications": sum(len(queue) for queue in self.notifications),
+            }
+
+
+def mac_for(index):
+    return "5A:00:00:00:{0:02X}:{1:02X}".format(index >> 8, index & 0xFF)
+
+
+def index_for(mac):
+    parts = mac.split(":")
+    return int(parts[4], 16) << 8 | int(parts[5], 16)
+
+
+class SimulatedCharacteristic(FakeCharacteristic):
+    """
+    Write characteristic that hands every frame to the world.
+    """
+    def __init__(self, uuid, handle, world, index, latency=0.0):
+        FakeCharacteristic.__init__(self, uuid, handle, latency)
+        self.world = world
+        self.index = index
+
+    def write(self, val, withResponse=False):
+        if withResponse and self.latency:
+            time.sleep(self.latency)
+        self.world.apply(self.index, val)
+
+
+class SimulatedPeripheral(FakePeripheral):
+    """
+    One robot of a RobotWorld behind the bluepy Peripheral interface.
+    """
+    def __init__(self, world, index, latency=0.0):
+        FakePeripheral.__init__(self, mac_for(index), latency=latency)
+        self.world = world
+        self.index = index
+        self.writer = SimulatedCharacteristic(KamigamiRobot.WRITE_UUID, self.writer.handle, world, index, latency)
+        self.service.characteristics[0] = self.writer
+        self.cccd_handle = self.notifier.getDescriptors()[0].handle
+
+    def writeCharacteristic(self, handle, val, withResponse=False):
+        if handle == self.writer.handle:
+            self.writer.write(val, withResponse)
+        elif handle == self.cccd_handle:
+            self.world.notifying[self.index] = bytes(val)[:1] == b"\x01"
+        else:
+            FakePeripheral.writeCharacteristic(self, handle, val, withResponse)
+
+    def waitForNotifications(self, timeout):
+        """
+        Deliver the oldest queued notification to the delegate.  Like
+        bluepy, waits up to timeout for one, handles at most one per call
+        and returns whether it came.
+        """
+        queue = self.world.notifications[self.index]
+        deadline = time.monotonic() + timeout
+        while not queue:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.001)
+        data = queue.popleft()
+        if self.delegate is not None:
+            self.delegate.handleNotification(self.notifier.handle, data)
+        return True
+
+    def disconnect(self):
+        FakePeripheral.disconnect(self)
+        self.world.notifying[self.index] = False
+
+
+class SimulatedSession(KamigamiSession):
+    """
+    KamigamiSession that connects to a robot of SimulatedSession.world,
+    picked by its address (see RobotWorld.macs()).  Its address is only
+    remembered in memory unless a cache is given.
+    """
+    world = None
+    latency = 0.0
+
+    def __init__(self, mac=None, cache=None, **kwargs):
+        KamigamiSession.__init__(self, mac=mac, cache=cache if cache is not None else MacCache(path=None), **kwargs)
+
+    def _connect_to(self, mac, use_cached_handles=True):
+        self.peripheral = self.world.peripheral(index_for(mac), self.latency)
+        self.writer = self.peripheral.writer
+        self.mac = mac
+        self.cache.remember(mac, write_handle=self.writer.getHandle(), notify_handle=None, cccd_handle=None)
+        return self
+
+
+def session_class(world, latency=0.0):
+    """
+    A SimulatedSession subclass bound to world, for Fleet(session_class=...).
+    """
+    return type("SimulatedSession", (SimulatedSession,), {"world": world, "latency": latency})
@@ -0,0 +1,183 @@
+import asyncio
+import struct
+import time
+import numpy as np
+from bluepy import btle
+
+from KamigamiData import KamigamiRobot
+from KamigamiLogging import logger
+
+"""
+Robot telemetry.  Notifications from NOTIFY_UUID are copied straight into
+preallocated NumPy ring buffers, one structured array per sample kind, so
+memory stays fixed for a whole match and no Python object is kept per
+sample.  Readers get views of the most recent samples without copying.
+
+The notification layout is not documented by the robot.  Everything this
+module assumes about it is in the IMU_* and LUX_* constants below: one
+identifier byte followed by little-endian fields.
+"""
+
+IMU_NOTIFICATION = 0x0A
+LUX_NOTIFICATION = 0x0B
+
+# Sample fields after the identifier byte; 't' is filled in on arrival.
+IMU_DTYPE = np.dtype([('t', '<f8'), ('accel', '<i2', (3,)), ('gyro', '<i2', (3,))])
+LUX_DTYPE = np.dtype([('t', '<f8'), ('lux', '<u2')])
+
+_TIMESTAMP = struct.Struct('<d')
+
+# Most notifications handled per poll, so a flood cannot hold the radio
+# thread (and the writes queued behind the poll) for long.
+MAX_NOTIFICATIONS_PER_POLL = 64
+
+log = logger("telemetry")
+
+
+class RingBuffer:
+    """
+    Fixed size ring of samples of a structured dtype whose first field is
+    an '<f8' timestamp.  Every sample is written twice, capacity apart, so
+    that any window of up to capacity samples is one contiguous slice.
+    """
+    def __init__(self, dtype, capacity):
+        self.dtype = dtype
+        self.capacity = capacity
+        self._data = np.zeros(capacity * 2, dtype=dtype)
+        self._raw = memoryview(self._data.view(np.uint8))
+        self._payload_size = dtype.itemsize - _TIMESTAMP.size
+        self.count = 0
+
+    def append(self, timestamp, payload):
+        """
+        Store one sample.  payload holds every field after the timestamp,
+        in the dtype's byte layout.
+        """
+        if len(payload) != self._payload_size:
+            raise ValueError("Expected {0} payload bytes, got {1}.".format(self._payload_size, len(payload)))
+        index = self.count % self.capacity
+        itemsize = self.dtype.itemsize
+        for offset in (index * itemsize, (index + self.capacity) * itemsize):
+            _TIMESTAMP.pack_into(self._raw, offset, timestamp)
+            self._raw[offset + _TIMESTAMP.size:offset + itemsize] = payload
+        self.count += 1
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def window(self, size=None):
+        """
+        View of the last `size` samples (all retained samples by default),
+        oldest first.  The view is overwritten as new samples arrive.
+        """
+        available = len(self)
+        size = available if size is None else min(size, available)
+        end = self.count % self.capacity + (self.capacity if self.count >= self.capacity else 0)
+        return self._data[end - size:end]
+
+    def since(self, timestamp):
+        """
+        View of the retained samples newer than timestamp.
+        """
+        samples = self.window()
+        return samples[np.searchsorted(samples['t'], timestamp, side='right'):]
+
+    def latest(self):
+        return self.window(1)[0] if self.count else None
+
+
+class TelemetryDelegate(btle.DefaultDelegate):
+    """
+    bluepy delegate that routes notifications into the telemetry buffers.
+    """
+    def __init__(self, telemetry):
+        btle.DefaultDelegate.__init__(self)
+        self.telemetry = telemetry
+        self.notify_handle = None
+
+    def handleNotification(self, cHandle, data):
+        if self.notify_handle is not None and cHandle != self.notify_handle:
+            return
+        self.telemetry.handle(data)
+
+
+class KamigamiTelemetry:
+    """
+    Ring buffers for one robot's notifications, sized in seconds at the
+    rates in KamigamiRobot.Settings.
+    """
+    def __init__(self, seconds=600):
+        self.imu = RingBuffer(IMU_DTYPE, seconds * KamigamiRobot.Settings.IMU_NOTIFY_PER_SECOND)
+        self.lux = RingBuffer(LUX_DTYPE, seconds * KamigamiRobot.Settings.LUX_NOTIFY_PER_SECOND)
+        self.buffers = {
+            IMU_NOTIFICATION: self.imu,
+            LUX_NOTIFICATION: self.lux,
+        }
+        self.delegate = TelemetryDelegate(self)
+        self.session = None
+        # How often poll_notifications polls; a rate controller may change it.
+        self.poll_interval = 1.0 / (2 * KamigamiRobot.Settings.IMU_NOTIFY_PER_SECOND)
+        self.unknown = 0
+        self.malformed = 0
+        self.poll_errors = 0
+
+    def handle(self, data):
+        buffer = self.buffers.get(data[0]) if data else None
+        if buffer is None:
+            self.unknown += 1
+            return
+        try:
+            buffer.append(time.monotonic(), memoryview(data)[1:])
+        except ValueError:
+            self.malformed += 1
+
+    def attach(self, session):
+        """
+        Turn notifications on for a connected KamigamiSession.
+        """
+        self.delegate.notify_handle = session.enable_notifications(self.delegate)
+        self.session = session
+        return self
+
+    def poll(self, timeout=0.0, limit=MAX_NOTIFICATIONS_PER_POLL):
+        """
+        Handle the notifications waiting, up to limit.  bluepy hands over
+        one notification per waitForNotifications() call, so this keeps
+        calling it until none is left.  Blocking for up to timeout for
+        the first one; must run on the same thread as the session's
+        writes.  Returns how many were handled.
+        """
+        peripheral = self.session.peripheral
+        handled = 0
+        while handled < limit and peripheral.waitForNotifications(timeout if not handled else 0.0):
+            handled += 1
+        return handled
+
+    def stats(self):
+        return {
+            "imu": self.imu.count,
+            "lux": self.lux.count,
+            "unknown": self.unknown,
+            "malformed": self.malformed,
+            "poll_errors": self.poll_errors,
+        }
+
+
+@asyncio.coroutine
+def poll_notifications(telemetry, transport, interval=None):
+    """
+    Keep handling notifications on the transport's radio thread, so they
+    interleave with writes instead of racing them.  Without an interval,
+    follows telemetry.poll_interval.  Polls are skipped while the session
+    is disconnected; a link that drops mid poll is left to the transport
+    to reconnect, and polling carries on afterwards.
+    """
+    while True:
+        if telemetry.session.connected:
+            try:
+                yield from transport.call(telemetry.poll, 0.0)
+            except (btle.BTLEException, AttributeError) as error:
+                # AttributeError: the peripheral went away while reconnecting.
+                telemetry.poll_errors += 1
+                log.debug("Notification poll failed: %r", error)
+        yield from asyncio.sleep(interval if interval is not None else telemetry.poll_interval)
@@ -0,0 +1,214 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from bluepy.btle import BTLEException
+
+from KamigamiMetrics import clock
+
+"""
+asyncio front end for the bluepy write characteristic.  bluepy calls block
+for a full GATT round trip, so every write is run on one dedicated thread
+(which also keeps them serialized, as bluepy is not thread safe) while the
+event loop keeps reading Interactive packets.
+
+Given its KamigamiSession, the transport also recovers a dropped link: the
+failed write triggers session.reconnect() on the radio thread, and the
+frames waiting meanwhile are either held and sent afterwards or discarded.
+"""
+
+
+class AsyncBleTransport:
+    """
+    characteristic: bluepy Characteristic (or anything with
+                    write(data, withResponse)).
+    loop: event loop for write and write_nowait; the current one when
+          start() is called if None.  write_value needs none.
+    max_queue: writes allowed to wait for the radio before callers are
+               made to wait (write) or refused (write_nowait).
+    with_response: False uses write-without-response, which does not
+                   wait for the robot to acknowledge each packet.
+    metrics: optional Metrics to record write times in.
+    recorder: optional KamigamiRecorder to log every written frame to,
+              tagged with channel.
+    session: KamigamiSession to reconnect through when a write fails.
+    on_reconnect: HOLD to send the failed frame and everything queued once
+                  the link is back, DISCARD to drop them.
+    reconnect_timeout: seconds to keep trying before giving up, or None.
+    """
+    HOLD = "hold"
+    DISCARD = "discard"
+
+    def __init__(self, characteristic, loop=None, max_queue=16, with_response=True, metrics=None,
+                 recorder=None, channel=0, session=None, on_reconnect=HOLD, reconnect_timeout=None):
+        self.characteristic = characteristic
+        self.session = session
+        self.on_reconnect = on_reconnect
+        self.reconnect_timeout = reconnect_timeout
+        self.metrics = metrics
+        self.recorder = recorder
+        self.channel = channel
+        self.loop = loop
+        self.max_queue = max_queue
+        self.with_response = with_response
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._queue = None
+        self._task = None
+
+        # Moving average of successful write times, in seconds.  Only the
+        # writes themselves count, not reconnecting; a new link starts a
+        # new average.
+        self.write_latency = 0.0
+        self._latency_samples = 0
+
+        self.written = 0
+        self.errors = 0
+        self.rejected = 0
+        self.reconnects = 0
+        self.discarded = 0
+
+    def start(self):
+        if self.loop is None:
+            self.loop = asyncio.get_event_loop()
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._task = self.loop.create_task(self._drain())
+        return self
+
+    @asyncio.coroutine
+    def write(self, frame):
+        """
+        Queue a frame, waiting for room if the queue is full, and wait
+        until it has been written.
+        """
+        done = asyncio.Future(loop=self.loop)
+        yield from self._queue.put((bytes(frame), done))
+        return (yield from done)
+
+    def write_nowait(self, frame):
+        """
+        Queue a frame without waiting.  Raises asyncio.QueueFull when the
+        radio is too far behind.  Returns a future for the write.
+        """
+        done = asyncio.Future(loop=self.loop)
+        self._queue.put_nowait((bytes(frame), done))
+        return done
+
+    def write_value(self, frame):
+        """
+        Blocking write for use from threads other than the event loop's,
+        such as a MailboxWriter.  Shares the same radio thread.
+        """
+        return self._executor.submit(self._write, bytes(frame)).result()
+
+    @asyncio.coroutine
+    def call(self, function, *args):
+        """
+        Run any other bluepy call (notifications, reads) on the radio
+        thread so it is serialized with the writes.
+        """
+        loop = self.loop if self.loop is not None else asyncio.get_event_loop()
+        return (yield from loop.run_in_executor(self._executor, function, *args))
+
+    @property
+    def depth(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def _write(self, frame):
+        started = clock()
+        try:
+            self.characteristic.write(frame, withResponse=self.with_response)
+        except BTLEException:
+            self.errors += 1
+            if self.metrics is not None:
+                self.metrics.count("write_errors")
+            if self.session is None:
+                raise
+            self._recover()
+            if self.on_reconnect == AsyncBleTransport.DISCARD:
+                self.discarded += 1
+                raise
+            started = clock()
+            self.characteristic.write(frame, withResponse=self.with_response)
+        elapsed = clock() - started
+        if self._latency_samples:
+            self.write_latency += (elapsed - self.write_latency) * 0.2
+        else:
+            self.write_latency = elapsed
+        self._latency_samples += 1
+        self.written += 1
+        if self.recorder is not None:
+            self.recorder.record_write(frame, self.channel)
+        if self.metrics is not None:
+            self.metrics.stage("write").record(elapsed)
+            self.metrics.count("writes")
+
+    def _recover(self):
+        """
+        Runs on the radio thread, so nothing else is written meanwhile.
+        """
+        recovering = clock()
+        self.session.reconnect(give_up_after=self.reconnect_timeout)
+        self.characteristic = self.session.writer
+        self.reconnects += 1
+        self._latency_samples = 0
+        if self.metrics is not None:
+            self.metrics.stage("reconnect").since(recovering)
+            self.metrics.count("reconnects")
+        if self.on_reconnect == AsyncBleTransport.DISCARD and self._queue is not None:
+            self.loop.call_soon_threadsafe(self._discard_queued)
+
+    def _discard_queued(self):
+        while not self._queue.empty():
+            frame, done = self._queue.get_nowait()
+            self.discarded += 1
+            if not done.done():
+                done.set_exception(ConnectionError("Discarded while reconnecting to the robot."))
+
+    @asyncio.coroutine
+    def _drain(self):
+        while True:
+            frame, done = yield from self._queue.get()
+            try:
+                yield from self.loop.run_in_executor(self._executor, self._write, frame)
+            except Exception as error:
+                if not done.done():
+                    done.set_exception(error)
+            else:
+                if not done.done():
+                    done.set_result(None)
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+        self._executor.shutdown(wait=False)
+
+    def stats(self):
+        return {
+            "written": self.written,
+            "errors": self.errors,
+            "rejected": self.rejected,
+            "reconnects": self.reconnects,
+            "discarded": self.discarded,
+            "depth": self.depth,
+            "write_latency": self.write_latency,
+        }
+
+
+class NonBlockingWriter:
+    """
+    write_value adapter for code running on the event loop (for example a
+    KamigamiController used by the Interactive handlers).  Frames are
+    queued on the transport; when it is full they are counted as rejected
+    and dropped rather than stalling the loop.
+    """
+    def __init__(self, transport):
+        self.transport = transport
+
+    def write_value(self, message):
+        try:
+            done = self.transport.write_nowait(message)
+        except asyncio.QueueFull:
+            self.transport.rejected += 1
+            return None
+        # Nobody awaits these; fetch the exception so it is not reported
+        # as never retrieved.
+        done.add_done_callback(lambda future: future.cancelled() or future.exception())
+        return done
@@ -0,0 +1,205 @@
+"""
+Benchmarks for the control path, runnable with no radio and no network.
+
+    python benchmark.py               run everything, fail on a regression
+    python benchmark.py encode_motor  only run the named benchmarks
+    python benchmark.py --report-only report regressions without failing
+    python benchmark.py --update      store the results as the new baselines
+
+Every benchmark runs --runs times and each metric is the median of the
+runs.  Metrics ending in _per_sec that drop, and metrics ending in _ms
+that rise, by more than --tolerance against benchmark_baseline.json are
+regressions, and make the exit status 1.  The baselines are from one
+machine; elsewhere, use --report-only or record new ones with --update.
+"""
+
+from __future__ import print_function
+import argparse
+import asyncio
+import json
+import os
+import sys
+import timeit
+
+from KamigamiData import KamigamiByteFormatter, UnifiedPacket
+from KamigamiController import KamigamiController
+from KamigamiFakes import FakeCharacteristic, FakeInteractiveConnection, FakeSession
+from KamigamiFleet import Fleet, FleetRobot
+from KamigamiMetrics import Metrics
+from KamigamiScanner import MacCache
+import KamigamiCli
+from KamigamiSimulator import RobotWorld
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+
+
+def _ops_per_sec(function, number):
+    # Best of three, to keep scheduler noise out of the baseline.
+    best = min(timeit.repeat(function, number=number, repeat=3))
+    return number / best
+
+
+def bench_encode_motor():
+    encode = KamigamiByteFormatter.get_sendable_motor_packet
+    return {"ops_per_sec": _ops_per_sec(lambda: encode(-31, 45), 200000)}
+
+
+def bench_encode_unified():
+    packet = UnifiedPacket()
+
+    def update():
+        packet.set_motors(31, 45)
+        packet.set_lights(255, 127, 0)
+        return packet.view()
+
+    return {"ops_per_sec": _ops_per_sec(update, 100000)}
+
+
+def bench_cli_dispatch():
+    robot = KamigamiController(KamigamiCli.AdaptedWriter(FakeCharacteristic(None, 0)))
+    tokens = ["motors", "10", "-10"]
+    return {"ops_per_sec": _ops_per_sec(lambda: KamigamiCli.do_cli(robot, tokens), 100000)}
+
+
+def bench_world_step():
+    # A few hundred robots, all streaming telemetry.
+    world = RobotWorld(500)
+    world.notifying[:] = True
+
+    def step():
+        world.step(0.01)
+        for queue in world.notifications:
+            queue.clear()
+
+    return {"steps_per_sec": _ops_per_sec(step, 200)}
+
+
+def _run_reports(reports, rate_hz, joysticks, latency):
+    """
+    Feed synthetic reports through index.handle_packets/on_report into a
+    fleet of one fake robot.
+    """
+    import index
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    metrics = index.METRICS = Metrics()
+    cache = MacCache(path=None)
+    session = FakeSession(latency=latency, cache=cache).connect()
+    fleet = index.FLEET = Fleet(count=1, cache=cache, metrics=metrics)
+    fleet.robots.append(FleetRobot(session, loop, write_rate=1000, metrics=metrics))
+    connection = FakeInteractiveConnection(reports, rate_hz=rate_hz, joysticks=joysticks)
+    try:
+        started = loop.time()
+        loop.run_until_complete(index.handle_packets(connection))
+        elapsed = loop.time() - started
+        # Let the last command reach the fake radio.
+        loop.run_until_complete(asyncio.sleep(0.05))
+    finally:
+        fleet.close()
+        # Let the cancelled transport tasks finish.
+        loop.run_until_complete(asyncio.sleep(0))
+        loop.close()
+    end_to_end = metrics.stage("end_to_end")
+    return {
+        "reports_per_sec": reports / elapsed,
+        "end_to_end_p50_ms": end_to_end.percentile(50) * 1e3,
+        "end_to_end_p99_ms": end_to_end.percentile(99) * 1e3,
+    }
+
+
+def bench_report_throughput():
+    results = _run_reports(5000, None, joysticks=8, latency=0.0)
+    return {"reports_per_sec": results["reports_per_sec"]}
+
+
+def bench_report_latency():
+    # A 5ms radio and reports at 100Hz, roughly a busy stream.
+    results = _run_reports(500, 100, joysticks=8, latency=0.005)
+    del results["reports_per_sec"]
+    return results
+
+
+BENCHMARKS = {
+    "encode_motor": bench_encode_motor,
+    "encode_unified": bench_encode_unified,
+    "cli_dispatch": bench_cli_dispatch,
+    "report_throughput": bench_report_throughput,
+    "report_latency": bench_report_latency,
+    "world_step": bench_world_step,
+}
+
+
+def run(benchmark, runs):
+    """
+    Median of each metric over runs runs of benchmark.
+    """
+    samples = [benchmark() for _ in range(runs)]
+    return dict((metric, _median([sample[metric] for sample in samples])) for metric in samples[0])
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
+
+
+def compare(name, results, baseline, tolerance):
+    """
+    Returns a list of regression messages.
+    """
+    regressions = []
+    for metric, value in sorted(results.items()):
+        expected = baseline.get(metric)
+        if expected is None:
+            continue
+        if metric.endswith("_per_sec") and value < expected * (1 - tolerance):
+            regressions.append("{0}.{1}: {2:.1f} < baseline {3:.1f}".format(name, metric, value, expected))
+        elif metric.endswith("_ms") and value > expected * (1 + tolerance):
+            regressions.append("{0}.{1}: {2:.3f} > baseline {3:.3f}".format(name, metric, value, expected))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('names', nargs='*', help='Benchmarks to run.  Default all.')
+    parser.add_argument('--update', action='store_true',
+                        help='Store the results as the new baselines.')
+    parser.add_argument('--report-only', action='store_true',
+                        help='Only print regressions; exit with status 0 anyway.')
+    parser.add_argument('--runs', type=int, default=3,
+                        help='Runs of each benchmark to take the median of.  Default 3.')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Allowed fraction of slow down before reporting.  Default 0.25.')
+    args = parser.parse_args()
+
+    try:
+        with open(BASELINE_PATH) as baseline_file:
+            baselines = json.load(baseline_file)
+    except (IOError, OSError):
+        baselines = {}
+
+    regressions = []
+    for name in args.names or sorted(BENCHMARKS):
+        results = run(BENCHMARKS[name], args.runs)
+        print("{0:<20} {1}".format(name, "  ".join(
+            "{0}={1:.3f}".format(metric, value) for metric, value in sorted(results.items()))))
+        if args.update:
+            baselines[name] = results
+        elif name in baselines:
+            regressions.extend(compare(name, results, baselines[name], args.tolerance))
+        else:
+            print("{0:<20} no baseline, run with --update to record one".format(""))
+
+    if args.update:
+        with open(BASELINE_PATH, "w") as baseline_file:
+            json.dump(baselines, baseline_file, indent=2, sort_keys=True)
+            baseline_file.write("\n")
+
+    for regression in regressions:
+        print("slower:" if args.report_only else "REGRESSION", regression)
+    return 1 if regressions and not args.report_only else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
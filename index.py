@@ -1,18 +1,22 @@
-"""Move the mouse based on Beam Interactive controls."""
+"""Drive Kamigami Robots based on Beam Interactive controls."""
 
 import asyncio
 #import auth_info
 import bluepy
 
-from urllib.parse import urljoin
-
-from math import isnan
-
-from beam_interactive import start, proto
-from requests import Session
-from pymouse import PyMouse
+from beam_interactive import proto
 
 import KamigamiCli
+from KamigamiActions import ActionScheduler
+from KamigamiBeam import BeamApi, BeamSessionCache, InteractiveLink
+from KamigamiFleet import Fleet
+from KamigamiJoystick import JoystickAggregator
+import KamigamiLogging
+from KamigamiMetrics import Metrics, clock, report_periodically, serve
+from KamigamiRecorder import KamigamiLog, KamigamiRecorder, ReplayConnection
+from KamigamiScanner import MacCache
+from KamigamiSession import KamigamiSession
+from KamigamiShards import ShardSupervisor
 
 URL = "https://beam.pro/api/v1/"
 
@@ -22,98 +26,235 @@ AUTHENTICATION = {
     #"code": "2FA-CODE"  # Unnecessary if two-factor authentication is disabled.
 }
 
-SESSION = Session()
-MOUSE = PyMouse()
-
-
-def _build(endpoint, *, url=URL):
-    """Build an address for an API endpoint."""
-    return urljoin(url, endpoint.lstrip('/'))
-
-
-def login(username, password, code='', *, session=SESSION):
-    """Log into Beam via the API."""
-    auth = dict(username=username, password=password, code=code)
-    return session.post(_build("/users/login"), data=auth).json()
+# Seconds to reuse a Beam login (across restarts) and an Interactive key
+# (across reconnects) before asking the API again, and the longest wait
+# between attempts to reconnect to Interactive.
+BEAM_SESSION_TTL = 24 * 60 * 60
+INTERACTIVE_KEY_TTL = 5 * 60
+INTERACTIVE_MAX_BACKOFF = 30.0
+
+# Motor commands sent to each robot per second.  Joystick reports that
+# arrive faster than this only replace the command waiting to be sent.
+MOTOR_WRITE_RATE = 40
+
+# Number of robots to drive, and which robot each joystick/button id
+# controls.  Controls that are not listed are spread over the robots by id.
+ROBOT_COUNT = 1
+CONTROL_ROUTES = {}
+
+# How the joysticks driving one robot are combined ("mean", "weighted" or
+# "median"), and the motor speed for a full joystick deflection.
+JOYSTICK_POLICY = "mean"
+JOYSTICK_DEADZONE = 0.1
+JOYSTICK_SCALE = 10
+JOYSTICK_WEIGHTS = {}
+
+# Robot action for each tactile (button) id, by name from
+# KamigamiActions.ACTIONS.  The button presses the robot its id routes to.
+TACTILE_ACTIONS = {
+    0: "kick",
+    1: "red",
+    2: "blue",
+    3: "spin",
+}
 
+# Seconds between latency summaries, and the port to serve them on for
+# scraping (None to not serve them).
+METRICS_INTERVAL = 60
+METRICS_PORT = None
+
+# Record IMU and lux notifications from every robot, and whether to lower
+# their rates on congested links.  Adapting writes STICKY_PACKET_SET
+# frames in a layout that has not been confirmed on a robot yet.
+ROBOT_TELEMETRY = True
+ADAPT_TELEMETRY = False
+
+# Log levels, overridable with --log, e.g. "INFO,interactive=DEBUG", and
+# how many records per second each message may log before being sampled.
+LOG_LEVELS = "INFO"
+LOG_RATE = 10.0
+
+METRICS = Metrics()
+JOYSTICKS = JoystickAggregator(policy=JOYSTICK_POLICY, deadzone=JOYSTICK_DEADZONE,
+                               scale=JOYSTICK_SCALE, weights=JOYSTICK_WEIGHTS)
+BUTTONS = ActionScheduler(TACTILE_ACTIONS)
+# Set up in __main__.
+FLEET = None
+RECORDER = None
+INTERACTIVE = None
+LOG = KamigamiLogging.logger("interactive")
 
-def join_interactive(channel, *, session=SESSION):
-    """Retrieve interactive connection information."""
-    return session.get(_build("/interactive/{channel}/robot").format(
-        channel=channel)).json()
 
 def on_error(error):
     """Handle error packets."""
-    print("Oh no, there was an error!", error.message)
+    LOG.error("Oh no, there was an error! %s", error.message)
 
 
 def on_report(report):
     """Handle report packets."""
 
-    # Tactile Mouse Click Control
+    # Tactile Robot Actions: debounced and rate capped by the scheduler.
     for tactile in report.tactile:
         if tactile.pressFrequency:
-            print("Tactile report received!", tactile, sep='\n')
-            MOUSE.click(*MOUSE.position())
+            LOG.debug("Tactile report received!\n%s", tactile)
+            robot_index = FLEET.robot_index_for(tactile.id)
+            BUTTONS.press(tactile.id, robot_index, FLEET.robots[robot_index].controller)
 
-    # Joystick Mouse Movement Control
-    for joystick in report.joystick:
-        if not isnan(joystick.coordMean.x) and not isnan(joystick.coordMean.y):
-            print("Joystick report received!", joystick, sep='\n')
-            #mouse_x, mouse_y = MOUSE.position()
+    # Joystick Motor Control: all joysticks for a robot become one command.
+    for robot_index, left_motor, right_motor in JOYSTICKS.commands(
+            report.joystick, FLEET.robot_index_for, len(FLEET.robots)):
+        FLEET.robots[robot_index].controller.set_motors(left_motor, right_motor)
 
-            left_motor = round(joystick.coordMean.x*10)
-            right_motor = round(joystick.coordMean.y*10)
-            motor_string = "motors {0} {1}".format(left_motor, right_motor)
-            KamigamiCli.receive_data(motor_string)
 
-@asyncio.coroutine
-def run():
-    """Run the interactive app."""
-
-    # Authenticate with Beam and retrieve the channel id from the response.
-    channel_id = login(  # **AUTHENTICATION is a cleaner way of doing this.
-        AUTHENTICATION["username"],
-        AUTHENTICATION["password"]
-    )["channel"]["id"]
-    
-    #channel_id = 235212
-
-    # Get Interactive connection information.
-    data = join_interactive(channel_id)
-
-    # Initialize a connection with Interactive.
-    connection = yield from start(data["address"], channel_id, data["key"])
+# Handlers, to be called when Interactive packets are received.
+HANDLERS = {
+    proto.id.error: on_error,
+    proto.id.report: on_report
+}
 
-    # Handlers, to be called when Interactive packets are received.
-    handlers = {
-        proto.id.error: on_error,
-        proto.id.report: on_report
-    }
 
+@asyncio.coroutine
+def handle_packets(connection, handlers=HANDLERS):
+    """Dispatch packets from an Interactive connection until it closes."""
     # wait_message is a coroutine that will return True when it receives
     # a complete packet from Interactive, or False if we got disconnected.
     while (yield from connection.wait_message()):
+        received = METRICS.origin = clock()
+        METRICS.count("packets")
 
         # Decode the Interactive packet.
-        decoded, _ = connection.get_packet()
+        decoded, raw = connection.get_packet()
+        if RECORDER is not None:
+            RECORDER.record_interactive(raw)
         packet_id = proto.id.get_packet_id(decoded)
+        decoded_at = clock()
+        METRICS.stage("decode").record(decoded_at - received)
 
         # Handle the packet with the proper handler, if its type is known.
         if packet_id in handlers:
             handlers[packet_id](decoded)
+            METRICS.stage("dispatch").since(decoded_at)
         elif decoded is None:
-            print("Unknown bytes were received. Uh oh!", packet_id)
+            LOG.warning("Unknown bytes were received. Uh oh! %s", packet_id)
         else:
-            print("We got packet {} but didn't handle it!".format(packet_id))
+            LOG.info("We got packet %s but didn't handle it!", packet_id)
 
-    connection.close()
+
+@asyncio.coroutine
+def run(fleet, link):
+    """Run the interactive app."""
+    loop = asyncio.get_event_loop()
+
+    # Find and connect to the robots while logging into Beam, rather than
+    # one after the other.
+    fleet_ready = loop.create_task(fleet.start(loop))
+
+    # Log in and get the Interactive connection information now; the link
+    # reuses it when it connects, and retries by itself if this failed.
+    try:
+        yield from link.interactive_info()
+    except Exception as error:
+        LOG.warning("Could not reach Beam yet: %r", error)
+
+    yield from fleet_ready
+
+    loop.create_task(report_periodically(METRICS, METRICS_INTERVAL,
+                                         output=KamigamiLogging.logger("metrics").info))
+    if METRICS_PORT is not None:
+        yield from serve(METRICS, port=METRICS_PORT)
+
+    # Connect to Interactive, and connect again whenever it drops; the
+    # robots stay connected meanwhile.
+    yield from link.run()
+
+
+@asyncio.coroutine
+def replay(fleet, log, realtime=True, speed=1.0):
+    """Feed a recorded Interactive stream to the robots, no Beam needed."""
+    yield from fleet.start(asyncio.get_event_loop())
+    yield from handle_packets(ReplayConnection(log, realtime=realtime, speed=speed))
 
 
 if __name__ == "__main__":
+    KamigamiCli.parser.add_argument('--record', action='store',
+                                    help='Log Interactive packets and robot writes to this file.')
+    KamigamiCli.parser.add_argument('--replay', action='store',
+                                    help='Replay the Interactive packets of a log instead of connecting to Beam.')
+    KamigamiCli.parser.add_argument('--fast', action='store_true',
+                                    help='Replay as fast as possible rather than in real time.')
+    KamigamiCli.parser.add_argument('--fake-robots', action='store_true',
+                                    help='Drive fake robots instead of real ones.')
+    KamigamiCli.parser.add_argument('--simulate', action='store_true',
+                                    help='Drive simulated robots (KamigamiSimulator) instead of real ones.')
+    KamigamiCli.parser.add_argument('--adapters', action='store',
+                                    help='Shard the robots over worker processes on these HCI adapters, e.g. "0,1".')
+    KamigamiCli.parser.add_argument('--api', action='store', default=URL,
+                                    help='Beam API root, e.g. a local stand-in.  Default {0}.'.format(URL))
+    args = KamigamiCli.parser.parse_args()
+    LOG_SINK = KamigamiLogging.setup(args.log or LOG_LEVELS, rate=LOG_RATE)
+
+    if args.record:
+        RECORDER = KamigamiRecorder(args.record)
+    # Made up robots must not end up in the cache of real ones.
+    cache = None
+    if args.simulate:
+        import KamigamiSimulator
+        WORLD = KamigamiSimulator.RobotWorld(ROBOT_COUNT)
+        WORLD.run()
+        macs = WORLD.macs()
+        session_class = KamigamiSimulator.session_class(WORLD)
+        cache = MacCache(path=None)
+    elif args.fake_robots:
+        from KamigamiFakes import FakeSession
+        macs = ["00:00:00:00:00:{0:02x}".format(i) for i in range(ROBOT_COUNT)]
+        session_class = FakeSession
+        cache = MacCache(path=None)
+    else:
+        macs = [args.mac] if args.mac else None
+        session_class = KamigamiSession
     loop = asyncio.get_event_loop()
+    if args.adapters:
+        # Sharded robots run without telemetry, latency metrics or
+        # recording; the supervisor reports each robot's health instead.
+        FLEET = ShardSupervisor(count=ROBOT_COUNT,
+                                macs=macs,
+                                adapters=[int(adapter) for adapter in args.adapters.split(",")],
+                                scan_time=KamigamiCli.scan_time_from_args(args),
+                                write_rate=MOTOR_WRITE_RATE,
+                                cache=cache,
+                                session_class=session_class)
+        loop.create_task(FLEET.watch())
+    else:
+        FLEET = Fleet(count=ROBOT_COUNT,
+                      macs=macs,
+                      scan_time=KamigamiCli.scan_time_from_args(args),
+                      write_rate=MOTOR_WRITE_RATE,
+                      telemetry=ROBOT_TELEMETRY,
+                      adapt_telemetry=ADAPT_TELEMETRY,
+                      metrics=METRICS,
+                      recorder=RECORDER,
+                      cache=cache,
+                      session_class=session_class)
+    for control_id, robot_index in CONTROL_ROUTES.items():
+        FLEET.assign(control_id, robot_index)
+    INTERACTIVE = InteractiveLink(BeamApi(url=args.api), AUTHENTICATION, handle_packets,
+                                  cache=BeamSessionCache(session_ttl=BEAM_SESSION_TTL, key_ttl=INTERACTIVE_KEY_TTL),
+                                  max_backoff=INTERACTIVE_MAX_BACKOFF)
 
     try:
-        loop.run_until_complete(run())
+        if args.replay:
+            log = KamigamiLog(args.replay)
+            loop.run_until_complete(replay(FLEET, log, realtime=not args.fast))
+        else:
+            loop.run_until_complete(run(FLEET, INTERACTIVE))
     finally:
+        INTERACTIVE.stop()
+        print("Robots:", FLEET.stats())
+        print("Interactive:", INTERACTIVE.stats())
+        print("Buttons:", BUTTONS.stats())
+        print(METRICS.summary())
+        FLEET.close()
+        if RECORDER is not None:
+            RECORDER.close()
         loop.close()
+        LOG_SINK.stop()
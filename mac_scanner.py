@@ -1,25 +1,19 @@
 from __future__ import print_function
-from bluepy.btle import Scanner, DefaultDelegate
 import argparse
 
-class ScanDelegate(DefaultDelegate):
-    def __init__(self):
-        DefaultDelegate.__init__(self)
-
-    def handleDiscovery(self, dev, isNewDev, isNewData):
-        pass
+from KamigamiScanner import MacCache, find_robots
 
 parser = argparse.ArgumentParser()
 
-# TODO: Auto Mac Address Finding.
 parser.add_argument('-t', '--time', action='store',
                     help='Customize the time.  Default 10 seconds.')
 
+parser.add_argument('-n', '--count', action='store', type=int, default=1,
+                    help='Stop scanning once this many robots are found.  Default 1.')
+
 parser.add_argument('-p', '--passing', action='store_true',
                     help='Output in a way that is easy to be used by other programs.  Similar to git plumbing vs porcelain commands.')
 
-scanner = Scanner().withDelegate(ScanDelegate())
-
 try:
 	scan_time = float(parser.parse_args().time)
 except Exception:
@@ -30,17 +24,17 @@ try:
 except:
     shouldPass = False
 
-devices = scanner.scan(scan_time)
+cache = MacCache()
 
-for dev in devices:
-    for (adtype, desc, value) in dev.getScanData():
-        if value == "KRB0001":
-            # Print it human friendly if not shouldPass
-            if not shouldPass:
-                print("Found a Kamigami Robot! MAC: " + dev.addr)
-            else:
-                # Break at the end to print only 1
-                print(dev.addr)
-                break
+# Strongest signal first.
+robots = find_robots(parser.parse_args().count, scan_time)
 
-dev.addr
+for addr, rssi in robots:
+    cache.remember(addr, rssi)
+    # Print it human friendly if not shouldPass
+    if not shouldPass:
+        print("Found a Kamigami Robot! MAC: " + addr + " RSSI: " + str(rssi))
+    else:
+        # Break at the end to print only 1
+        print(addr)
+        break
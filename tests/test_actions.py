@@ -0,0 +1,61 @@
+import asyncio
+import unittest
+
+from KamigamiActions import ACTIONS, ActionScheduler, TactileAction
+
+
+class Controller:
+    def __init__(self):
+        self.sent = []
+
+    def send(self, command, *args):
+        self.sent.append((command,) + args)
+
+
+class ActionSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(self.loop.close)
+
+    def run_for(self, seconds):
+        self.loop.run_until_complete(asyncio.sleep(seconds))
+
+    def scheduler(self, **actions):
+        return ActionScheduler({1: "spin"}, actions=actions, loop=self.loop)
+
+    def test_spin_leaves_test_mode(self):
+        self.assertEqual(ACTIONS["spin"].then, ("testmode", 0))
+        spin = TactileAction("testmode", 20, debounce=0.01, cooldown=0.0, rate=100.0,
+                             duration=0.05, then=("testmode", 0))
+        scheduler = self.scheduler(spin=spin)
+        controller = Controller()
+        scheduler.press(1, 0, controller)
+        self.run_for(0.03)
+        self.assertEqual(controller.sent, [("testmode", 20)])
+        self.run_for(0.06)
+        self.assertEqual(controller.sent, [("testmode", 20), ("testmode", 0)])
+        self.assertEqual((scheduler.fired, scheduler.finished), (1, 1))
+
+    def test_refiring_extends_the_action(self):
+        spin = TactileAction("testmode", 20, debounce=0.01, cooldown=0.0, rate=100.0, burst=2.0,
+                             duration=0.1, then=("testmode", 0))
+        scheduler = self.scheduler(spin=spin)
+        controller = Controller()
+        scheduler.press(1, 0, controller)
+        self.run_for(0.06)
+        scheduler.press(1, 0, controller)
+        # The first firing's timer is due here and must not end the second.
+        self.run_for(0.07)
+        self.assertEqual(controller.sent, [("testmode", 20), ("testmode", 20)])
+        self.run_for(0.06)
+        self.assertEqual(controller.sent[-1], ("testmode", 0))
+        self.assertEqual((scheduler.fired, scheduler.finished), (2, 1))
+
+    def test_duration_needs_then(self):
+        with self.assertRaises(ValueError):
+            TactileAction("testmode", 20, duration=1.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
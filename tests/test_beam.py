@@ -0,0 +1,184 @@
+import asyncio
+import os
+import shutil
+import stat
+import tempfile
+import time
+import unittest
+
+from beam_interactive import proto
+
+from KamigamiBeam import BeamApi, BeamError, BeamSessionCache, InteractiveLink, _read_response
+from KamigamiFakes import FakeBeamApi, FakeInteractiveConnection, serve_fake_interactive
+
+LOGIN = "/api/v1/users/login"
+AUTH = {"username": "robot", "password": "secret@home"}
+
+
+class BeamTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(self.loop.close)
+        self.fake = FakeBeamApi(username=AUTH["username"], password=AUTH["password"])
+        server = self.run_until_complete(self.fake.serve())
+        self.addCleanup(self.run_until_complete, server.wait_closed())
+        self.addCleanup(server.close)
+
+    def run_until_complete(self, coroutine):
+        return self.loop.run_until_complete(asyncio.wait_for(coroutine, 5.0))
+
+
+class BeamApiTest(BeamTestCase):
+    def test_login_sets_the_session_cookie(self):
+        api = BeamApi(self.fake.url)
+        user = self.run_until_complete(api.login(AUTH["username"], AUTH["password"]))
+        self.assertEqual(user["channel"]["id"], self.fake.channel)
+        self.assertIn(api.cookies.get("sid"), self.fake.sessions)
+        data = self.run_until_complete(api.join_interactive(self.fake.channel))
+        self.assertEqual(data, {"address": self.fake.address, "key": self.fake.key})
+        self.assertEqual(api.requests, 2)
+
+    def test_refusals_carry_the_status(self):
+        api = BeamApi(self.fake.url)
+        with self.assertRaises(BeamError) as refused:
+            self.run_until_complete(api.login(AUTH["username"], "wrong"))
+        self.assertEqual(refused.exception.status, 401)
+        with self.assertRaises(BeamError) as refused:
+            self.run_until_complete(api.join_interactive(self.fake.channel))
+        self.assertEqual(refused.exception.status, 403)
+
+    def test_unreachable_api(self):
+        api = BeamApi("http://127.0.0.1:1/api/v1/")
+        with self.assertRaises(BeamError) as failed:
+            self.run_until_complete(api.login(AUTH["username"], AUTH["password"]))
+        self.assertIsNone(failed.exception.status)
+
+    def test_chunked_response(self):
+        reader = asyncio.StreamReader()
+        reader.feed_data(b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+                         b"4\r\n{\"a\"\r\n3;x=y\r\n: 1\r\n1\r\n}\r\n0\r\n\r\n")
+        reader.feed_eof()
+        status, headers, body = self.run_until_complete(_read_response(reader))
+        self.assertEqual((status, body), (200, b'{"a": 1}'))
+        self.assertIn(("transfer-encoding", "chunked"), headers)
+
+
+class BeamSessionCacheTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, "beam.json")
+
+    def test_sessions_persist_readable_only_by_the_owner(self):
+        BeamSessionCache(self.path).remember_session("robot", 1234, {"sid": "s1"})
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o600)
+        self.assertEqual(BeamSessionCache(self.path).session("robot"), (1234, {"sid": "s1"}))
+        BeamSessionCache(self.path).forget_session("robot")
+        self.assertIsNone(BeamSessionCache(self.path).session("robot"))
+
+    def test_expired_session_is_ignored(self):
+        cache = BeamSessionCache(self.path, session_ttl=60)
+        cache.remember_session("robot", 1234, {"sid": "s1"})
+        entries = cache._load()
+        entries["robot"]["saved"] = time.time() - 61
+        cache._save(entries)
+        self.assertIsNone(cache.session("robot"))
+
+    def test_interactive_keys_expire_and_stay_in_memory(self):
+        cache = BeamSessionCache(self.path, key_ttl=0.05)
+        cache.remember_interactive(1234, {"key": "k"})
+        self.assertEqual(cache.interactive(1234), {"key": "k"})
+        self.assertFalse(os.path.exists(self.path))
+        time.sleep(0.1)
+        self.assertIsNone(cache.interactive(1234))
+
+
+class InteractiveLinkTest(BeamTestCase):
+    def link(self, handle, cache, connect=None, **kwargs):
+        if connect is None:
+            @asyncio.coroutine
+            def connect(address, channel, key):
+                yield from asyncio.sleep(0)
+                return FakeInteractiveConnection(0)
+        return InteractiveLink(BeamApi(self.fake.url), AUTH, handle, cache=cache, connect=connect,
+                               backoff=0.01, poll=0.01, **kwargs)
+
+    def run_once(self, cache):
+        """
+        Connect once through a new link with cache, then stop.
+        """
+        @asyncio.coroutine
+        def handle(connection):
+            yield from asyncio.sleep(0)
+            link.stop()
+
+        link = self.link(handle, cache)
+        self.run_until_complete(link.run())
+        return link
+
+    def test_cached_session_skips_login(self):
+        cache = BeamSessionCache(path=None)
+        self.assertEqual(self.run_once(cache).logins, 1)
+        cache.forget_interactive(self.fake.channel)
+        link = self.run_once(cache)
+        self.assertEqual(link.logins, 0)
+        self.assertEqual(link.joins, 1)
+        self.assertEqual(self.fake.requests[LOGIN], 1)
+
+    def test_refused_session_logs_in_again(self):
+        cache = BeamSessionCache(path=None)
+        self.run_once(cache)
+        cache.forget_interactive(self.fake.channel)
+        self.fake.refuse_session = True
+        link = self.run_once(cache)
+        self.assertEqual(link.logins, 1)
+        self.assertEqual(link.joins, 2)
+        self.assertEqual(self.fake.requests[LOGIN], 2)
+        self.assertIn(cache.session(AUTH["username"])[1]["sid"], self.fake.sessions)
+
+    def test_handler_error_reconnects_instead_of_ending_run(self):
+        handled = []
+
+        @asyncio.coroutine
+        def handle(connection):
+            handled.append(connection)
+            yield from asyncio.sleep(0)
+            if len(handled) == 1:
+                raise RuntimeError("handler bug")
+            link.stop()
+
+        link = self.link(handle, BeamSessionCache(path=None))
+        self.run_until_complete(link.run())
+        self.assertEqual(len(handled), 2)
+        self.assertEqual(link.connects, 2)
+        self.assertEqual(link.errors, 1)
+        # The key of a connection whose handler failed is not reused.
+        self.assertEqual(link.joins, 2)
+
+    def test_reports_from_interactive(self):
+        server = self.run_until_complete(serve_fake_interactive(key=self.fake.key, count=5))
+        self.addCleanup(self.run_until_complete, server.wait_closed())
+        self.addCleanup(server.close)
+        self.fake.address = "ws://127.0.0.1:{0}".format(list(server.sockets)[0].getsockname()[1])
+        reports = []
+
+        @asyncio.coroutine
+        def handle(connection):
+            try:
+                while (yield from connection.wait_message()):
+                    packet = connection.get_packet()[0]
+                    if isinstance(packet, proto.Report):
+                        reports.append(packet)
+            finally:
+                link.stop()
+
+        link = InteractiveLink(BeamApi(self.fake.url), AUTH, handle, cache=BeamSessionCache(path=None),
+                               poll=0.01)
+        self.run_until_complete(link.run())
+        self.assertEqual(server.handshakes, {True: 1, False: 0})
+        self.assertEqual(len(reports), 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
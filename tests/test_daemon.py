@@ -0,0 +1,187 @@
+import asyncio
+import os
+import shutil
+import socket
+import stat
+import tempfile
+import unittest
+
+from KamigamiData import KamigamiByteFormatter, KamigamiRobot
+from KamigamiDaemon import ACK, BAD_FRAME, BAD_ROBOT, LENGTH, OK, REQUEST, STALE, KamigamiDaemon, _bind_private_socket
+
+
+class RecordingController:
+    def __init__(self):
+        self.motors = []
+        self.lights = []
+        self.frames = []
+        self.writer = self
+
+    def set_motors(self, left, right):
+        self.motors.append((left, right))
+
+    def set_lights(self, r, g, b):
+        self.lights.append((r, g, b))
+
+    def write_value(self, message):
+        self.frames.append(bytes(message))
+        return True
+
+
+class Robot:
+    def __init__(self):
+        self.controller = RecordingController()
+
+
+class Fleet:
+    def __init__(self, count):
+        self.robots = [Robot() for _ in range(count)]
+
+
+def request(seq, robot, frame):
+    return REQUEST.pack(seq, robot) + frame
+
+
+class DaemonHandleTest(unittest.TestCase):
+    def setUp(self):
+        self.fleet = Fleet(2)
+        self.daemon = KamigamiDaemon(self.fleet)
+        self.motor = KamigamiByteFormatter.get_sendable_motor_packet(10, -10)
+
+    def test_ack_echoes_sequence(self):
+        ack = self.daemon.handle("a", request(7, 1, self.motor))
+        self.assertEqual(ACK.unpack(ack), (7, OK))
+        self.assertEqual(self.fleet.robots[1].controller.motors, [(10, -10)])
+
+    def test_stale_and_wrapping_sequences(self):
+        self.assertEqual(ACK.unpack(self.daemon.handle("a", request(0xFFFFFFFF, 0, self.motor)))[1], OK)
+        self.assertEqual(ACK.unpack(self.daemon.handle("a", request(0xFFFFFFFE, 0, self.motor)))[1], STALE)
+        self.assertEqual(ACK.unpack(self.daemon.handle("a", request(1, 0, self.motor)))[1], OK)
+        # Sequences are per client, and 0 is never stale.
+        self.assertEqual(ACK.unpack(self.daemon.handle("b", request(5, 0, self.motor)))[1], OK)
+        self.assertEqual(ACK.unpack(self.daemon.handle("b", request(0, 0, self.motor)))[1], OK)
+        self.assertEqual(ACK.unpack(self.daemon.handle("b", request(0, 0, self.motor)))[1], OK)
+
+    def test_rejections(self):
+        self.assertEqual(ACK.unpack(self.daemon.handle("a", request(1, 5, self.motor))), (1, BAD_ROBOT))
+        self.assertEqual(ACK.unpack(self.daemon.handle("a", request(2, 0, self.motor[:2]))), (2, BAD_FRAME))
+        self.assertEqual(ACK.unpack(self.daemon.handle("a", b"\x01\x00")), (0, BAD_FRAME))
+        self.assertEqual(self.daemon.stats()["rejected"], 3)
+
+    def test_other_frames_are_written_through(self):
+        shutdown = KamigamiByteFormatter.get_sendable_shutdown()
+        self.assertEqual(ACK.unpack(self.daemon.handle("a", request(1, 0, shutdown)))[1], OK)
+        self.assertEqual(self.fleet.robots[0].controller.frames, [shutdown])
+
+
+class DaemonUnixStreamTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, "kamigami.sock")
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(self.loop.close)
+        self.fleet = Fleet(1)
+        self.daemon = KamigamiDaemon(self.fleet)
+        self.server = self.loop.run_until_complete(self.daemon.serve_unix(self.path))
+        self.addCleanup(self.close_server)
+
+    def close_server(self):
+        self.daemon.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+
+    def exchange(self, chunks, answers):
+        @asyncio.coroutine
+        def talk():
+            reader, writer = yield from asyncio.open_unix_connection(self.path)
+            for chunk in chunks:
+                writer.write(chunk)
+                yield from writer.drain()
+                yield from asyncio.sleep(0.01)
+            acks = []
+            for _ in range(answers):
+                header = yield from reader.readexactly(LENGTH.size)
+                acks.append(ACK.unpack((yield from reader.readexactly(LENGTH.unpack(header)[0]))))
+            writer.close()
+            return acks
+
+        return self.loop.run_until_complete(asyncio.wait_for(talk(), 5.0))
+
+    def framed(self, seq, frame):
+        message = request(seq, 0, frame)
+        return LENGTH.pack(len(message)) + message
+
+    def test_one_ack_per_message(self):
+        motor = KamigamiByteFormatter.get_sendable_motor_packet(1, 2)
+        light = KamigamiByteFormatter.get_sendable_light_packet(r=3, g=4, b=5)
+        # Two messages in one write, and one split across writes.
+        stream = self.framed(1, motor) + self.framed(2, light)
+        third = self.framed(3, motor)
+        acks = self.exchange([stream, third[:3], third[3:]], 3)
+        self.assertEqual(acks, [(1, OK), (2, OK), (3, OK)])
+        controller = self.fleet.robots[0].controller
+        self.assertEqual(controller.motors, [(1, 2), (1, 2)])
+        self.assertEqual(controller.lights, [(3, 4, 5)])
+
+    def test_bad_frame_does_not_break_the_stream(self):
+        motor = KamigamiByteFormatter.get_sendable_motor_packet(1, 2)
+        acks = self.exchange([self.framed(1, motor[:1] + b"\x00"), self.framed(2, motor)], 2)
+        self.assertEqual(acks, [(1, BAD_FRAME), (2, OK)])
+
+    def test_unknown_identifier(self):
+        acks = self.exchange([self.framed(1, bytes((0xEE, 0, 0)))], 1)
+        self.assertEqual(acks, [(1, BAD_FRAME)])
+        self.assertNotIn(0xEE, KamigamiByteFormatter.FRAME_SIZES)
+        self.assertIn(KamigamiRobot.Identifiers.MOTOR_PACKET, KamigamiByteFormatter.FRAME_SIZES)
+
+
+class DaemonSocketFileTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, "kamigami.sock")
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(self.loop.close)
+        self.daemon = KamigamiDaemon(Fleet(1))
+
+    def test_owner_only_and_removed_on_close(self):
+        self.loop.run_until_complete(self.daemon.serve_unix(self.path))
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o600)
+        self.daemon.close()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_bound_owner_only_without_changing_the_umask(self):
+        mask = os.umask(0o022)
+        self.addCleanup(os.umask, mask)
+        sock = _bind_private_socket(self.path)
+        self.addCleanup(sock.close)
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o600)
+        self.assertEqual(os.umask(0o022), 0o022)
+
+    def test_stale_socket_is_replaced(self):
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(self.path)
+        stale.close()
+        self.loop.run_until_complete(self.daemon.serve_unix(self.path))
+        self.daemon.close()
+
+    def test_live_socket_is_not_taken_over(self):
+        other = KamigamiDaemon(Fleet(1))
+        self.loop.run_until_complete(other.serve_unix(self.path))
+        self.addCleanup(other.close)
+        with self.assertRaises(OSError):
+            self.loop.run_until_complete(self.daemon.serve_unix(self.path))
+        self.assertTrue(os.path.exists(self.path))
+
+    def test_other_files_are_left_alone(self):
+        with open(self.path, "w") as other:
+            other.write("not a socket")
+        with self.assertRaises(FileExistsError):
+            self.loop.run_until_complete(self.daemon.serve_unix(self.path))
+        self.assertTrue(os.path.isfile(self.path))
+
+
+if __name__ == "__main__":
+    unittest.main()
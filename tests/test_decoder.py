@@ -0,0 +1,211 @@
+import os
+import random
+import shutil
+import tempfile
+import time
+import unittest
+
+from KamigamiData import KamigamiByteFormatter, KamigamiRobot
+from KamigamiDecoder import decode_frame, decode_log, decode_stream
+from KamigamiRecorder import BLE_WRITE, HEADER, RECORD, KamigamiLog, KamigamiRecorder
+
+Identifiers = KamigamiRobot.Identifiers
+SIZES = KamigamiByteFormatter.FRAME_SIZES
+
+
+def parse_sequentially(buffer):
+    """
+    The straightforward parser decode_stream must agree with: frames by
+    identifier, and the offsets of bytes that do not start a frame.
+    """
+    frames = {}
+    malformed = []
+    offset = 0
+    while offset < len(buffer):
+        size = SIZES.get(buffer[offset])
+        if size is None or offset + size > len(buffer):
+            malformed.append(offset)
+            offset += 1
+            continue
+        frames.setdefault(buffer[offset], []).append(offset)
+        offset += size
+    return frames, malformed
+
+
+def runs(offsets):
+    result = []
+    for offset in offsets:
+        if result and result[-1][0] + result[-1][1] == offset:
+            result[-1][1] += 1
+        else:
+            result.append([offset, 1])
+    return result
+
+
+def random_capture(rng, frames):
+    parts = []
+    for _ in range(frames):
+        choice = rng.random()
+        if choice < 0.4:
+            parts.append(KamigamiByteFormatter.get_sendable_motor_packet(rng.randint(-63, 63), rng.randint(-63, 63)))
+        elif choice < 0.6:
+            parts.append(KamigamiByteFormatter.get_sendable_light_packet(
+                r=rng.randint(0, 255), g=rng.randint(0, 255), b=rng.randint(0, 255)))
+        elif choice < 0.75:
+            parts.append(KamigamiByteFormatter.get_unified_packet((rng.randint(0, 63), rng.randint(0, 63))))
+        elif choice < 0.8:
+            parts.append(KamigamiByteFormatter.get_sendable_ir_packet())
+        elif choice < 0.85:
+            parts.append(KamigamiByteFormatter.get_sendable_shutdown())
+        else:
+            # Garbage, which may or may not happen to look like a frame.
+            parts.append(bytes(rng.randint(0, 255) for _ in range(rng.randint(1, 5))))
+    return b"".join(parts)
+
+
+class DecodeStreamTest(unittest.TestCase):
+    def check(self, buffer):
+        frames, malformed = parse_sequentially(buffer)
+        decoded = decode_stream(buffer)
+        self.assertEqual(sorted(decoded.frames), sorted(frames))
+        for identifier, offsets in frames.items():
+            self.assertEqual(decoded[identifier]['offset'].tolist(), offsets)
+        self.assertEqual(decoded.malformed.tolist(), runs(malformed))
+
+    def test_random_captures(self):
+        rng = random.Random(1)
+        for frames in (0, 1, 2, 10, 100, 1000):
+            self.check(random_capture(rng, frames))
+
+    def test_truncated_last_frame(self):
+        buffer = KamigamiByteFormatter.get_sendable_motor_packet(1, 2) + \
+            KamigamiByteFormatter.get_unified_packet(lights=(1, 2, 3))[:5]
+        self.check(buffer)
+        self.assertEqual(decode_stream(buffer).malformed.tolist(), [[3, 5]])
+
+    def test_fields(self):
+        buffer = KamigamiByteFormatter.get_sendable_motor_packet(-5, 7) + \
+            KamigamiByteFormatter.get_sendable_light_packet(r=1, g=2, b=3)
+        decoded = decode_stream(buffer)
+        motor = decoded[Identifiers.MOTOR_PACKET]
+        self.assertEqual((motor['left'][0], motor['right'][0]), (-5, 7))
+        light = decoded[Identifiers.LIGHT_PACKET]
+        self.assertEqual((light['r'][0], light['g'][0], light['b'][0]), (1, 2, 3))
+
+    def test_decode_frame_agrees(self):
+        frame = KamigamiByteFormatter.get_sendable_motor_packet(-5, 7)
+        self.assertEqual(decode_frame(frame), (Identifiers.MOTOR_PACKET, {'left': -5, 'right': 7}))
+        with self.assertRaises(ValueError):
+            decode_frame(frame[:2])
+        with self.assertRaises(ValueError):
+            decode_frame(b"\xff")
+
+
+class DecodeLogTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, "capture.log")
+
+    def record(self, rng, count):
+        recorder = KamigamiRecorder(self.path)
+        for _ in range(count):
+            if rng.random() < 0.2:
+                recorder.record_interactive(bytes(rng.randint(0, 255) for _ in range(rng.randint(0, 40))))
+            else:
+                frame = random_capture(rng, 1) if rng.random() < 0.9 else random_capture(rng, 2)
+                recorder.record_write(frame, channel=rng.randint(0, 3))
+        recorder.close()
+
+    def check(self):
+        frames = {}
+        malformed = []
+        log = KamigamiLog(self.path)
+        try:
+            for offset in log.record_offsets():
+                kind, channel, seconds, length = RECORD.unpack_from(log.buffer, offset)
+                payload = log.buffer[offset + RECORD.size:offset + RECORD.size + length]
+                if kind != BLE_WRITE:
+                    continue
+                try:
+                    identifier, fields = decode_frame(payload)
+                except ValueError:
+                    malformed.append([offset, length])
+                    continue
+                frames.setdefault(identifier, []).append((offset + RECORD.size, channel, seconds, fields))
+            decoded = decode_log(log)
+        finally:
+            log.close()
+        self.assertEqual(sorted(decoded.frames), sorted(frames))
+        for identifier, rows in frames.items():
+            table = decoded[identifier]
+            self.assertEqual(table['offset'].tolist(), [row[0] for row in rows])
+            self.assertEqual(table['channel'].tolist(), [row[1] for row in rows])
+            self.assertEqual(table['t'].tolist(), [row[2] for row in rows])
+            for name, values in rows[0][3].items():
+                self.assertEqual(table[name][0], values)
+        self.assertEqual(decoded.malformed.tolist(), malformed)
+
+    def test_random_logs(self):
+        rng = random.Random(2)
+        for count in (0, 1, 10, 500):
+            self.record(rng, count)
+            self.check()
+
+    def test_record_cut_short_ends_the_log(self):
+        self.record(random.Random(3), 50)
+        with open(self.path, "r+b") as log_file:
+            log_file.truncate(os.path.getsize(self.path) - 2)
+        self.check()
+
+    def test_empty_log(self):
+        self.record(random.Random(4), 0)
+        self.assertEqual(os.path.getsize(self.path), HEADER.size)
+        log = KamigamiLog(self.path)
+        decoded = decode_log(log)
+        log.close()
+        self.assertEqual(decoded.frames, {})
+
+
+class RecorderTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, "capture.log")
+
+    def on_disk(self):
+        """
+        The number of records another process would read now.
+        """
+        log = KamigamiLog(self.path)
+        try:
+            return sum(1 for _ in log)
+        finally:
+            log.close()
+
+    def test_flushes_every_n_records(self):
+        recorder = KamigamiRecorder(self.path, flush_every=3, flush_interval=None)
+        self.addCleanup(recorder.close)
+        frame = KamigamiByteFormatter.get_sendable_motor_packet(1, 2)
+        for _ in range(4):
+            recorder.record_write(frame)
+        self.assertEqual(self.on_disk(), 3)
+
+    def test_timer_flushes_a_quiet_log(self):
+        recorder = KamigamiRecorder(self.path, flush_every=1000, flush_interval=0.02)
+        self.addCleanup(recorder.close)
+        recorder.record_interactive(b"report")
+        deadline = time.monotonic() + 2.0
+        while self.on_disk() < 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.on_disk(), 1)
+
+    def test_close_flushes(self):
+        recorder = KamigamiRecorder(self.path, flush_every=1000, flush_interval=None)
+        recorder.record_interactive(b"report")
+        recorder.close()
+        self.assertEqual(self.on_disk(), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
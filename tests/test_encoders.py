@@ -0,0 +1,91 @@
+import unittest
+
+from KamigamiData import KamigamiByteFormatter, KamigamiRobot, UnifiedPacket
+
+
+class MotorPacketTest(unittest.TestCase):
+    def test_layout(self):
+        self.assertEqual(KamigamiByteFormatter.get_sendable_motor_packet(10, 20),
+                         bytes((KamigamiRobot.Identifiers.MOTOR_PACKET, 10, 20)))
+
+    def test_reverse_speeds_are_twos_complement(self):
+        self.assertEqual(KamigamiByteFormatter.get_sendable_motor_packet(-1, -63),
+                         bytes((KamigamiRobot.Identifiers.MOTOR_PACKET, 0xFF, 0xC1)))
+
+    def test_range(self):
+        for left, right in ((64, 0), (0, 64), (-64, 0), (0, -64)):
+            with self.assertRaises(ValueError):
+                KamigamiByteFormatter.get_sendable_motor_packet(left, right)
+
+    def test_matches_generic_encoder(self):
+        for left in range(-63, 64, 7):
+            for right in range(-63, 64, 9):
+                self.assertEqual(
+                    KamigamiByteFormatter.get_sendable_motor_packet(left, right),
+                    KamigamiByteFormatter.convert_params_to_message(
+                        [KamigamiRobot.Identifiers.MOTOR_PACKET, left, right]))
+
+    def test_frame_size(self):
+        packet = KamigamiByteFormatter.get_sendable_motor_packet(1, 2)
+        self.assertEqual(len(packet), KamigamiByteFormatter.FRAME_SIZES[packet[0]])
+
+
+class UnifiedPacketTest(unittest.TestCase):
+    def test_empty(self):
+        packet = UnifiedPacket()
+        self.assertEqual(len(packet.frame), UnifiedPacket.SIZE)
+        self.assertEqual(packet.frame[0], KamigamiRobot.Identifiers.UNIFIED_PACKET)
+        self.assertEqual(packet.flags, 0)
+        self.assertEqual(bytes(packet.frame[1:]), bytes(UnifiedPacket.SIZE - 1))
+
+    def test_motors_and_lights(self):
+        packet = UnifiedPacket()
+        packet.set_motors(31, 45)
+        packet.set_lights(255, 127, 0)
+        frame = bytes(packet.view())
+        self.assertEqual(frame[UnifiedPacket.FLAGS_OFFSET], UnifiedPacket.MOTOR_FLAG | UnifiedPacket.LIGHT_FLAG)
+        self.assertEqual(frame[UnifiedPacket.MOTOR_OFFSET:UnifiedPacket.MOTOR_OFFSET + 2], bytes((31, 45)))
+        self.assertEqual(frame[UnifiedPacket.LIGHT_OFFSET:UnifiedPacket.LIGHT_OFFSET + 3], bytes((255, 127, 0)))
+        self.assertEqual(packet.motors, (31, 45))
+        self.assertEqual(packet.lights, (255, 127, 0))
+
+    def test_clear_drops_fields_and_flags(self):
+        packet = UnifiedPacket()
+        packet.set_motors(1, 2)
+        packet.set_lights(3, 4, 5)
+        packet.clear_motors()
+        self.assertEqual(packet.flags, UnifiedPacket.LIGHT_FLAG)
+        self.assertEqual(packet.motors, (0, 0))
+        packet.clear_lights()
+        self.assertEqual(packet.flags, 0)
+        packet.set_motors(6, 7)
+        packet.clear()
+        self.assertEqual(bytes(packet.frame), bytes(UnifiedPacket().frame))
+
+    def test_view_is_updated_in_place(self):
+        packet = UnifiedPacket()
+        view = packet.view()
+        packet.set_motors(9, 9)
+        self.assertEqual(view[UnifiedPacket.MOTOR_OFFSET], 9)
+
+    def test_range(self):
+        packet = UnifiedPacket()
+        with self.assertRaises(ValueError):
+            packet.set_motors(-1, 0)
+        with self.assertRaises(ValueError):
+            packet.set_motors(0, 64)
+        with self.assertRaises(ValueError):
+            packet.set_lights(0, 256, 0)
+        self.assertEqual(packet.flags, 0)
+
+    def test_get_unified_packet(self):
+        packet = UnifiedPacket()
+        packet.set_motors(10, 11)
+        packet.set_lights(1, 2, 3)
+        self.assertEqual(KamigamiByteFormatter.get_unified_packet((10, 11), (1, 2, 3)), bytes(packet.frame))
+        with self.assertRaises(AttributeError):
+            KamigamiByteFormatter.get_unified_packet((-1, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
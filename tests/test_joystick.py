@@ -0,0 +1,65 @@
+import math
+import unittest
+
+from KamigamiJoystick import JoystickAggregator
+
+
+class Coordinates:
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+
+class Joystick:
+    def __init__(self, control_id, x, y):
+        self.id = control_id
+        self.coordMean = Coordinates(x, y)
+
+
+class JoystickAggregatorTest(unittest.TestCase):
+    def test_mean(self):
+        aggregator = JoystickAggregator("mean", deadzone=0.0, scale=10)
+        joysticks = [Joystick(0, 1.0, 0.0), Joystick(1, 0.0, 1.0)]
+        self.assertEqual(aggregator.commands(joysticks), [(0, 5, 5)])
+
+    def test_weighted(self):
+        aggregator = JoystickAggregator("weighted", deadzone=0.0, scale=10, weights={0: 3.0})
+        joysticks = [Joystick(0, 1.0, 0.0), Joystick(1, 0.0, 1.0)]
+        self.assertEqual(aggregator.commands(joysticks), [(0, 8, 2)])
+
+    def test_median_ignores_outliers(self):
+        aggregator = JoystickAggregator("median", deadzone=0.0, scale=10)
+        joysticks = [Joystick(0, 0.5, 0.5), Joystick(1, 0.4, 0.6), Joystick(2, -1.0, -1.0)]
+        self.assertEqual(aggregator.commands(joysticks), [(0, 4, 5)])
+
+    def test_deadzone(self):
+        aggregator = JoystickAggregator("mean", deadzone=0.2, scale=10)
+        self.assertEqual(aggregator.commands([Joystick(0, 0.1, 0.1)]), [(0, 0, 0)])
+        self.assertEqual(aggregator.commands([Joystick(0, 0.3, 0.0)]), [(0, 3, 0)])
+
+    def test_clipped_to_motor_range(self):
+        aggregator = JoystickAggregator("mean", deadzone=0.0, scale=100)
+        self.assertEqual(aggregator.commands([Joystick(0, 1.0, -1.0)]), [(0, 63, -63)])
+
+    def test_nan_positions_are_skipped(self):
+        aggregator = JoystickAggregator("mean", deadzone=0.0, scale=10)
+        self.assertEqual(aggregator.commands([Joystick(0, math.nan, 0.0)]), [])
+        joysticks = [Joystick(0, math.nan, 0.0), Joystick(1, 1.0, 1.0)]
+        self.assertEqual(aggregator.commands(joysticks), [(0, 10, 10)])
+
+    def test_routing(self):
+        aggregator = JoystickAggregator("mean", deadzone=0.0, scale=10)
+        joysticks = [Joystick(0, 1.0, 0.0), Joystick(1, 0.0, 1.0), Joystick(2, 1.0, 1.0)]
+        commands = aggregator.commands(joysticks, route=lambda control_id: control_id % 2, robot_count=2)
+        self.assertEqual(sorted(commands), [(0, 10, 5), (1, 0, 10)])
+
+    def test_no_joysticks(self):
+        self.assertEqual(JoystickAggregator().commands([]), [])
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            JoystickAggregator("mode")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,132 @@
+import threading
+import time
+import unittest
+
+from KamigamiData import KamigamiRobot, UnifiedPacket
+from KamigamiMerger import UnifiedTickMerger
+
+
+class RecordingWriter:
+    def __init__(self):
+        self.frames = []
+        self.written = threading.Event()
+
+    def write_value(self, message):
+        self.frames.append(bytes(message))
+        self.written.set()
+
+
+class FailingWriter(RecordingWriter):
+    """
+    Fails the first `failures` writes.
+    """
+    def __init__(self, failures):
+        RecordingWriter.__init__(self)
+        self.failures = failures
+
+    def write_value(self, message):
+        if self.failures:
+            self.failures -= 1
+            raise IOError("write failed")
+        RecordingWriter.write_value(self, message)
+
+
+class UnifiedTickMergerTest(unittest.TestCase):
+    def start(self, writer=None, **kwargs):
+        self.writer = writer if writer is not None else RecordingWriter()
+        self.merger = UnifiedTickMerger(self.writer, **kwargs)
+        self.merger.start()
+        self.addCleanup(self.merger.stop, 1.0)
+        return self.merger
+
+    def wait_for_frames(self, count, timeout=1.0):
+        deadline = time.monotonic() + timeout
+        while len(self.writer.frames) < count and time.monotonic() < deadline:
+            time.sleep(0.005)
+        return self.writer.frames
+
+    def test_latest_state_in_one_frame(self):
+        merger = self.start(rate_hz=20, keepalive=None)
+        merger.set_motors(1, 1)
+        merger.set_motors(10, 20)
+        merger.set_lights(1, 2, 3)
+        frames = self.wait_for_frames(1)
+        time.sleep(0.2)
+        self.assertLessEqual(len(frames), 2)
+        last = frames[-1]
+        self.assertEqual(last[0], KamigamiRobot.Identifiers.UNIFIED_PACKET)
+        self.assertEqual(last[UnifiedPacket.FLAGS_OFFSET] & UnifiedPacket.MOTOR_FLAG, UnifiedPacket.MOTOR_FLAG)
+        self.assertEqual(tuple(last[UnifiedPacket.MOTOR_OFFSET:UnifiedPacket.MOTOR_OFFSET + 2]), (10, 20))
+
+    def test_unchanged_state_is_suppressed(self):
+        merger = self.start(rate_hz=100, keepalive=None)
+        merger.set_motors(10, 20)
+        self.wait_for_frames(1)
+        for _ in range(20):
+            merger.set_motors(10, 20)
+            time.sleep(0.005)
+        time.sleep(0.05)
+        self.assertEqual(len(self.writer.frames), 1)
+        self.assertGreater(merger.stats()["suppressed"], 0)
+
+    def test_changed_lights_only_carry_lights(self):
+        merger = self.start(rate_hz=100, keepalive=None)
+        merger.set_motors(10, 20)
+        self.wait_for_frames(1)
+        merger.set_lights(0, 0, 255)
+        frames = self.wait_for_frames(2)
+        self.assertEqual(frames[1][UnifiedPacket.FLAGS_OFFSET], UnifiedPacket.LIGHT_FLAG)
+
+    def test_keepalive_resends_state(self):
+        merger = self.start(rate_hz=100, keepalive=0.1)
+        merger.set_motors(10, 20)
+        frames = self.wait_for_frames(3, timeout=1.0)
+        self.assertGreaterEqual(len(frames), 3)
+        self.assertEqual(len(set(frames)), 1)
+        self.assertGreaterEqual(merger.stats()["keepalives"], 2)
+
+    def test_no_keepalive_before_anything_was_sent(self):
+        self.start(rate_hz=100, keepalive=0.05)
+        time.sleep(0.2)
+        self.assertEqual(self.writer.frames, [])
+
+    def test_reverse_speeds_fall_back_to_motor_packet(self):
+        merger = self.start(rate_hz=100, keepalive=None)
+        merger.set_motors(-10, 20)
+        merger.set_lights(1, 2, 3)
+        frames = self.wait_for_frames(2)
+        self.assertEqual(frames[0], bytes((KamigamiRobot.Identifiers.MOTOR_PACKET, 0xF6, 20)))
+        self.assertEqual(frames[1][0], KamigamiRobot.Identifiers.UNIFIED_PACKET)
+        self.assertEqual(frames[1][UnifiedPacket.FLAGS_OFFSET], UnifiedPacket.LIGHT_FLAG)
+        self.assertEqual(merger.stats()["motor_fallbacks"], 1)
+
+    def test_oneshots_go_out_in_order_ahead_of_the_state(self):
+        merger = self.start(rate_hz=100, keepalive=None)
+        merger.send(b"\x05\x08\x02\x00")
+        merger.send(b"\x06")
+        merger.set_motors(10, 20)
+        frames = self.wait_for_frames(3)
+        self.assertEqual(frames[:2], [b"\x05\x08\x02\x00", b"\x06"])
+        self.assertEqual(frames[2][0], KamigamiRobot.Identifiers.UNIFIED_PACKET)
+        self.assertEqual(merger.stats()["oneshots"], 2)
+
+    def test_failed_write_is_retried_on_the_next_tick(self):
+        merger = self.start(writer=FailingWriter(2), rate_hz=100, keepalive=None)
+        merger.set_motors(0, 0)
+        frames = self.wait_for_frames(1, timeout=0.5)
+        self.assertEqual(len(frames), 1)
+        self.assertEqual(tuple(frames[0][UnifiedPacket.MOTOR_OFFSET:UnifiedPacket.MOTOR_OFFSET + 2]), (0, 0))
+        self.assertEqual(merger.stats()["errors"], 2)
+
+    def test_rate_cap(self):
+        merger = self.start(rate_hz=20, keepalive=None)
+        started = time.monotonic()
+        while time.monotonic() - started < 0.5:
+            merger.set_motors(int((time.monotonic() - started) * 100) % 60, 0)
+            time.sleep(0.001)
+        # 0.5s at 20Hz, plus the first frame going out at once.
+        self.assertLessEqual(len(self.writer.frames), 12)
+
+
+if __name__ == "__main__":
+    unittest.main()
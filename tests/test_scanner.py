@@ -0,0 +1,50 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+
+from KamigamiScanner import MacCache
+
+
+def remember_all(path, prefix, count):
+    cache = MacCache(path)
+    for number in range(count):
+        cache.remember("{0}:{1:02X}".format(prefix, number))
+
+
+class MacCacheTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, "robots.json")
+
+    def test_remember_and_forget(self):
+        cache = MacCache(self.path)
+        cache.remember("5A:00:00:00:00:01", -40, write_handle=14)
+        self.assertEqual(cache.fresh(), ["5A:00:00:00:00:01"])
+        self.assertEqual(cache.get("5A:00:00:00:00:01")["write_handle"], 14)
+        cache.forget("5A:00:00:00:00:01")
+        self.assertEqual(cache.fresh(), [])
+
+    def test_memory_only_cache_writes_no_files(self):
+        cache = MacCache(path=None)
+        cache.remember("5A:00:00:00:00:01", write_handle=14)
+        self.assertEqual(cache.fresh(), ["5A:00:00:00:00:01"])
+        self.assertEqual(cache.get("5A:00:00:00:00:01")["write_handle"], 14)
+        self.assertEqual(MacCache(path=None).fresh(), [])
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), [])
+
+    def test_processes_do_not_lose_each_others_updates(self):
+        prefixes = ["5A:00:00:00:{0:02X}".format(worker) for worker in range(4)]
+        workers = [multiprocessing.Process(target=remember_all, args=(self.path, prefix, 20))
+                   for prefix in prefixes]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(30)
+        self.assertEqual(len(MacCache(self.path).fresh()), 80)
+
+
+if __name__ == "__main__":
+    unittest.main()
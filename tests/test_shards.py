@@ -0,0 +1,213 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from bluepy import btle
+
+import KamigamiShards
+from KamigamiFakes import FakeSession
+from KamigamiScanner import MacCache
+from KamigamiShards import HEALTH, ONESHOTS, SLOT, SharedSlots, _SlotMerger
+
+
+class SharedSlotsTest(unittest.TestCase):
+    def test_round_trip(self):
+        slots = SharedSlots(3, SLOT)
+        ring = [0, b"\x00" * 4] * ONESHOTS
+        ring[2:4] = [3, b"\x05\x08\x02\x00"]
+        slots.write(1, -5, 7, 1, 2, 3, 0x03, 9, *ring)
+        self.assertEqual(slots.read(1)[1:], (-5, 7, 1, 2, 3, 0x03, 9) + tuple(ring))
+
+    def test_records_are_independent(self):
+        slots = SharedSlots(3, HEALTH)
+        for index in range(3):
+            slots.write(index, index, index + 1, index + 2, index + 3, index + 4, 0.5 * index, 1.0)
+        for index in range(3):
+            self.assertEqual(slots.read(index)[1:], (index, index + 1, index + 2, index + 3, index + 4, 0.5 * index, 1.0))
+
+    def test_unwritten_record_reads_as_zero(self):
+        slots = SharedSlots(2, HEALTH)
+        self.assertEqual(slots.read(1), (0, 0, 0, 0, 0, 0, 0.0, 0.0))
+
+    def test_sequence_is_even_and_advances(self):
+        slots = SharedSlots(1, HEALTH)
+        sequences = []
+        for value in range(4):
+            slots.write(0, value, 0, 0, 0, 0, 0.0, 0.0)
+            sequences.append(slots.read(0)[0])
+        self.assertTrue(all(sequence % 2 == 0 for sequence in sequences))
+        self.assertEqual(sequences, sorted(set(sequences)))
+
+    def test_write_recovers_from_a_writer_that_died_mid_write(self):
+        slots = SharedSlots(1, HEALTH)
+        slots.write(0, 1, 0, 0, 0, 0, 0.0, 0.0)
+        # As left by a writer killed between the two sequence stores.
+        HEALTH.pack_into(slots.buffer, 0, slots.read(0)[0] + 1, 2, 0, 0, 0, 0, 0.0, 0.0)
+        with self.assertRaises(TimeoutError):
+            slots.read(0, timeout=0.01)
+        slots.write(0, 3, 0, 0, 0, 0, 0.0, 0.0)
+        sequence, connected = slots.read(0)[:2]
+        self.assertEqual(sequence % 2, 0)
+        self.assertEqual(connected, 3)
+
+    def test_reader_never_sees_a_torn_record(self):
+        slots = SharedSlots(1, HEALTH)
+        stop = threading.Event()
+
+        def write():
+            value = 0
+            while not stop.is_set():
+                value = (value + 1) & 0xFFFFFFF
+                slots.write(0, value, value, value, value, value, float(value), float(value))
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        try:
+            for _ in range(20000):
+                fields = slots.read(0)[1:]
+                self.assertEqual(len(set(fields)), 1, fields)
+        finally:
+            stop.set()
+            writer.join()
+
+
+class WorkerTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.cache_path = os.path.join(directory, "robots.json")
+
+        class FlakySession(FakeSession):
+            failures = 2
+
+            def _connect_to(self, mac, use_cached_handles=True):
+                if FlakySession.failures:
+                    FlakySession.failures -= 1
+                    raise OSError("out of range")
+                return FakeSession._connect_to(self, mac, use_cached_handles)
+
+        self.session_class = FlakySession
+
+    def test_robot_that_failed_to_connect_is_retried(self):
+        commands = SharedSlots(1, SLOT)
+        health = SharedSlots(1, HEALTH)
+        stopping = multiprocessing.RawValue('B', 0)
+        worker = threading.Thread(target=KamigamiShards._run_worker, args=(
+            0, [0], ["5A:00:00:00:00:00"], commands, health, 100, self.session_class, self.cache_path, stopping))
+        with mock.patch.object(KamigamiShards, "CONNECT_RETRY_BASE_DELAY", 0.01):
+            worker.start()
+            try:
+                deadline = time.monotonic() + 5.0
+                while not health.read(0)[1] and time.monotonic() < deadline:
+                    time.sleep(0.01)
+                self.assertEqual(health.read(0)[1], 1)
+                self.assertEqual(self.session_class.failures, 0)
+                self.assertIn("5A:00:00:00:00:00", MacCache(self.cache_path).fresh())
+            finally:
+                stopping.value = 1
+                worker.join(5.0)
+
+    def run_worker(self, count, session_class, stopping):
+        commands = SharedSlots(count, SLOT)
+        health = SharedSlots(count, HEALTH)
+        macs = ["5A:00:00:00:00:{0:02X}".format(index) for index in range(count)]
+        worker = threading.Thread(target=KamigamiShards._run_worker, args=(
+            0, list(range(count)), macs, commands, health, 100, session_class, self.cache_path, stopping))
+        worker.start()
+        self.addCleanup(worker.join, 5.0)
+        self.addCleanup(setattr, stopping, "value", 1)
+        deadline = time.monotonic() + 5.0
+        while not all(health.read(index)[1] for index in range(count)) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        # Let the worker take in the first slots before anything is sent.
+        time.sleep(0.05)
+        return commands, health
+
+    def test_oneshots_sent_within_one_tick_all_go_out(self):
+        sessions = []
+
+        class RecordedSession(FakeSession):
+            def connect(self):
+                sessions.append(self)
+                return FakeSession.connect(self)
+
+        commands, health = self.run_worker(1, RecordedSession, multiprocessing.RawValue('B', 0))
+        slot = _SlotMerger(commands, 0)
+        frames = [bytes((number,)) for number in range(1, 5)]
+        for frame in frames:
+            slot.write_value(frame)
+        deadline = time.monotonic() + 2.0
+        writes = sessions[0].writer.writes
+        while len(writes) < len(frames) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual([frame for written, frame in writes], frames)
+        self.assertEqual(health.read(0)[5], 0)
+
+    def test_oneshots_past_the_ring_are_reported_lost(self):
+        commands, health = self.run_worker(1, FakeSession, multiprocessing.RawValue('B', 0))
+        slot = _SlotMerger(commands, 0)
+        # As if the worker missed this many within one tick.
+        slot.oneshots += ONESHOTS + 3
+        slot.write_value(b"\x06")
+        deadline = time.monotonic() + 2.0
+        while not health.read(0)[5] and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(health.read(0)[5], 4)
+
+    def test_dropped_robot_does_not_hold_up_the_others(self):
+        macs = ["5A:00:00:00:00:00", "5A:00:00:00:00:01"]
+
+        class Dropped(btle.BTLEException):
+            def __init__(self):
+                Exception.__init__(self, "Device disconnected")
+
+        def write(val, withResponse=False):
+            raise Dropped()
+
+        class DroppingSession(FakeSession):
+            """
+            Robot 0 connects once; then its writes fail and it never
+            comes back.
+            """
+            dropped = False
+
+            def _connect_to(self, mac, use_cached_handles=True):
+                if self.dropped:
+                    raise Dropped()
+                FakeSession._connect_to(self, mac, use_cached_handles)
+                if mac == macs[0]:
+                    self.dropped = True
+                    self.writer.write = write
+                return self
+
+        commands = SharedSlots(2, SLOT)
+        health = SharedSlots(2, HEALTH)
+        stopping = multiprocessing.RawValue('B', 0)
+        worker = threading.Thread(target=KamigamiShards._run_worker, args=(
+            0, [0, 1], macs, commands, health, 100, DroppingSession, self.cache_path, stopping))
+        with mock.patch.object(KamigamiShards, "RECONNECT_TIMEOUT", 1.0):
+            worker.start()
+            try:
+                deadline = time.monotonic() + 5.0
+                while not health.read(1)[1] and time.monotonic() < deadline:
+                    time.sleep(0.01)
+                # Let the worker see the initial slots before the one-shot.
+                time.sleep(0.05)
+                _SlotMerger(commands, 0).write_value(b"\x05\x08\x02\x00")
+                time.sleep(0.1)
+                before = health.read(1)[-1]
+                time.sleep(0.2)
+                self.assertGreater(health.read(1)[-1], before)
+            finally:
+                stopping.value = 1
+                worker.join(5.0)
+        self.assertFalse(worker.is_alive())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,43 @@
+import unittest
+
+from KamigamiSimulator import RobotWorld, session_class
+
+
+class RecordingDelegate:
+    def __init__(self):
+        self.notifications = []
+
+    def handleNotification(self, handle, data):
+        self.notifications.append(bytes(data))
+
+
+class SimulatedPeripheralTest(unittest.TestCase):
+    def setUp(self):
+        self.world = RobotWorld(1)
+        self.peripheral = self.world.peripheral(0)
+        self.delegate = RecordingDelegate()
+        self.peripheral.withDelegate(self.delegate)
+
+    def test_one_notification_per_wait(self):
+        self.world.notifications[0].extend([b"\x01a", b"\x01b", b"\x01c"])
+        self.assertTrue(self.peripheral.waitForNotifications(0.0))
+        self.assertEqual(self.delegate.notifications, [b"\x01a"])
+        self.assertTrue(self.peripheral.waitForNotifications(0.0))
+        self.assertTrue(self.peripheral.waitForNotifications(0.0))
+        self.assertEqual(self.delegate.notifications, [b"\x01a", b"\x01b", b"\x01c"])
+
+    def test_times_out_when_nothing_queued(self):
+        self.assertFalse(self.peripheral.waitForNotifications(0.01))
+        self.assertEqual(self.delegate.notifications, [])
+
+
+class SimulatedSessionTest(unittest.TestCase):
+    def test_remembers_robots_in_memory_only(self):
+        world = RobotWorld(1)
+        session = session_class(world)(mac=world.macs()[0]).connect()
+        self.assertIsNone(session.cache.path)
+        self.assertEqual(session.cache.fresh(), world.macs())
+
+
+if __name__ == "__main__":
+    unittest.main()